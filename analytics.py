@@ -0,0 +1,90 @@
+"""Whole-guild attendance analytics computed with NumPy.
+
+compute() reads a guild's attendance_stats and ledger once (storage.get_analytics_rows),
+turns them into arrays and derives every aggregate with vectorized operations: the
+attendance-rate distribution, members below ANALYTICS_LOW_RATE, absences by weekday and
+the excused-vs-absent split. It is CPU work, so callers run it off the event loop
+(`await adb.run(analytics.compute, guild_id)`).
+
+NumPy is optional: without it available() is False and the bot reports the missing package.
+"""
+import database
+import storage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Members whose attendance rate is below this percentage are listed as at risk.
+ANALYTICS_LOW_RATE = database.env_int("ANALYTICS_LOW_RATE", 80)
+
+RATE_BINS = (0, 50, 60, 70, 80, 90, 100)
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+# Ledger timestamps are UTC epoch seconds; weekdays are counted in Philippines time (UTC+8).
+PH_OFFSET_SECONDS = 8 * 3600
+
+
+def available():
+    """Returns True when NumPy is installed."""
+    return np is not None
+
+
+def compute(guild_id, low_rate=None):
+    """Returns a guild's attendance analytics as plain Python values.
+
+    Keys: members, rated, mean_rate, median_rate, low_rate, below (list of (user_id, rate,
+    present, sessions), lowest rate first), distribution (list of (label, members)),
+    weekday_absences and weekday_absence_rates (seven entries, Monday first), absent,
+    excused and excused_share.
+    """
+    if np is None:
+        raise RuntimeError("analytics needs NumPy (pip install numpy)")
+    low_rate = ANALYTICS_LOW_RATE if low_rate is None else low_rate
+    data = storage.backend.get_analytics_rows(guild_id)
+
+    stats = np.array(data["stats"], dtype=np.int64).reshape(-1, 4)
+    user_ids, present, absent, excused = stats.T
+    sessions = present + absent + excused
+    rated = sessions > 0
+    rates = np.zeros(len(stats), dtype=np.float64)
+    np.divide(100.0 * present, sessions, out=rates, where=rated)
+
+    rated_rates = rates[rated]
+    below = np.flatnonzero(rated & (rates < low_rate))
+    below = below[np.lexsort((user_ids[below], rates[below]))]
+    counts, _ = np.histogram(rated_rates, bins=RATE_BINS)
+
+    weekday_absences = np.zeros(7, dtype=np.int64)
+    weekday_absence_rates = np.zeros(7, dtype=np.float64)
+    if data["events"]:
+        _, statuses, timestamps = zip(*data["events"])
+        statuses = np.array(statuses)
+        # 1970-01-01 was a Thursday (weekday 3 with Monday = 0).
+        weekdays = ((np.array(timestamps, dtype=np.int64) + PH_OFFSET_SECONDS) // 86400 + 3) % 7
+        weekday_absences = np.bincount(weekdays[statuses == "absent"], minlength=7)
+        weekday_sessions = np.bincount(weekdays, minlength=7)
+        np.divide(100.0 * weekday_absences, weekday_sessions, out=weekday_absence_rates, where=weekday_sessions > 0)
+
+    total_absent = int(absent.sum())
+    total_excused = int(excused.sum())
+    missed = total_absent + total_excused
+    return {
+        "members": len(stats),
+        "rated": int(rated.sum()),
+        "mean_rate": round(float(rated_rates.mean()), 1) if rated_rates.size else None,
+        "median_rate": round(float(np.median(rated_rates)), 1) if rated_rates.size else None,
+        "low_rate": low_rate,
+        "below": [
+            (int(user_ids[i]), round(float(rates[i]), 1), int(present[i]), int(sessions[i]))
+            for i in below
+        ],
+        "distribution": [
+            (f"{RATE_BINS[i]}–{RATE_BINS[i + 1]}%", int(count)) for i, count in enumerate(counts)
+        ],
+        "weekday_absences": [int(count) for count in weekday_absences],
+        "weekday_absence_rates": [round(float(rate), 1) for rate in weekday_absence_rates],
+        "absent": total_absent,
+        "excused": total_excused,
+        "excused_share": round(100 * total_excused / missed, 1) if missed else None,
+    }
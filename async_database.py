@@ -0,0 +1,50 @@
+"""Awaitable facade over the configured storage backend (storage.backend).
+
+Every public operation of the backend is available here as a coroutine that runs the
+blocking call on a small bounded thread pool, so the discord.py event loop keeps
+serving heartbeats and other guilds while a query or commit is in flight:
+
+    import async_database as adb
+    config = await adb.get_guild_config(guild_id)
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import storage
+
+# Reads are still capped by the reader pool, but writers mostly wait on the group-commit
+# queue, so extra threads let a check-in burst share one transaction instead of queueing here.
+DB_EXECUTOR_WORKERS = database.env_int("DB_EXECUTOR_WORKERS", 32)
+
+_executor = ThreadPoolExecutor(max_workers=max(1, DB_EXECUTOR_WORKERS), thread_name_prefix="registrar-db")
+_wrappers = {}
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking callable on the database executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown(wait=True):
+    """Stops accepting new work and (optionally) waits for queued calls to finish."""
+    _executor.shutdown(wait=wait)
+
+
+def __getattr__(name):
+    wrapper = _wrappers.get(name)
+    if wrapper is not None:
+        return wrapper
+
+    target = getattr(storage.backend, name, None)
+    if name.startswith("_") or not callable(target) or isinstance(target, type):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    @functools.wraps(target)
+    async def wrapper(*args, **kwargs):
+        return await run(target, *args, **kwargs)
+
+    _wrappers[name] = wrapper
+    return wrapper
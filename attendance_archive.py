@@ -0,0 +1,176 @@
+"""Cold storage for closed months of the attendance ledger (attendance_events).
+
+Each guild's month lives in <archive dir>/<guild_id>/<YYYY-MM>.csv.gz. The file is an
+ordinary gzip CSV (`zcat` prints it) written as a series of gzip members:
+
+    header    user_id,status,reason,ts,source,id
+    one member per user with that user's rows, oldest first
+    index     "#index {json}": each user's [offset, length, rows], the row count and ts range
+    tail      "#footer <offset of the index member>", a fixed-size stored member
+
+A reader seeks to the tail, then the index, and decompresses only the members it needs, so
+one member's history for a month costs a few small reads however large the guild is.
+Months follow Philippines time (UTC+8), like the attendance windows.
+"""
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+from pathlib import Path
+
+COLUMNS = ("user_id", "status", "reason", "ts", "source", "id")
+PH_TZ = datetime.timezone(datetime.timedelta(hours=8))
+
+
+def _member(data, compresslevel=9):
+    return gzip.compress(data, compresslevel=compresslevel, mtime=0)
+
+
+def _tail(offset):
+    # Stored (level 0) and fixed-width, so the tail is always TAIL_SIZE bytes.
+    return _member(b"#footer %020d\n" % offset, compresslevel=0)
+
+
+TAIL_SIZE = len(_tail(0))
+
+
+def month_key(ts):
+    """Returns the 'YYYY-MM' month of an epoch-seconds timestamp."""
+    return datetime.datetime.fromtimestamp(ts, PH_TZ).strftime("%Y-%m")
+
+
+def month_bounds(month):
+    """Returns (start, end) epoch seconds of a 'YYYY-MM' month; end is exclusive."""
+    start = datetime.datetime.strptime(month, "%Y-%m").replace(tzinfo=PH_TZ)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def archive_path(archive_dir, guild_id, month):
+    return Path(archive_dir) / str(guild_id) / f"{month}.csv.gz"
+
+
+def archived_months(archive_dir, guild_id):
+    """Returns the guild's archived 'YYYY-MM' months, oldest first."""
+    guild_dir = Path(archive_dir) / str(guild_id)
+    if not guild_dir.is_dir():
+        return []
+    return sorted(path.name[:-len(".csv.gz")] for path in guild_dir.glob("*.csv.gz"))
+
+
+def _csv_bytes(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+def write_month(archive_dir, guild_id, month, rows):
+    """Writes (user_id, status, reason, ts, source, id) rows as a month file, replacing any old one.
+
+    The file is written to a fresh temporary file beside it, synced and renamed, so a crash never
+    leaves a partial archive behind. Returns the path.
+    """
+    by_user = {}
+    for row in rows:
+        by_user.setdefault(int(row[0]), []).append(row)
+
+    path = archive_path(archive_dir, guild_id, month)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    users = {}
+    timestamps = [row[3] for row in rows]
+    fd, temp_path = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_member(_csv_bytes([COLUMNS])))
+            for user_id in sorted(by_user):
+                user_rows = sorted(by_user[user_id], key=lambda row: (row[3], row[5]))
+                data = _member(_csv_bytes(user_rows))
+                users[str(user_id)] = [f.tell(), len(data), len(user_rows)]
+                f.write(data)
+            index = {
+                "guild_id": guild_id,
+                "month": month,
+                "columns": COLUMNS,
+                "rows": len(rows),
+                "min_ts": min(timestamps, default=None),
+                "max_ts": max(timestamps, default=None),
+                "users": users,
+            }
+            index_offset = f.tell()
+            f.write(_member(b"#index " + json.dumps(index, separators=(",", ":")).encode("utf-8") + b"\n"))
+            f.write(_tail(index_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+def read_index(path):
+    """Returns the index of a month file (see the module docstring)."""
+    with open(path, "rb") as f:
+        f.seek(-TAIL_SIZE, os.SEEK_END)
+        index_offset = int(gzip.decompress(f.read(TAIL_SIZE)).split()[1])
+        f.seek(index_offset)
+        index = f.read(os.fstat(f.fileno()).st_size - TAIL_SIZE - index_offset)
+    return json.loads(gzip.decompress(index)[len(b"#index "):])
+
+
+def _parse(data):
+    return [
+        (int(user_id), status, reason or None, int(ts), source or None, int(event_id))
+        for user_id, status, reason, ts, source, event_id in csv.reader(io.StringIO(data.decode("utf-8")))
+    ]
+
+
+def read_rows(path, user_id=None):
+    """Returns a month file's (user_id, status, reason, ts, source, id) rows, or one user's."""
+    index = read_index(path)
+    if user_id is None:
+        spans = list(index["users"].values())
+    else:
+        span = index["users"].get(str(int(user_id)))
+        spans = [span] if span else []
+    rows = []
+    with open(path, "rb") as f:
+        for offset, length, _ in spans:
+            f.seek(offset)
+            rows.extend(_parse(gzip.decompress(f.read(length))))
+    return rows
+
+
+def read_history(archive_dir, guild_id, user_id, since, until):
+    """Returns a member's archived events with since <= ts < until as {status, reason, ts, source}."""
+    events = []
+    for month in archived_months(archive_dir, guild_id):
+        start, end = month_bounds(month)
+        if end <= since or start >= until:
+            continue
+        for _, status, reason, ts, source, _ in read_rows(archive_path(archive_dir, guild_id, month), user_id):
+            if since <= ts < until:
+                events.append({"status": status, "reason": reason, "ts": ts, "source": source})
+    return events
+
+
+def read_excuses(archive_dir, guild_id, since, until):
+    """Returns a guild's archived excused events that have a reason, with since <= ts < until,
+    as {user_id, reason, ts, source}, newest first."""
+    excuses = []
+    for month in archived_months(archive_dir, guild_id):
+        start, end = month_bounds(month)
+        if end <= since or start >= until:
+            continue
+        for user_id, status, reason, ts, source, _ in read_rows(archive_path(archive_dir, guild_id, month)):
+            if status == "excused" and reason and since <= ts < until:
+                excuses.append({"user_id": user_id, "reason": reason, "ts": ts, "source": source})
+    excuses.sort(key=lambda excuse: excuse["ts"], reverse=True)
+    return excuses
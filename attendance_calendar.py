@@ -0,0 +1,125 @@
+"""Compact attendance calendars: two bits per day, one BLOB per (guild, user, year).
+
+Day n of the year (January 1 is day 0) is bits 2n and 2n+1 of the calendar read as a
+little-endian integer: 0 = no session, 1 = present, 2 = absent, 3 = excused. A whole year
+is CALENDAR_BYTES (92) bytes, so a 5,000-member guild needs under half a megabyte.
+
+The helpers below never loop over days. They split a calendar into one mask per status
+(the day's low bit position set when it has that status) and answer counts, rates, streaks
+and "days missed" with integer AND/shift/popcount over the whole range at once.
+"""
+import datetime
+
+PRESENT, ABSENT, EXCUSED = 1, 2, 3
+CODES = {"present": PRESENT, "absent": ABSENT, "excused": EXCUSED}
+STATUSES = {code: status for status, code in CODES.items()}
+
+DAYS = 366
+CALENDAR_BYTES = (2 * DAYS + 7) // 8
+# The low bit of every day's pair.
+DAY_BITS = int("01" * DAYS, 2)
+
+
+def day_index(day):
+    """Returns (year, day of year from 0) for a 'YYYY-MM-DD' string, date or datetime."""
+    if isinstance(day, str):
+        day = datetime.datetime.strptime(day, "%Y-%m-%d").date()
+    return day.year, day.timetuple().tm_yday - 1
+
+
+def day_date(year, index):
+    """Returns the date of a day index within year."""
+    return datetime.date(year, 1, 1) + datetime.timedelta(days=index)
+
+
+def _value(calendar):
+    return int.from_bytes(calendar or b"", "little")
+
+
+def set_day(calendar, index, status):
+    """Returns a copy of calendar (None for an empty one) with day index set to status."""
+    code = CODES[status]
+    value = _value(calendar) & ~(3 << 2 * index) | code << 2 * index
+    return value.to_bytes(CALENDAR_BYTES, "little")
+
+
+def get_day(calendar, index):
+    """Returns the status recorded for day index, or None when there was no session."""
+    return STATUSES.get(_value(calendar) >> 2 * index & 3)
+
+
+def day_masks(calendar):
+    """Returns (present, absent, excused) masks with bit 2n set when day n has that status."""
+    value = _value(calendar)
+    low = value & DAY_BITS
+    high = value >> 1 & DAY_BITS
+    return low & ~high, high & ~low, low & high
+
+
+def range_mask(start=0, end=DAYS):
+    """Mask selecting days start..end-1."""
+    return DAY_BITS & ((1 << 2 * end) - 1) & ~((1 << 2 * start) - 1)
+
+
+def summarize(calendar, start=0, end=DAYS):
+    """Returns {present, absent, excused, sessions, rate} for days start..end-1."""
+    window = range_mask(start, end)
+    present, absent, excused = (
+        (mask & window).bit_count() for mask in day_masks(calendar)
+    )
+    sessions = present + absent + excused
+    return {
+        "present": present,
+        "absent": absent,
+        "excused": excused,
+        "sessions": sessions,
+        "rate": round(100 * present / sessions, 1) if sessions else None,
+    }
+
+
+def days_missed(calendar, start=0, end=DAYS):
+    """Returns how many sessions in days start..end-1 were marked absent."""
+    return (day_masks(calendar)[1] & range_mask(start, end)).bit_count()
+
+
+def missed_days(calendar, start=0, end=DAYS):
+    """Returns the day indexes marked absent in days start..end-1, in order."""
+    absent = day_masks(calendar)[1] & range_mask(start, end)
+    days = []
+    while absent:
+        lowest = absent & -absent
+        days.append(lowest.bit_length() // 2)
+        absent ^= lowest
+    return days
+
+
+def streaks(calendar, end=DAYS):
+    """Returns (current, best) present streaks up to day end-1.
+
+    Like attendance_streaks, an absence ends a streak while excused days and days without
+    a session leave it unchanged. Work is one popcount per absence, not per day.
+    """
+    window = range_mask(0, end)
+    present, absent, _ = day_masks(calendar)
+    present &= window
+    absent &= window
+    best = 0
+    while absent:
+        below = (absent & -absent) - 1  # every day before the earliest remaining absence
+        best = max(best, (present & below).bit_count())
+        present &= ~below
+        absent &= absent - 1
+    current = present.bit_count()
+    return current, max(best, current)
+
+
+def guild_missed(calendars, start=0, end=DAYS):
+    """Returns {user_id: days missed} over start..end-1 for a {user_id: calendar} mapping."""
+    window = range_mask(start, end)
+    missed = {}
+    for user_id, calendar in calendars.items():
+        value = _value(calendar)
+        count = (value >> 1 & ~value & window).bit_count()
+        if count:
+            missed[user_id] = count
+    return missed
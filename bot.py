@@ -1,15 +1,23 @@
 import os
+import re
 import json
 import datetime
 import asyncio
 import logging
+import signal
 import time
-from typing import Union
+from collections import OrderedDict
+from typing import Optional, Union
 import discord
 from discord.ext import commands, tasks
 from env_utils import load_dotenv
 from keep_alive import keep_alive
-import database # Import database module
+import storage # Storage backend (DB_BACKEND)
+import async_database as adb
+import ranking
+import attendance_calendar
+import analytics
+import replication
 
 # Load environment variables
 load_dotenv()
@@ -57,7 +65,7 @@ def can_manage_nick(ctx, member):
 
 async def apply_nickname(member):
     """Helper function to apply the nickname suffix."""
-    settings = load_settings(member.guild.id)
+    settings = await load_settings(member.guild.id)
     suffix = settings.get("suffix_format", SUFFIX)
     
     try:
@@ -86,7 +94,7 @@ async def apply_nickname(member):
 
 async def remove_nickname(member):
     """Helper function to remove the nickname suffix."""
-    settings = load_settings(member.guild.id)
+    settings = await load_settings(member.guild.id)
     suffix = settings.get("suffix_format", SUFFIX)
     
     try:
@@ -119,13 +127,13 @@ async def on_member_join(member):
         logger.info(f"Member {member.name} is pending verification. Skipping auto-nick.")
         return
 
-    settings = load_settings(member.guild.id)
+    settings = await load_settings(member.guild.id)
     if settings.get("auto_nick_on_join", False):
         await apply_nickname(member)
 
 @bot.event
 async def on_member_update(before, after):
-    settings = load_settings(after.guild.id)
+    settings = await load_settings(after.guild.id)
     
     # Handle Membership Screening Completion (Pending -> Member)
     if before.pending and not after.pending:
@@ -243,7 +251,7 @@ async def nick(ctx, *, name: str = None):
                 return
 
             # Check if the suffix is already in the provided name, if not, append it
-            settings = load_settings(ctx.guild.id)
+            settings = await load_settings(ctx.guild.id)
             suffix = settings.get("suffix_format", SUFFIX)
             if not name.endswith(suffix):
                  # Truncate if necessary
@@ -357,7 +365,7 @@ async def add_custom_command(ctx, command_name: str = None, *, response_text: st
         await ctx.send(f"❌ `!{normalized_name}` is already used by a built-in bot command or alias.")
         return
 
-    database.upsert_custom_command(ctx.guild.id, normalized_name, response_text.strip())
+    await adb.upsert_custom_command(ctx.guild.id, normalized_name, response_text.strip())
     await ctx.send(f"✅ Custom command saved. Members can now use `!{normalized_name}`.")
 
 
@@ -377,7 +385,7 @@ async def remove_custom_command(ctx, command_name: str = None):
         await ctx.send("❌ Please provide a valid one-word command name.")
         return
 
-    if database.delete_custom_command(ctx.guild.id, normalized_name):
+    if await adb.delete_custom_command(ctx.guild.id, normalized_name):
         await ctx.send(f"🗑️ Removed custom command `!{normalized_name}`.")
     else:
         await ctx.send(f"❌ No custom command named `!{normalized_name}` was found.")
@@ -386,7 +394,7 @@ async def remove_custom_command(ctx, command_name: str = None):
 @bot.command(name='listcommands', aliases=['customcommands'])
 async def list_custom_commands(ctx):
     """Lists the custom commands configured for this server."""
-    commands_map = database.get_custom_commands(ctx.guild.id)
+    commands_map = await adb.get_custom_commands(ctx.guild.id)
     if not commands_map:
         await ctx.send("No custom commands are configured yet.")
         return
@@ -406,8 +414,8 @@ async def check_and_notify_setup_completion(ctx):
     Required: Time Window, Report Channel, Present Role, Absent Role, Excused Role, Permit Role.
     """
     try:
-        data = load_attendance_data(ctx.guild.id)
-        settings = load_settings(ctx.guild.id)
+        data = await load_attendance_data(ctx.guild.id)
+        settings = await load_settings(ctx.guild.id)
         
         # Check required fields
         # 1. Time Window (implied by attendance_mode='window' which is set by !settime, 
@@ -497,7 +505,7 @@ async def set_attendance_time(ctx, *, time_input: str = None):
             await ctx.send(f"Invalid time format (`{start_str}` or `{end_str}`). Please use formats like `6am`, `11:59pm`, `08:00`.")
             return
             
-        settings = load_settings(ctx.guild.id)
+        settings = await load_settings(ctx.guild.id)
         settings['attendance_mode'] = 'window'
         settings['window_start_time'] = s_parsed
         settings['window_end_time'] = e_parsed
@@ -505,7 +513,7 @@ async def set_attendance_time(ctx, *, time_input: str = None):
         # Reset the last processed date so we don't accidentally skip today if re-setting
         settings['last_processed_date'] = None
         
-        save_settings(ctx.guild.id, settings)
+        await save_settings(ctx.guild.id, settings)
         
         # Convert to 12-hour format for confirmation message
         dt_start = datetime.datetime.strptime(s_parsed, "%H:%M")
@@ -517,7 +525,7 @@ async def set_attendance_time(ctx, *, time_input: str = None):
         await ctx.send(f"✅ Attendance time set to **{display_s} - {display_e}**. Mode switched to 'Window'.")
         
         # Check if allowed_role is set for auto-absence
-        data = load_attendance_data(ctx.guild.id)
+        data = await load_attendance_data(ctx.guild.id)
         if not data.get('allowed_role_id'):
             await ctx.send("⚠️ **Note:** You haven't set a 'Permitted Role' (the role required to attend). \n"
                            "Bot cannot determine who is 'missing' without it. \n"
@@ -536,20 +544,24 @@ async def set_attendance_time(ctx, *, time_input: str = None):
 
 _settings_cache = {}
 
-def has_conflicting_attendance_status(records, user_id, target_status):
+async def has_conflicting_attendance_status(guild_id, user_id, target_status):
     """Return the existing attendance status when a user tries to switch states."""
-    record = (records or {}).get(str(user_id), {})
+    record = await adb.get_record(guild_id, user_id) or {}
     current_status = record.get('status')
     if current_status in ('present', 'absent', 'excused') and current_status != target_status:
         return current_status
     return None
 
-def load_attendance_data(guild_id):
-    """Loads attendance data for a specific guild from the database."""
-    config = database.get_guild_config(guild_id)
+async def load_attendance_data(guild_id, include_records=True):
+    """Loads attendance data for a specific guild from the database.
+
+    Pass include_records=False on single-member paths; the result then has no "records"
+    key and save_attendance_data leaves the stored records untouched.
+    """
+    config = await adb.get_guild_config(guild_id)
     if not config:
         # Default structure for new guilds
-        return {
+        data = {
             "attendance_role_id": None, 
             "absent_role_id": None, 
             "excused_role_id": None, 
@@ -560,6 +572,9 @@ def load_attendance_data(guild_id):
             "records": {}, 
             "settings": {}
         }
+        if not include_records:
+            del data["records"]
+        return data
     
     # Reconstruct settings dict
     settings = {
@@ -577,9 +592,7 @@ def load_attendance_data(guild_id):
         "suffix_format": config.get('suffix_format')
     }
     
-    records = database.get_attendance_records(guild_id)
-    
-    return {
+    data = {
         "attendance_role_id": config.get('attendance_role_id'),
         "absent_role_id": config.get('absent_role_id'),
         "excused_role_id": config.get('excused_role_id'),
@@ -588,11 +601,13 @@ def load_attendance_data(guild_id):
         "last_report_message_id": config.get('last_report_message_id'),
         "last_report_channel_id": config.get('last_report_channel_id'),
         "present_channel_id": config.get('present_channel_id'),
-        "records": records,
         "settings": settings
     }
+    if include_records:
+        data["records"] = await adb.get_attendance_records(guild_id)
+    return data
 
-def save_attendance_data(guild_id, guild_data):
+async def save_attendance_data(guild_id, guild_data):
     """Saves attendance data for a specific guild to the database."""
     settings = guild_data.get('settings', {})
     
@@ -622,16 +637,17 @@ def save_attendance_data(guild_id, guild_data):
         "suffix_format": settings.get('suffix_format')
     }
     
-    database.update_guild_config(guild_id, **config_update)
-    database.replace_all_records(guild_id, guild_data.get('records', {}))
+    await adb.update_guild_config(guild_id, **config_update)
+    if 'records' in guild_data:
+        await adb.replace_all_records(guild_id, guild_data['records'])
 
-def load_settings(guild_id):
+async def load_settings(guild_id):
     """Helper to get settings with defaults for a guild (Cached)"""
     # Check cache first
     if guild_id in _settings_cache:
         return _settings_cache[guild_id]
 
-    config = database.get_guild_config(guild_id)
+    config = await adb.get_guild_config(guild_id)
     
     defaults = {
         "debug_mode": False,
@@ -679,7 +695,7 @@ def load_settings(guild_id):
     _settings_cache[guild_id] = settings
     return settings
 
-def save_settings(guild_id, settings):
+async def save_settings(guild_id, settings):
     # Update cache
     _settings_cache[guild_id] = settings
     
@@ -697,7 +713,7 @@ def save_settings(guild_id, settings):
         "remove_suffix_on_role_loss": settings.get('remove_suffix_on_role_loss'),
         "suffix_format": settings.get('suffix_format')
     }
-    database.update_guild_config(guild_id, **config_update)
+    await adb.update_guild_config(guild_id, **config_update)
 
 # --- Configuration Views ---
 
@@ -714,7 +730,7 @@ class SettingsSelect(discord.ui.Select):
 
     async def callback(self, interaction: discord.Interaction):
         category = self.values[0]
-        settings = load_settings(interaction.guild.id)
+        settings = await load_settings(interaction.guild.id)
         
         if category == "System Settings":
             view = SystemSettingsView(interaction.guild.id, settings)
@@ -772,7 +788,7 @@ class BaseSettingsView(discord.ui.View):
         self.settings = settings
 
     async def update_message(self, interaction, embed):
-        save_settings(self.guild_id, self.settings)
+        await save_settings(self.guild_id, self.settings)
         await interaction.response.edit_message(embed=embed, view=self)
 
     @discord.ui.button(label="Back to Main Menu", style=discord.ButtonStyle.secondary, row=4)
@@ -912,9 +928,9 @@ async def assign_attendance_role(ctx, role: discord.Role):
     Sets the role that users receive when they say 'present'.
     Usage: !presentrole @Role (or !assignrole @Role)
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     data['attendance_role_id'] = role.id
-    save_attendance_data(ctx.guild.id, data)
+    await save_attendance_data(ctx.guild.id, data)
     await ctx.send(f"Attendance role has been set to {role.mention}. Users who say 'present' will now receive this role for 12 hours.")
     
     # Check setup completion
@@ -927,9 +943,9 @@ async def assign_absent_role(ctx, role: discord.Role):
     Sets the role that users receive when marked as absent.
     Usage: !absentrole @Role
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     data['absent_role_id'] = role.id
-    save_attendance_data(ctx.guild.id, data)
+    await save_attendance_data(ctx.guild.id, data)
     await ctx.send(f"Absent role has been set to {role.mention}.")
     
     # Check setup completion
@@ -942,16 +958,16 @@ async def assign_excused_role(ctx, role: discord.Role):
     Sets the role that users receive when marked as excused.
     Usage: !excuserole @Role
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     data['excused_role_id'] = role.id
-    save_attendance_data(ctx.guild.id, data)
+    await save_attendance_data(ctx.guild.id, data)
     await ctx.send(f"Excused role has been set to {role.mention}.")
     
     # Check setup completion
     await check_and_notify_setup_completion(ctx)
 
 async def update_user_status(ctx, member, status, reason=None):
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id, include_records=False)
     
     # Get all role IDs
     present_role_id = data.get('attendance_role_id')
@@ -1006,23 +1022,11 @@ async def update_user_status(ctx, member, status, reason=None):
             msg += f"\nReason: {reason}"
         await ctx.send(msg, delete_after=10)
 
-    # Update JSON
-    user_id = str(member.id)
-    if 'records' not in data:
-        data['records'] = {}
-    
-    record = {
-        "status": status,
-        "timestamp": datetime.datetime.now().isoformat(),
-        "channel_id": ctx.channel.id
-    }
-    if reason:
-        record["reason"] = reason
-        
-    data['records'][user_id] = record
-    save_attendance_data(ctx.guild.id, data)
-    if status in ('present', 'absent', 'excused'):
-        database.increment_status_count(ctx.guild.id, member.id, status)
+    # Update record, stats and history in one write
+    await adb.record_attendance(
+        ctx.guild.id, member.id, status, datetime.datetime.now().isoformat(),
+        channel_id=ctx.channel.id, reason=reason or None, source="command"
+    )
     
     # Philippines Time (UTC+8) for DMs
     ph_tz = datetime.timezone(datetime.timedelta(hours=8))
@@ -1093,7 +1097,7 @@ async def set_permit_role(ctx, role: discord.Role = None):
     Usage: !setpermitrole @Role
     Usage: !setpermitrole (to reset/allow everyone)
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     if role:
         data['allowed_role_id'] = role.id
         await ctx.send(f"Permission Updated: Only users with the {role.mention} role can mark attendance.")
@@ -1101,7 +1105,7 @@ async def set_permit_role(ctx, role: discord.Role = None):
         data['allowed_role_id'] = None
         await ctx.send("Permission Updated: Everyone can now mark attendance.")
     
-    save_attendance_data(ctx.guild.id, data)
+    await save_attendance_data(ctx.guild.id, data)
     
     # Check setup completion
     await check_and_notify_setup_completion(ctx)
@@ -1114,14 +1118,14 @@ async def set_present_channel(ctx, channel: discord.TextChannel = None):
     Usage: !channelpresent #channel
     Usage: !channelpresent (to remove the restriction)
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     if channel:
         data['present_channel_id'] = channel.id
-        save_attendance_data(ctx.guild.id, data)
+        await save_attendance_data(ctx.guild.id, data)
         await ctx.send(f"Present channel updated: users can only say `present` in {channel.mention}.")
     else:
         data['present_channel_id'] = None
-        save_attendance_data(ctx.guild.id, data)
+        await save_attendance_data(ctx.guild.id, data)
         await ctx.send("Present channel restriction removed: users can say `present` in any channel.")
 
 @bot.command(name='resetpermitrole', aliases=['resetassignrole', 'resetallowedrole'])
@@ -1132,7 +1136,7 @@ async def reset_permit_role_users(ctx):
     This effectively resets who is allowed to say 'present'.
     Usage: !resetpermitrole
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     allowed_role_id = data.get('allowed_role_id')
     
     if not allowed_role_id:
@@ -1211,8 +1215,8 @@ def is_weekend_in_ph(now_dt=None):
     return current_dt.weekday() >= 5
 
 
-def is_in_attendance_window(guild_id):
-    settings = load_settings(guild_id)
+async def is_in_attendance_window(guild_id):
+    settings = await load_settings(guild_id)
     now_dt = get_current_ph_time()
 
     if is_weekend_in_ph(now_dt):
@@ -1259,10 +1263,10 @@ async def mark_present(ctx, member: discord.Member = None):
 
     # Check for required role if marking self
     if member == ctx.author:
-        settings = load_settings(ctx.guild.id)
+        settings = await load_settings(ctx.guild.id)
         
         # Check Window
-        allowed, msg = is_in_attendance_window(ctx.guild.id)
+        allowed, msg = await is_in_attendance_window(ctx.guild.id)
         if not allowed:
              await ctx.send(msg)
              return
@@ -1271,8 +1275,8 @@ async def mark_present(ctx, member: discord.Member = None):
             await ctx.send("Self-marking is currently disabled.")
             return
 
-        data = load_attendance_data(ctx.guild.id)
-        existing_status = has_conflicting_attendance_status(data.get('records'), ctx.author.id, 'present')
+        data = await load_attendance_data(ctx.guild.id, include_records=False)
+        existing_status = await has_conflicting_attendance_status(ctx.guild.id, ctx.author.id, 'present')
         if existing_status:
             await ctx.send(
                 f"You are already marked as **{existing_status}** and cannot switch to **present** this session. Reset attendance before changing it."
@@ -1299,7 +1303,7 @@ async def mark_absent(ctx, member: discord.Member):
     Marks a user as absent.
     Usage: !absent @User
     """
-    allowed, msg = is_in_attendance_window(ctx.guild.id)
+    allowed, msg = await is_in_attendance_window(ctx.guild.id)
     if not allowed:
         await ctx.send(msg)
         return
@@ -1312,12 +1316,12 @@ async def mark_excuse(ctx, member: discord.Member, *, reason: str):
     Marks a user as excused with a reason.
     Usage: !excuse @User I was sick
     """
-    allowed, msg = is_in_attendance_window(ctx.guild.id)
+    allowed, msg = await is_in_attendance_window(ctx.guild.id)
     if not allowed:
         await ctx.send(f"{msg} Excuse submissions are also closed once attendance time is over.")
         return
 
-    settings = load_settings(ctx.guild.id)
+    settings = await load_settings(ctx.guild.id)
     if settings.get('require_admin_excuse', True):
         if not ctx.author.guild_permissions.manage_roles:
             await ctx.send("You do not have permission to excuse users.")
@@ -1330,10 +1334,11 @@ async def mark_excuse_error(ctx, error):
     if isinstance(error, commands.MissingRequiredArgument):
         await ctx.send("Usage: `!excuse @User <reason>` (e.g., `!excuse @John I was sick`)")
 
-def create_attendance_embed(guild):
+async def create_attendance_embed(guild, records=None):
     logger.info(f"Generating report for guild: {guild.name} ({guild.id})")
-    data = load_attendance_data(guild.id)
-    records = data.get('records', {})
+    data = await load_attendance_data(guild.id, include_records=records is None)
+    if records is None:
+        records = data.get('records', {})
     
     now_ph = get_current_ph_time()
 
@@ -1345,7 +1350,7 @@ def create_attendance_embed(guild):
         embed.set_author(name=guild.name)
         
     # Check status
-    allowed, _ = is_in_attendance_window(guild.id)
+    allowed, _ = await is_in_attendance_window(guild.id)
     status_str = "🟢 **OPEN**" if allowed else "🔴 **CLOSED**"
     
     # Get Window Info
@@ -1427,14 +1432,12 @@ async def remove_present(ctx, member: discord.Member):
     Removes a user's present status/role so they can mark attendance again.
     Usage: !removepresent @User
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id, include_records=False)
     role_id = data.get('attendance_role_id')
-    user_id = str(member.id)
     
     # Remove from records
-    if 'records' in data and user_id in data['records']:
-        del data['records'][user_id]
-        save_attendance_data(ctx.guild.id, data)
+    if await adb.delete_record(ctx.guild.id, member.id):
+        await adb.log_attendance_event(ctx.guild.id, member.id, "removed", source="removepresent")
     
     # Remove role
     if role_id:
@@ -1470,7 +1473,7 @@ async def restart_attendance(ctx):
     # Proceed with reset
     await ctx.send("🔄 Resetting attendance system... Please wait.")
     
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     
     # 1. Remove Roles
     roles_to_reset = []
@@ -1515,9 +1518,9 @@ async def restart_attendance(ctx):
         "settings": default_settings
     }
     
-    save_attendance_data(ctx.guild.id, fresh_data)
-    database.clear_attendance_records(ctx.guild.id)
-    database.clear_attendance_stats(ctx.guild.id)
+    await save_attendance_data(ctx.guild.id, fresh_data)
+    await adb.clear_attendance_records(ctx.guild.id)
+    await adb.clear_attendance_stats(ctx.guild.id)
     
     # Attempt to post a fresh, empty report to the report channel
     report_channel_id = data.get('report_channel_id')
@@ -1528,7 +1531,7 @@ async def restart_attendance(ctx):
                 # Create a temporary guild object or just call the function since it only needs ID for loading data
                 # but create_attendance_embed uses guild.get_member etc.
                 # Since we are in ctx, we can use ctx.guild
-                embed = create_attendance_embed(ctx.guild)
+                embed = await create_attendance_embed(ctx.guild)
                 await channel.send(embed=embed)
             except:
                 pass
@@ -1538,16 +1541,18 @@ async def restart_attendance(ctx):
 # Store the last report state to prevent unnecessary updates
 guild_report_state = {}
 
-async def refresh_attendance_report(guild, target_channel=None, force_update=False):
+async def refresh_attendance_report(guild, target_channel=None, force_update=False, records=None):
     """
     Updates the existing report or sends a new one if it doesn't exist.
+    Pass records to report a session that is no longer stored (e.g. right after close-out).
     """
-    data = load_attendance_data(guild.id)
+    data = await load_attendance_data(guild.id, include_records=records is None)
+    if records is None:
+        records = data.get('records', {})
     
     # Calculate state to check if update is needed
     try:
-        is_open, _ = is_in_attendance_window(guild.id)
-        records = data.get('records', {})
+        is_open, _ = await is_in_attendance_window(guild.id)
         # Create a stable string representation of the data that affects the report content
         # We include: Open Status, Records (sorted), and Window Settings (in case time changes)
         settings = data.get('settings', {})
@@ -1589,7 +1594,7 @@ async def refresh_attendance_report(guild, target_channel=None, force_update=Fal
         logger.error(f"Security Alert: Attempted to post report for {guild.name} to channel in {channel.guild.name}!")
         return None
         
-    embed = create_attendance_embed(guild)
+    embed = await create_attendance_embed(guild, records=records)
     
     # Try to edit existing message if channel matches
     if last_msg_id and last_chan_id and last_chan_id == channel.id:
@@ -1621,33 +1626,76 @@ async def refresh_attendance_report(guild, target_channel=None, force_update=Fal
         new_msg = await channel.send(embed=embed)
         data['last_report_message_id'] = new_msg.id
         data['last_report_channel_id'] = channel.id
-        save_attendance_data(guild.id, data)
+        await save_attendance_data(guild.id, data)
         return new_msg
     except discord.Forbidden:
         return None
 
-@bot.command(name='attendance_leaderboard', aliases=['presentleaderboard', 'leaderboard'])
-async def attendance_leaderboard(ctx, page: int = 1):
-    per_page = 10
-    max_pages = 200
+LEADERBOARD_PER_PAGE = 10
+LEADERBOARD_CACHE_PAGES = max(1, int(os.getenv('LEADERBOARD_CACHE_PAGES', '20') or 20))
+
+# Last (present_count, user_id) of each leaderboard page seen, per guild, valid for one stats version
+leaderboard_cursors = {}
+# Rendered pages per guild: guild_id -> OrderedDict(page -> (embed, total_pages)), least recent first
+leaderboard_pages = {}
+# Bumped on every stats change so a page rendered from older data is never cached
+leaderboard_generations = {}
+
+def invalidate_leaderboard(guild_id, rows=None, version=None):
+    """Stats listener: drops a guild's rendered leaderboard pages (every guild's if guild_id is None)."""
+    if guild_id is None:
+        for gid in list(leaderboard_generations):
+            leaderboard_generations[gid] += 1
+        leaderboard_pages.clear()
+        return
+    leaderboard_generations[guild_id] = leaderboard_generations.get(guild_id, 0) + 1
+    leaderboard_pages.pop(guild_id, None)
+
+storage.add_stats_listener(invalidate_leaderboard)
+
+def cached_leaderboard_page(guild_id, page):
+    pages = leaderboard_pages.get(guild_id)
+    if not pages or page not in pages:
+        return None
+    pages.move_to_end(page)
+    embed, total_pages = pages[page]
+    return embed, page, total_pages
+
+async def render_leaderboard_page(guild, page):
+    """Returns (embed, page, total_pages) for a leaderboard page, or None when nobody is ranked."""
+    cached = cached_leaderboard_page(guild.id, page)
+    if cached:
+        return cached
+
+    generation = leaderboard_generations.get(guild.id, 0)
+    per_page = LEADERBOARD_PER_PAGE
 
-    total_rows = database.get_attendance_leaderboard_count(ctx.guild.id)
+    state = await adb.get_leaderboard_state(guild.id)
+    total_rows = state['members']
     if total_rows == 0:
-        await ctx.send("No attendance data yet.")
-        return
+        return None
 
-    calculated_pages = (total_rows + per_page - 1) // per_page
-    total_pages = max(1, min(max_pages, calculated_pages))
+    total_pages = max(1, (total_rows + per_page - 1) // per_page)
     if page < 1:
         page = 1
     if page > total_pages:
         page = total_pages
+    cached = cached_leaderboard_page(guild.id, page)
+    if cached:
+        return cached
+
+    # Seek from the previous page's last row when we still know it; otherwise fall back to OFFSET
+    version, cursors = leaderboard_cursors.get(guild.id, (None, {}))
+    if version != state['version']:
+        cursors = {}
+        leaderboard_cursors[guild.id] = (state['version'], cursors)
 
     offset = (page - 1) * per_page
-    rows = database.get_attendance_leaderboard(ctx.guild.id, per_page, offset)
+    after = cursors.get(page - 1)
+    rows = await adb.get_attendance_leaderboard(guild.id, per_page, offset, after=after)
     if not rows:
-        await ctx.send("No attendance data yet.")
-        return
+        return None
+    cursors[page] = (rows[-1]["present_count"], rows[-1]["user_id"])
 
     start_rank = offset + 1
     end_rank = offset + len(rows)
@@ -1655,23 +1703,23 @@ async def attendance_leaderboard(ctx, page: int = 1):
     embed = discord.Embed(
         title="🏆 Attendance Leaderboard",
         description=(
-            f"**{ctx.guild.name}**\n"
+            f"**{guild.name}**\n"
             f"Showing ranks **{start_rank}–{end_rank}**"
         ),
         color=discord.Color.gold()
     )
     embed.timestamp = discord.utils.utcnow()
 
-    if ctx.guild.icon:
-        embed.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon.url)
+    if guild.icon:
+        embed.set_author(name=guild.name, icon_url=guild.icon.url)
     else:
-        embed.set_author(name=ctx.guild.name)
+        embed.set_author(name=guild.name)
 
     # Show a recognizable logo in the leaderboard embed.
     if bot.user and bot.user.display_avatar:
         embed.set_thumbnail(url=bot.user.display_avatar.url)
-    elif ctx.guild.icon:
-        embed.set_thumbnail(url=ctx.guild.icon.url)
+    elif guild.icon:
+        embed.set_thumbnail(url=guild.icon.url)
 
     rank_emojis = {
         1: "🥇",
@@ -1682,7 +1730,7 @@ async def attendance_leaderboard(ctx, page: int = 1):
     lines = []
     rank = start_rank
     for row in rows:
-        member = ctx.guild.get_member(row["user_id"])
+        member = guild.get_member(row["user_id"])
         mention_text = member.mention if member else f"<@{row['user_id']}>"
         tag_text = member.name if member else f"User ID: {row['user_id']}"
         present = row["present_count"] or 0
@@ -1699,7 +1747,7 @@ async def attendance_leaderboard(ctx, page: int = 1):
     embed.add_field(name="Top Members", value="\n\n".join(lines), inline=False)
     embed.add_field(
         name="How to Navigate",
-        value=f"Use `!leaderboard <page>` • Page **{page}/{total_pages}**",
+        value=f"Use the buttons below or `!leaderboard <page>` • Page **{page}/{total_pages}**",
         inline=False
     )
     embed.set_footer(
@@ -1707,8 +1755,597 @@ async def attendance_leaderboard(ctx, page: int = 1):
         icon_url=bot.user.display_avatar.url if bot.user and bot.user.display_avatar else None
     )
 
+    # Only cache if no stats change landed while this page was being rendered
+    if leaderboard_generations.get(guild.id, 0) == generation:
+        pages = leaderboard_pages.setdefault(guild.id, OrderedDict())
+        pages[page] = (embed, total_pages)
+        while len(pages) > LEADERBOARD_CACHE_PAGES:
+            pages.popitem(last=False)
+
+    return embed, page, total_pages
+
+class LeaderboardJumpModal(discord.ui.Modal, title="Jump to Page"):
+    page = discord.ui.TextInput(label="Page number", placeholder="1", min_length=1, max_length=6)
+
+    def __init__(self, view_instance):
+        super().__init__()
+        self.view_instance = view_instance
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            page = int(self.page.value)
+        except ValueError:
+            await interaction.response.send_message("Please enter a page number.", ephemeral=True)
+            return
+        await self.view_instance.show_page(interaction, page)
+
+class LeaderboardView(discord.ui.View):
+    """Prev / Next / Jump buttons that edit the leaderboard message in place."""
+
+    def __init__(self, page=1, total_pages=1):
+        super().__init__(timeout=None) # Persistent view
+        self.btn_prev.disabled = page <= 1
+        self.btn_next.disabled = page >= total_pages
+
+    @staticmethod
+    def current_page(message):
+        # The page lives in the embed so the buttons keep working after a restart
+        for embed in message.embeds if message else []:
+            for field in embed.fields:
+                match = re.search(r"Page \*\*(\d+)/", field.value or "")
+                if match:
+                    return int(match.group(1))
+        return 1
+
+    async def show_page(self, interaction, page):
+        result = await render_leaderboard_page(interaction.guild, page)
+        if result is None:
+            await interaction.response.edit_message(content="No attendance data yet.", embed=None, view=None)
+            return
+        embed, page, total_pages = result
+        await interaction.response.edit_message(embed=embed, view=LeaderboardView(page, total_pages))
+
+    @discord.ui.button(label="Prev", style=discord.ButtonStyle.secondary, custom_id="leaderboard_btn_prev", emoji="◀️")
+    async def btn_prev(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.current_page(interaction.message) - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, custom_id="leaderboard_btn_next", emoji="▶️")
+    async def btn_next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.current_page(interaction.message) + 1)
+
+    @discord.ui.button(label="Jump", style=discord.ButtonStyle.primary, custom_id="leaderboard_btn_jump", emoji="🔢")
+    async def btn_jump(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(LeaderboardJumpModal(self))
+
+@bot.command(name='attendance_leaderboard', aliases=['presentleaderboard', 'leaderboard'])
+async def attendance_leaderboard(ctx, page: int = 1):
+    result = await render_leaderboard_page(ctx.guild, page)
+    if result is None:
+        await ctx.send("No attendance data yet.")
+        return
+
+    embed, page, total_pages = result
+    await ctx.send(embed=embed, view=LeaderboardView(page, total_pages))
+
+@bot.command(name='rank', aliases=['myrank'])
+async def attendance_rank(ctx, member: discord.Member = None):
+    """
+    Shows a member's leaderboard rank, percentile and neighbours.
+    Usage: !rank [@User]
+    """
+    member = member or ctx.author
+    result = await adb.run(ranking.get_rank, ctx.guild.id, member.id)
+    if result is None:
+        await ctx.send(f"{member.display_name} has no attendance stats yet.")
+        return
+
+    def describe(rank, user_id, present):
+        other = ctx.guild.get_member(user_id)
+        name = other.display_name if other else f"User ID: {user_id}"
+        return f"`#{rank}` {name} • ✅ **{present}**"
+
+    embed = discord.Embed(
+        title="📊 Attendance Rank",
+        description=(
+            f"{member.mention} is ranked **#{result['rank']}** of **{result['total']}** "
+            f"with **{result['present_count']}** present.\n"
+            f"Ahead of **{result['percentile']}%** of ranked members."
+        ),
+        color=discord.Color.gold()
+    )
+    if member.display_avatar:
+        embed.set_thumbnail(url=member.display_avatar.url)
+
+    nearby = [describe(*entry) for entry in result['above']]
+    nearby.append(f"**{describe(result['rank'], member.id, result['present_count'])}** ⬅️")
+    nearby.extend(describe(*entry) for entry in result['below'])
+    embed.add_field(name="Nearby", value="\n".join(nearby), inline=False)
+    embed.set_footer(text="Registrar Bot • Use !leaderboard for the full list")
+
     await ctx.send(embed=embed)
 
+def parse_rollup_period(text, now_dt=None):
+    """
+    Resolves a !stats / !periodleaderboard period into a rollup key and label.
+    Accepts: week, month, lastweek, lastmonth, YYYY-MM, YYYY-Www
+    """
+    now_dt = now_dt or get_current_ph_time()
+    text = (text or 'month').strip().lower()
+
+    if text in ('week', 'lastweek'):
+        day = now_dt.date() - datetime.timedelta(days=7 if text == 'lastweek' else 0)
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}", ("last week" if text == 'lastweek' else "this week")
+    if text in ('month', 'lastmonth'):
+        day = now_dt.date().replace(day=1)
+        if text == 'lastmonth':
+            day = (day - datetime.timedelta(days=1)).replace(day=1)
+        return day.strftime("%Y-%m"), day.strftime("%B %Y")
+    if re.fullmatch(r"\d{4}-\d{2}", text):
+        return text, datetime.datetime.strptime(text, "%Y-%m").strftime("%B %Y")
+    match = re.fullmatch(r"(\d{4})-w(\d{1,2})", text)
+    if match and 1 <= int(match.group(2)) <= 53:
+        period = f"{match.group(1)}-W{int(match.group(2)):02d}"
+        return period, f"week {period}"
+    raise ValueError(text)
+
+@bot.command(name='stats', aliases=['mystats'])
+async def attendance_stats(ctx, member: Optional[discord.Member] = None, period: str = None):
+    """
+    Shows a member's counts, attendance rate and streaks for a week or month.
+    Usage: !stats [@User] [week | month | lastweek | lastmonth | 2026-09 | 2026-W37]
+    """
+    member = member or ctx.author
+    try:
+        period, label = parse_rollup_period(period)
+    except ValueError:
+        await ctx.send("Invalid period. Try `week`, `month`, `lastmonth`, `2026-09` or `2026-W37`.")
+        return
+
+    stats = await adb.get_member_stats(ctx.guild.id, member.id, period)
+    rate = f"{stats['rate']}%" if stats['rate'] is not None else "—"
+
+    embed = discord.Embed(
+        title=f"📈 Attendance Stats — {member.display_name}",
+        description=f"**{label}** • {stats['sessions']} closed session(s)",
+        color=discord.Color.green()
+    )
+    if member.display_avatar:
+        embed.set_thumbnail(url=member.display_avatar.url)
+    embed.add_field(name="✅ Present", value=str(stats['present']), inline=True)
+    embed.add_field(name="❌ Absent", value=str(stats['absent']), inline=True)
+    embed.add_field(name="⚠️ Excused", value=str(stats['excused']), inline=True)
+    embed.add_field(name="Attendance Rate", value=rate, inline=True)
+    embed.add_field(name="🔥 Current Streak", value=str(stats['current_streak']), inline=True)
+    embed.add_field(name="🏆 Best Streak", value=str(stats['best_streak']), inline=True)
+    embed.set_footer(text="Registrar Bot • Updated when each attendance window closes")
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='periodleaderboard', aliases=['monthleaderboard', 'weekleaderboard'])
+async def period_leaderboard(ctx, period: str = None, page: int = 1):
+    """
+    Shows the leaderboard for one week or month.
+    Usage: !periodleaderboard [week | month | lastweek | lastmonth | 2026-09 | 2026-W37] [page]
+    """
+    if period is None and ctx.invoked_with == 'weekleaderboard':
+        period = 'week'
+    try:
+        period, label = parse_rollup_period(period)
+    except ValueError:
+        await ctx.send("Invalid period. Try `week`, `month`, `lastmonth`, `2026-09` or `2026-W37`.")
+        return
+
+    per_page = LEADERBOARD_PER_PAGE
+    page = max(1, page)
+    total_rows, rows = await adb.get_period_leaderboard(ctx.guild.id, period, limit=per_page, offset=(page - 1) * per_page)
+    if not total_rows:
+        await ctx.send(f"No closed attendance sessions for {label} yet.")
+        return
+    total_pages = (total_rows + per_page - 1) // per_page
+    if page > total_pages:
+        page = total_pages
+        _, rows = await adb.get_period_leaderboard(ctx.guild.id, period, limit=per_page, offset=(page - 1) * per_page)
+
+    lines = []
+    for rank, row in enumerate(rows, start=(page - 1) * per_page + 1):
+        member = ctx.guild.get_member(row['user_id'])
+        name = member.display_name if member else f"User ID: {row['user_id']}"
+        lines.append(
+            f"`#{rank}` **{name}**\n"
+            f"↳ ✅ **{row['present_count']}** | ❌ **{row['absent_count']}** | ⚠️ **{row['excused_count']}**"
+        )
+
+    embed = discord.Embed(
+        title=f"🏆 Attendance Leaderboard — {label}",
+        description="\n\n".join(lines),
+        color=discord.Color.gold()
+    )
+    embed.set_footer(text=f"Registrar Bot • Page {page}/{total_pages} • Members Ranked: {total_rows}")
+    await ctx.send(embed=embed)
+
+def parse_history_range(text, now_dt=None):
+    """
+    Parses a !history range into (since, until, label) Philippines-time datetimes.
+    Accepts: 7d, 2w, today, week, month, all, YYYY-MM, YYYY-MM-DD, YYYY-MM-DD..YYYY-MM-DD
+    """
+    now_dt = now_dt or get_current_ph_time()
+    today = now_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    text = (text or '30d').strip().lower()
+
+    def day(value):
+        return datetime.datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=now_dt.tzinfo)
+
+    if text == 'all':
+        return None, None, "all time"
+    if text == 'today':
+        return today, None, "today"
+    if text == 'week':
+        start = today - datetime.timedelta(days=today.weekday())
+        return start, None, "this week"
+    if text == 'month':
+        return today.replace(day=1), None, "this month"
+    match = re.fullmatch(r"(\d+)([dw])", text)
+    if match:
+        days = int(match.group(1)) * (7 if match.group(2) == 'w' else 1)
+        return now_dt - datetime.timedelta(days=days), None, f"last {match.group(1)}{match.group(2)}"
+    if re.fullmatch(r"\d{4}-\d{2}", text):
+        start = day(f"{text}-01")
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start, end, start.strftime("%B %Y")
+    if '..' in text:
+        first, last = text.split('..', 1)
+        return day(first), day(last) + datetime.timedelta(days=1), f"{first} to {last}"
+    start = day(text)
+    return start, start + datetime.timedelta(days=1), text
+
+@bot.command(name='history')
+async def attendance_history(ctx, member: Optional[discord.Member] = None, *, date_range: str = None):
+    """
+    Shows a member's attendance history from the ledger.
+    Usage: !history [@User] [7d | 2w | month | 2026-09 | 2026-09-01..2026-09-15 | all]
+    """
+    member = member or ctx.author
+    try:
+        since, until, label = parse_history_range(date_range)
+    except ValueError:
+        await ctx.send("Invalid range. Try `7d`, `2w`, `month`, `2026-09`, `2026-09-01..2026-09-15` or `all`.")
+        return
+
+    events = await adb.get_attendance_history(ctx.guild.id, member.id, since=since, until=until, limit=25)
+    if not events:
+        await ctx.send(f"No attendance history for {member.display_name} ({label}).")
+        return
+
+    status_emojis = {"present": "✅", "absent": "❌", "excused": "⚠️", "removed": "↩️"}
+    lines = []
+    for event in events:
+        line = f"{status_emojis.get(event['status'], '•')} <t:{event['ts']}:f> • **{event['status'].title()}**"
+        if event.get('reason'):
+            line += f" — {event['reason'][:80]}"
+        lines.append(line)
+
+    embed = discord.Embed(
+        title=f"🗓️ Attendance History — {member.display_name}",
+        description="\n".join(lines),
+        color=discord.Color.blurple()
+    )
+    embed.set_footer(text=f"Registrar Bot • {label} • newest first, up to 25 entries")
+    await ctx.send(embed=embed)
+
+CALENDAR_EMOJIS = {"present": "✅", "absent": "❌", "excused": "⚠️", None: "▫️"}
+
+@bot.command(name='calendar')
+async def show_attendance_calendar(ctx, member: Optional[discord.Member] = None, month: str = None):
+    """
+    Shows a member's attendance for one month as a calendar grid.
+    Usage: !calendar [@User] [YYYY-MM]
+    """
+    member = member or ctx.author
+    try:
+        first = (datetime.datetime.strptime(month, "%Y-%m").date() if month
+                 else get_current_ph_time().date().replace(day=1))
+    except ValueError:
+        await ctx.send("Invalid month. Use `YYYY-MM`, for example `2026-09`.")
+        return
+
+    days = await adb.get_calendar(ctx.guild.id, member.id, first.year)
+    if days is None:
+        await ctx.send(f"No closed attendance sessions for {member.display_name} in {first.year}.")
+        return
+
+    next_month = (first + datetime.timedelta(days=32)).replace(day=1)
+    _, start = attendance_calendar.day_index(first)
+    end = start + (next_month - first).days
+    summary = attendance_calendar.summarize(days, start, end)
+    current, best = attendance_calendar.streaks(days, end)
+
+    # One row per week, Monday first; ⬛ pads the days outside this month.
+    cells = ["⬛"] * first.weekday()
+    cells.extend(CALENDAR_EMOJIS[attendance_calendar.get_day(days, index)] for index in range(start, end))
+    cells.extend(["⬛"] * (-len(cells) % 7))
+    grid = "\n".join("".join(cells[i:i + 7]) for i in range(0, len(cells), 7))
+
+    embed = discord.Embed(
+        title=f"🗓️ {first.strftime('%B %Y')} — {member.display_name}",
+        description=grid,
+        color=discord.Color.blurple()
+    )
+    rate = f"{summary['rate']}%" if summary['rate'] is not None else "—"
+    embed.add_field(
+        name="Month",
+        value=(f"✅ **{summary['present']}** | ❌ **{summary['absent']}** | ⚠️ **{summary['excused']}**\n"
+               f"Attendance Rate: **{rate}**"),
+        inline=True
+    )
+    embed.add_field(name="Streak", value=f"🔥 Current: **{current}**\n🏆 Best: **{best}** ({first.year})", inline=True)
+    embed.set_footer(text="Registrar Bot • Weeks start on Monday • ▫️ no session")
+    await ctx.send(embed=embed)
+
+@bot.command(name='missed', aliases=['absences'])
+@commands.has_permissions(manage_roles=True)
+async def most_missed(ctx, *, date_range: str = None):
+    """
+    Lists the members who missed the most sessions in a range.
+    Usage: !missed [7d | 2w | month | 2026-09 | 2026-09-01..2026-09-15]
+    """
+    try:
+        since, until, label = parse_history_range(date_range or 'month')
+    except ValueError:
+        await ctx.send("Invalid range. Try `7d`, `2w`, `month`, `2026-09` or `2026-09-01..2026-09-15`.")
+        return
+
+    today = get_current_ph_time().date()
+    start = since.date() if since else today.replace(month=1, day=1)
+    if since is None:
+        label = f"{today.year} so far"
+    end = until.date() if until else today + datetime.timedelta(days=1)
+
+    # One read per calendar year in range; counting is a few bit operations per member.
+    missed = {}
+    for year in range(start.year, end.year + 1):
+        first = start if start.year == year else datetime.date(year, 1, 1)
+        last = end if end.year == year else datetime.date(year + 1, 1, 1)
+        if first >= last:
+            continue
+        calendars = await adb.get_guild_calendars(ctx.guild.id, year)
+        start_index = attendance_calendar.day_index(first)[1]
+        end_index = start_index + (last - first).days
+        for user_id, count in attendance_calendar.guild_missed(calendars, start_index, end_index).items():
+            missed[user_id] = missed.get(user_id, 0) + count
+
+    if not missed:
+        await ctx.send(f"Nobody missed a session ({label}).")
+        return
+
+    top = sorted(missed.items(), key=lambda item: (-item[1], item[0]))[:15]
+    lines = []
+    for rank, (user_id, count) in enumerate(top, start=1):
+        member = ctx.guild.get_member(user_id)
+        name = member.display_name if member else f"User ID: {user_id}"
+        lines.append(f"`#{rank}` **{name}** • ❌ {count} day(s)")
+
+    embed = discord.Embed(
+        title=f"❌ Most Missed Sessions — {label}",
+        description="\n".join(lines),
+        color=discord.Color.red()
+    )
+    embed.set_footer(text=f"Registrar Bot • {len(missed)} member(s) missed at least one session")
+    await ctx.send(embed=embed)
+
+# Analytics reports per guild: guild_id -> (close-out date, report). Reports follow the last
+# closed session, so marks in an open window show up after the next close-out.
+analytics_reports = {}
+
+def invalidate_analytics(guild_id, rows=None, version=None):
+    """Stats listener: drops cached analytics when a guild's stats are reset, rebuilt or imported."""
+    if rows is not None:
+        return
+    if guild_id is None:
+        analytics_reports.clear()
+    else:
+        analytics_reports.pop(guild_id, None)
+
+storage.add_stats_listener(invalidate_analytics)
+
+def text_bar(value, total, width=10):
+    filled = round(width * value / total) if total else 0
+    return "█" * filled + "░" * (width - filled)
+
+@bot.command(name='analytics', aliases=['insights'])
+@commands.has_permissions(manage_roles=True)
+async def attendance_analytics(ctx):
+    """
+    Shows guild-wide attendance analytics: rate distribution, members below the
+    ANALYTICS_LOW_RATE threshold, absences by weekday and excused vs absent.
+    Usage: !analytics
+    """
+    if not analytics.available():
+        await ctx.send("Analytics needs NumPy. Install it with `pip install numpy` and restart the bot.")
+        return
+
+    config = await adb.get_guild_config(ctx.guild.id) or {}
+    close_date = config.get('last_processed_date')
+    cached = analytics_reports.get(ctx.guild.id)
+    if cached and close_date and cached[0] == close_date:
+        report = cached[1]
+    else:
+        report = await adb.run(analytics.compute, ctx.guild.id)
+        if close_date:
+            analytics_reports[ctx.guild.id] = (close_date, report)
+
+    if not report['rated']:
+        await ctx.send("No attendance data yet.")
+        return
+
+    embed = discord.Embed(
+        title="📊 Attendance Analytics",
+        description=(
+            f"**{report['rated']}** member(s) with attendance • "
+            f"Mean rate **{report['mean_rate']}%** • Median **{report['median_rate']}%**"
+        ),
+        color=discord.Color.teal()
+    )
+
+    top_bin = max(count for _, count in report['distribution'])
+    embed.add_field(
+        name="Rate Distribution",
+        value="\n".join(
+            f"`{label:>8}` {text_bar(count, top_bin)} {count}" for label, count in report['distribution']
+        ),
+        inline=False
+    )
+
+    below = report['below']
+    lines = []
+    for user_id, rate, present, sessions in below[:10]:
+        member = ctx.guild.get_member(user_id)
+        name = member.display_name if member else f"User ID: {user_id}"
+        lines.append(f"**{name}** • {rate}% ({present}/{sessions})")
+    if len(below) > 10:
+        lines.append(f"…and {len(below) - 10} more")
+    embed.add_field(
+        name=f"Below {report['low_rate']}% ({len(below)})",
+        value="\n".join(lines) or "Nobody 🎉",
+        inline=False
+    )
+
+    most_absences = max(report['weekday_absences'])
+    embed.add_field(
+        name="Absences by Weekday",
+        value="\n".join(
+            f"`{day}` {text_bar(count, most_absences)} {count} ({rate}%)"
+            for day, count, rate in zip(analytics.WEEKDAYS, report['weekday_absences'], report['weekday_absence_rates'])
+        ),
+        inline=False
+    )
+
+    share = f"{report['excused_share']}%" if report['excused_share'] is not None else "—"
+    embed.add_field(
+        name="Excused vs Absent",
+        value=f"⚠️ Excused **{report['excused']}** | ❌ Absent **{report['absent']}** • Excused share **{share}**",
+        inline=False
+    )
+    embed.set_footer(text=f"Registrar Bot • As of close-out {close_date}" if close_date else "Registrar Bot")
+    await ctx.send(embed=embed)
+
+EXCUSE_SEARCH_PER_PAGE = 5
+RANGE_TOKEN = re.compile(r"\d+[dw]|\d{4}-\d{2}(-\d{2})?(\.\.\d{4}-\d{2}-\d{2})?|today|week|month|all")
+
+def split_search_range(text):
+    """Splits '!excuses search' input into (terms, range); a trailing range token is optional."""
+    words = (text or '').split()
+    if len(words) > 1 and RANGE_TOKEN.fullmatch(words[-1].lower()):
+        return " ".join(words[:-1]), words[-1]
+    return " ".join(words), 'all'
+
+async def render_excuse_search(guild, terms, since, until, label, page):
+    """Returns (embed, page, total_pages) for one page of excuse search results, or None without matches."""
+    per_page = EXCUSE_SEARCH_PER_PAGE
+    page = max(1, page)
+    total, rows = await adb.search_excuses(guild.id, terms, since=since, until=until,
+                                           limit=per_page, offset=(page - 1) * per_page)
+    if not total:
+        return None
+    total_pages = (total + per_page - 1) // per_page
+    if page > total_pages:
+        page = total_pages
+        _, rows = await adb.search_excuses(guild.id, terms, since=since, until=until,
+                                           limit=per_page, offset=(page - 1) * per_page)
+
+    embed = discord.Embed(
+        title=f"🔎 Excuses matching \"{terms}\"",
+        description=f"**{total}** match(es) • {label}",
+        color=discord.Color.light_grey()
+    )
+    for rank, row in enumerate(rows, start=(page - 1) * per_page + 1):
+        member = guild.get_member(row['user_id'])
+        name = member.display_name if member else f"User ID: {row['user_id']}"
+        embed.add_field(
+            name=f"#{rank} • {name}",
+            value=f"<t:{row['ts']}:d> — {row['snippet'][:300]}",
+            inline=False
+        )
+    embed.set_footer(text=f"Registrar Bot • Best matches first • Page {page}/{total_pages}")
+    return embed, page, total_pages
+
+class ExcuseSearchView(discord.ui.View):
+    """Prev / Next buttons for one search; only the member who ran it can page."""
+
+    def __init__(self, author_id, terms, since, until, label, page, total_pages):
+        super().__init__(timeout=300)
+        self.author_id = author_id
+        self.query = (terms, since, until, label)
+        self.page = page
+        self.btn_prev.disabled = page <= 1
+        self.btn_next.disabled = page >= total_pages
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Run `!excuses search` to page through your own results.", ephemeral=True)
+            return False
+        return True
+
+    async def show_page(self, interaction, page):
+        result = await render_excuse_search(interaction.guild, *self.query, page)
+        if result is None:
+            await interaction.response.edit_message(content="No matching excuses.", embed=None, view=None)
+            return
+        embed, page, total_pages = result
+        await interaction.response.edit_message(
+            embed=embed, view=ExcuseSearchView(self.author_id, *self.query, page, total_pages)
+        )
+
+    @discord.ui.button(label="Prev", style=discord.ButtonStyle.secondary, emoji="◀️")
+    async def btn_prev(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, emoji="▶️")
+    async def btn_next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+@bot.command(name='excuses')
+@commands.has_permissions(manage_roles=True)
+async def excuses(ctx, action: str = None, *, text: str = None):
+    """
+    Searches every recorded excuse reason, best match first.
+    Usage: !excuses search <terms> [7d | 2w | month | 2026-09 | 2026-09-01..2026-09-15 | all]
+    Words must all match; end a word with * to match prefixes (e.g. med*).
+    """
+    terms, date_range = split_search_range(text)
+    if action != 'search' or not terms:
+        await ctx.send("Usage: `!excuses search <terms> [range]` — e.g. `!excuses search medical 2026-09`")
+        return
+    try:
+        since, until, label = parse_history_range(date_range)
+    except ValueError:
+        await ctx.send("Invalid range. Try `7d`, `2w`, `month`, `2026-09`, `2026-09-01..2026-09-15` or `all`.")
+        return
+
+    result = await render_excuse_search(ctx.guild, terms, since, until, label, 1)
+    if result is None:
+        await ctx.send(f"No excuses match \"{terms}\" ({label}).")
+        return
+    embed, page, total_pages = result
+    await ctx.send(embed=embed, view=ExcuseSearchView(ctx.author.id, terms, since, until, label, page, total_pages))
+
+@bot.command(name='rebuildstats')
+@commands.has_permissions(administrator=True)
+async def rebuild_stats(ctx, confirm: str = None):
+    """
+    Recomputes leaderboard stats from the attendance history ledger.
+    Usage: !rebuildstats confirm
+    """
+    if confirm != 'confirm':
+        await ctx.send(
+            "This recomputes every Present/Absent/Excused count from the attendance history since the last reset. "
+            "Counts recorded before the history existed will be lost.\nRun `!rebuildstats confirm` to proceed."
+        )
+        return
+
+    rows = await adb.rebuild_attendance_stats(ctx.guild.id)
+    await ctx.send(f"✅ Rebuilt attendance stats for **{rows}** member(s) from the history ledger.")
+
 @bot.command(name='stick')
 @commands.has_permissions(manage_messages=True)
 async def stick_message(ctx, *, message_text: str):
@@ -1763,8 +2400,8 @@ async def check_attendance_expiry():
     # Iterate over guilds first, then load data for each
     for guild in bot.guilds:
         try:
-            settings = load_settings(guild.id)
-            data = load_attendance_data(guild.id)
+            settings = await load_settings(guild.id)
+            data = await load_attendance_data(guild.id)
             
             mode = settings.get('attendance_mode', 'duration')
             expiry_hours = settings.get("attendance_expiry_hours", 12)
@@ -1805,7 +2442,7 @@ async def check_attendance_expiry():
                          
                          # Update state FIRST to prevent loops if refresh fails
                          settings['last_opened_date'] = today_str
-                         save_settings(guild.id, settings)
+                         await save_settings(guild.id, settings)
                          
                          try:
                              await refresh_attendance_report(guild)
@@ -1832,9 +2469,11 @@ async def check_attendance_expiry():
                 if target_date_to_process and last_processed != target_date_to_process:
                     logger.info(f"Triggering End-of-Day for {guild.name} (Date: {target_date_to_process})")
                     
-                    # 1. Auto-Absent Logic
+                    # 1. Close the session in one transaction: absent records and stats
+                    # for missing members, clear the records, mark the date processed
                     allowed_role_id = data.get('allowed_role_id')
                     absent_role_id = data.get('absent_role_id')
+                    missing_members = []
                     
                     if allowed_role_id:
                         allowed_role = guild.get_role(allowed_role_id)
@@ -1842,88 +2481,79 @@ async def check_attendance_expiry():
                             # Identify missing users
                             present_ids = set(records.keys())
                             missing_members = [m for m in allowed_role.members if str(m.id) not in present_ids and not m.bot]
-                            
-                            # Mark them absent
-                            if missing_members:
-                                absent_role = guild.get_role(absent_role_id) if absent_role_id else None
-                                
-                                for member in missing_members:
-                                    # Add to records
-                                    records[str(member.id)] = {
-                                        "status": "absent",
-                                        "timestamp": now.isoformat(),
-                                        "reason": "Auto-marked at end of attendance window"
-                                    }
-                                    database.increment_status_count(guild.id, member.id, "absent")
-                                    
-                                    # Give absent role
-                                    if absent_role:
-                                        try:
-                                            await member.add_roles(absent_role)
-                                            await asyncio.sleep(0.3)
-                                        except discord.Forbidden:
-                                            pass
-                                    
-                                    # DM the user
-                                    try:
-                                        dm_embed = discord.Embed(
-                                            title="Attendance Status: Absent",
-                                            description=f"You have been marked **ABSENT** in **{guild.name}** because you did not check in within the attendance window.",
-                                            color=discord.Color.red(),
-                                            timestamp=now
-                                        )
-                                        
-                                        date_str = now.strftime('%B %d, %Y')
-                                        time_str = now.strftime('%I:%M %p')
-                                        
-                                        dm_embed.add_field(name="Date", value=date_str, inline=True)
-                                        dm_embed.add_field(name="Time", value=time_str, inline=True)
-
-                                        if guild.icon:
-                                            dm_embed.set_author(name=guild.name, icon_url=guild.icon.url)
-                                            dm_embed.set_thumbnail(url=guild.icon.url)
-                                        else:
-                                             dm_embed.set_author(name=guild.name)
-                                        
-                                        dm_embed.set_footer(text="Registrar Bot • Attendance System")
-
-                                        await member.send(embed=dm_embed)
-                                        await asyncio.sleep(0.5)
-                                    except discord.Forbidden:
-                                        pass # User has DMs blocked
-                                            
-                                logger.info(f"Marked {len(missing_members)} users as absent in {guild.name}")
                     else:
                         logger.warning(f"Cannot auto-mark absences for {guild.name}: No 'allowed_role' configured.")
                     
-                    # 2. Generate and Post Report
-                    # Save data first so embed is accurate
-                    data['records'] = records
-                    save_attendance_data(guild.id, data)
+                    session_records = await adb.close_session(
+                        guild.id,
+                        target_date_to_process,
+                        [m.id for m in missing_members],
+                        timestamp=now.isoformat(),
+                        reason="Auto-marked at end of attendance window"
+                    )
+                    settings['last_processed_date'] = target_date_to_process
+                    if session_records is None:
+                        logger.info(f"Session {target_date_to_process} for {guild.name} was already closed")
+                        continue
+                    if missing_members:
+                        logger.info(f"Marked {len(missing_members)} users as absent in {guild.name}")
+                    
+                    # 2. Generate and Post Report for the closed session
+                    await refresh_attendance_report(guild, records=session_records)
                     
-                    await refresh_attendance_report(guild)
+                    # 3. Roles and DMs for absent members
+                    if missing_members:
+                        absent_role = guild.get_role(absent_role_id) if absent_role_id else None
+                        
+                        for member in missing_members:
+                            # Give absent role
+                            if absent_role:
+                                try:
+                                    await member.add_roles(absent_role)
+                                    await asyncio.sleep(0.3)
+                                except discord.Forbidden:
+                                    pass
+                            
+                            # DM the user
+                            try:
+                                dm_embed = discord.Embed(
+                                    title="Attendance Status: Absent",
+                                    description=f"You have been marked **ABSENT** in **{guild.name}** because you did not check in within the attendance window.",
+                                    color=discord.Color.red(),
+                                    timestamp=now
+                                )
+                                
+                                date_str = now.strftime('%B %d, %Y')
+                                time_str = now.strftime('%I:%M %p')
+                                
+                                dm_embed.add_field(name="Date", value=date_str, inline=True)
+                                dm_embed.add_field(name="Time", value=time_str, inline=True)
+
+                                if guild.icon:
+                                    dm_embed.set_author(name=guild.name, icon_url=guild.icon.url)
+                                    dm_embed.set_thumbnail(url=guild.icon.url)
+                                else:
+                                     dm_embed.set_author(name=guild.name)
+                                
+                                dm_embed.set_footer(text="Registrar Bot • Attendance System")
+
+                                await member.send(embed=dm_embed)
+                                await asyncio.sleep(0.5)
+                            except discord.Forbidden:
+                                pass # User has DMs blocked
 
-                    # 3. Reset/Clear Data ("Old attendance will be out")
-                    # Remove 'present' roles
+                    # 4. Reset ("Old attendance will be out"): remove 'present' roles
                     present_role_id = data.get('attendance_role_id')
                     if present_role_id:
                         role = guild.get_role(present_role_id)
                         if role:
-                            for uid in list(records.keys()):
+                            for uid in list(session_records.keys()):
                                 member = guild.get_member(int(uid))
                                 if member and role in member.roles:
                                     try:
                                         await member.remove_roles(role)
                                         await asyncio.sleep(0.3)
                                     except: pass
-
-                    # Clear Records
-                    data['records'] = {}
-                    
-                    # Update Settings
-                    settings['last_processed_date'] = target_date_to_process
-                    save_settings(guild.id, settings)
-                    save_attendance_data(guild.id, data)
                     
                     logger.info(f"Attendance reset complete for {guild.name}")
                     
@@ -2013,13 +2643,16 @@ async def check_attendance_expiry():
                                     await member.add_roles(absent_role)
                                 except: pass
                         
-                        # Schedule update to 'absent'
+                        # Update to 'absent' (record, stats and history); keep the local copy in sync
                         users_to_update[user_id_str] = {
                             "status": "absent",
                             "timestamp": now.isoformat(), 
                             "channel_id": channel_id
                         }
-                        database.increment_status_count(guild.id, user_id, "absent")
+                        await adb.record_attendance(
+                            guild.id, user_id, "absent", now.isoformat(),
+                            channel_id=channel_id, source="expiry"
+                        )
 
                         # Notify
                         if channel:
@@ -2050,29 +2683,78 @@ async def check_attendance_expiry():
                 if uid in data['records'] and uid not in users_to_update:
                     del data['records'][uid]
                     
-        if users_to_update or users_to_remove:
-            save_attendance_data(guild.id, data)
+        # Updates were already written by record_attendance; only removals need a save
+        if users_to_remove:
+            await save_attendance_data(guild.id, data)
 
 @check_attendance_expiry.before_loop
 async def before_check_attendance_expiry():
     await bot.wait_until_ready()
 
+MAINTENANCE_INTERVAL_MINUTES = max(1, int(os.getenv('DB_MAINTENANCE_INTERVAL_MINUTES', '60') or 60))
+
+@tasks.loop(minutes=MAINTENANCE_INTERVAL_MINUTES)
+async def run_database_maintenance():
+    # Only guilds whose attendance window is closed right now are maintained
+    off_window = []
+    for guild in bot.guilds:
+        try:
+            in_window, _ = await is_in_attendance_window(guild.id)
+        except Exception as e:
+            logger.error(f"Could not check attendance window for guild {guild.id}: {e}")
+            continue
+        if not in_window:
+            off_window.append(guild.id)
+
+    if not off_window:
+        return
+
+    try:
+        report = await adb.run_maintenance(off_window)
+    except Exception as e:
+        logger.error(f"Database maintenance failed: {e}")
+        return
+
+    for step in report['steps']:
+        target = step.get('guild_id') or step.get('file')
+        details = ', '.join(f"{k}={v}" for k, v in step.items() if k not in ('step', 'guild_id', 'file'))
+        logger.info(f"Maintenance {step['step']} [{target}]: {details}")
+    logger.info(f"Maintenance finished for {len(off_window)} guild(s) in {report['duration_seconds']}s")
+
+@run_database_maintenance.before_loop
+async def before_run_database_maintenance():
+    await bot.wait_until_ready()
+
 @bot.event
-async def on_ready():
-    logger.info(f'Logged in as {bot.user.name}')
-    logger.info('Bot is ready to auto-nickname users!')
-    
-    # Initialize Database
+async def setup_hook():
+    # Runs once per process (not on every gateway reconnect like on_ready)
     try:
-        database.init_db()
+        await adb.init_db()
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
+    # Each step logs its own failure so a ranking error never leaves replication off.
+    try:
+        replication.start()
+    except Exception as e:
+        logger.error(f"Failed to start database replication; changes are NOT being shipped: {e}")
+    try:
+        await adb.run(ranking.rebuild)
+    except Exception as e:
+        logger.error(f"Failed to rebuild the rank index: {e}")
+
+@bot.event
+async def on_ready():
+    logger.info(f'Logged in as {bot.user.name}')
+    logger.info('Bot is ready to auto-nickname users!')
         
     if not check_attendance_expiry.is_running():
         check_attendance_expiry.start()
+    if not run_database_maintenance.is_running():
+        run_database_maintenance.start()
     
     # Register persistent views
     bot.add_view(AttendanceView(bot))
+    bot.add_view(LeaderboardView())
 
 # --- Persistent Views for Attendance ---
 
@@ -2108,7 +2790,7 @@ class AttendanceView(discord.ui.View):
         # The modal should open first, then we check? Or check first?
         # Checking first is better UX.
         
-        settings = load_settings(interaction.guild.id)
+        settings = await load_settings(interaction.guild.id)
         if settings.get('require_admin_excuse', True) and not interaction.user.guild_permissions.manage_roles:
             await interaction.response.send_message("Only admins can mark users as excused.", ephemeral=True)
             return
@@ -2121,7 +2803,7 @@ class AttendanceView(discord.ui.View):
         
         # Check Window (present and excused are both blocked when closed)
         if status in ('present', 'excused'):
-            allowed, msg = is_in_attendance_window(interaction.guild.id)
+            allowed, msg = await is_in_attendance_window(interaction.guild.id)
             if not allowed:
                  if status == 'excused':
                      msg = f"{msg} Excuse submissions are also closed once attendance time is over."
@@ -2129,15 +2811,15 @@ class AttendanceView(discord.ui.View):
                  return
 
         # Check self-marking setting (only for present)
-        settings = load_settings(interaction.guild.id)
+        settings = await load_settings(interaction.guild.id)
         if status == 'present' and not settings.get('allow_self_marking', True):
              await interaction.response.send_message("Self-marking is currently disabled.", ephemeral=True)
              return
 
         # Check permitted role
-        data = load_attendance_data(interaction.guild.id)
+        data = await load_attendance_data(interaction.guild.id, include_records=False)
 
-        existing_status = has_conflicting_attendance_status(data.get('records'), user.id, status)
+        existing_status = await has_conflicting_attendance_status(interaction.guild.id, user.id, status)
         if existing_status:
             await interaction.response.send_message(
                 f"You are already marked as **{existing_status}** and cannot switch to **{status}** this session. Reset attendance before changing it.",
@@ -2170,7 +2852,7 @@ class AttendanceView(discord.ui.View):
 
     async def process_status_update(self, interaction, member, status, reason=None):
         # Logic duplicated/adapted from update_user_status to avoid ctx dependency
-        data = load_attendance_data(interaction.guild.id)
+        data = await load_attendance_data(interaction.guild.id, include_records=False)
         present_role_id = data.get('attendance_role_id')
         absent_role_id = data.get('absent_role_id')
         excused_role_id = data.get('excused_role_id')
@@ -2205,22 +2887,11 @@ class AttendanceView(discord.ui.View):
                     await member.add_roles(role)
                 except: pass
         
-        # Save record
-        user_id = str(member.id)
-        if 'records' not in data:
-            data['records'] = {}
-        
-        record = {
-            "status": status,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        if reason:
-            record["reason"] = reason
-            
-        data['records'][user_id] = record
-        save_attendance_data(interaction.guild.id, data)
-        if status in ('present', 'absent', 'excused'):
-            database.increment_status_count(interaction.guild.id, member.id, status)
+        # Save record, stats and history in one write
+        await adb.record_attendance(
+            interaction.guild.id, member.id, status, datetime.datetime.now().isoformat(),
+            reason=reason or None, source="button"
+        )
 
         # Update Report
         await refresh_attendance_report(interaction.guild, interaction.channel, force_update=True)
@@ -2259,12 +2930,12 @@ async def assign_report_channel(ctx, channel: Union[discord.TextChannel, str] =
         return
 
     try:
-        data = load_attendance_data(ctx.guild.id)
+        data = await load_attendance_data(ctx.guild.id)
         
         if isinstance(channel, str):
             if channel.lower() in ['remove', 'none', 'off', 'disable']:
                 data['report_channel_id'] = None
-                save_attendance_data(ctx.guild.id, data)
+                await save_attendance_data(ctx.guild.id, data)
                 await ctx.send("✅ Attendance reports have been **disabled**. No new reports will be sent.")
                 return
             else:
@@ -2273,7 +2944,7 @@ async def assign_report_channel(ctx, channel: Union[discord.TextChannel, str] =
                 
         # If it's a TextChannel
         data['report_channel_id'] = channel.id
-        save_attendance_data(ctx.guild.id, data)
+        await save_attendance_data(ctx.guild.id, data)
         
         logger.info(f"Report channel set to {channel.name} ({channel.id}) for guild {ctx.guild.id}")
         await ctx.send(f"✅ Attendance reports will now be sent to {channel.mention}.")
@@ -2292,7 +2963,7 @@ async def remove_last_report(ctx):
     Deletes the currently active attendance report message.
     Usage: !removereport
     """
-    data = load_attendance_data(ctx.guild.id)
+    data = await load_attendance_data(ctx.guild.id)
     last_msg_id = data.get('last_report_message_id')
     last_chan_id = data.get('last_report_channel_id')
     
@@ -2317,7 +2988,7 @@ async def remove_last_report(ctx):
         # Clear the record so it doesn't try to edit it later
         data['last_report_message_id'] = None
         data['last_report_channel_id'] = None
-        save_attendance_data(ctx.guild.id, data)
+        await save_attendance_data(ctx.guild.id, data)
         
     except Exception as e:
         logger.error(f"Error removing report: {e}")
@@ -2374,7 +3045,7 @@ async def on_message(message):
     if message.guild and ctx.command is None:
         command_name = extract_prefixed_command_name(message.content)
         if command_name:
-            custom_response = database.get_custom_command(message.guild.id, command_name)
+            custom_response = await adb.get_custom_command(message.guild.id, command_name)
             if custom_response:
                 await message.channel.send(custom_response)
                 return
@@ -2385,11 +3056,11 @@ async def on_message(message):
         if not message.guild:
             return
 
-        settings = load_settings(message.guild.id)
+        settings = await load_settings(message.guild.id)
         status = msg_content
 
         # Check Window
-        allowed, window_msg = is_in_attendance_window(message.guild.id)
+        allowed, window_msg = await is_in_attendance_window(message.guild.id)
         if not allowed:
             await message.channel.send(window_msg, delete_after=5)
             return
@@ -2400,7 +3071,7 @@ async def on_message(message):
             await message.channel.send("Self-marking is currently disabled.", delete_after=5)
             return
 
-        data = load_attendance_data(message.guild.id)
+        data = await load_attendance_data(message.guild.id, include_records=False)
 
         # Restrict to configured present channel if set
         present_channel_id = data.get('present_channel_id')
@@ -2425,7 +3096,7 @@ async def on_message(message):
         status_role_name = 'attendance' if status == 'present' else 'absence'
         success_emoji = '✅' if status == 'present' else '❌'
 
-        existing_status = has_conflicting_attendance_status(data.get('records'), message.author.id, status)
+        existing_status = await has_conflicting_attendance_status(message.guild.id, message.author.id, status)
         if existing_status:
             await message.channel.send(
                 f"{message.author.mention}, you are already marked as **{existing_status}** and cannot switch to **{status}** this session.",
@@ -2436,7 +3107,6 @@ async def on_message(message):
         if status_role_id:
             role = message.guild.get_role(status_role_id)
             if role:
-                user_id = str(message.author.id)
                 now = datetime.datetime.now()
 
                 # Check if already marked today (prevent spamming status updates)
@@ -2463,15 +3133,10 @@ async def on_message(message):
                         await message.author.add_roles(role)
                         await message.add_reaction(success_emoji)
 
-                        if 'records' not in data:
-                            data['records'] = {}
-                        data['records'][user_id] = {
-                            "status": status,
-                            "timestamp": now.isoformat(),
-                            "channel_id": message.channel.id
-                        }
-                        save_attendance_data(message.guild.id, data)
-                        database.increment_status_count(message.guild.id, message.author.id, status)
+                        await adb.record_attendance(
+                            message.guild.id, message.author.id, status, now.isoformat(),
+                            channel_id=message.channel.id, source="message"
+                        )
 
                         await message.channel.send(
                             f"{status.title()} marked for {message.author.mention}! You have been given the {role.name} role.",
@@ -2520,24 +3185,24 @@ async def on_message(message):
         if not message.guild:
             return
 
-        allowed, window_msg = is_in_attendance_window(message.guild.id)
+        allowed, window_msg = await is_in_attendance_window(message.guild.id)
         if not allowed:
             await message.channel.send(f"{window_msg} Excuse submissions are also closed once attendance time is over.", delete_after=5)
             return
             
-        settings = load_settings(message.guild.id)
+        settings = await load_settings(message.guild.id)
         if settings.get('require_admin_excuse', True):
             # Check if user has manage_roles
             if not message.author.guild_permissions.manage_roles:
                 await message.channel.send("Only admins can excuse users.", delete_after=5)
                 return
 
-        data = load_attendance_data(message.guild.id)
+        data = await load_attendance_data(message.guild.id, include_records=False)
         attendance_role_id = data.get('attendance_role_id')
         absent_role_id = data.get('absent_role_id')
         excused_role_id = data.get('excused_role_id')
 
-        existing_status = has_conflicting_attendance_status(data.get('records'), message.author.id, 'excused')
+        existing_status = await has_conflicting_attendance_status(message.guild.id, message.author.id, 'excused')
         if existing_status:
             await message.channel.send(
                 f"{message.author.mention}, you are already marked as **{existing_status}** and cannot switch to **excused** this session.",
@@ -2554,7 +3219,6 @@ async def on_message(message):
         if excused_role_id:
             role = message.guild.get_role(excused_role_id)
             if role:
-                user_id = str(message.author.id)
                 now = datetime.datetime.now()
                 
                 # Check if already marked (prevent spamming)
@@ -2577,16 +3241,10 @@ async def on_message(message):
                         await message.add_reaction("✅")
                         
                         # Update record with FULL timestamp for 24h expiry
-                        if 'records' not in data:
-                            data['records'] = {}
-                        data['records'][user_id] = {
-                            "status": "excused",
-                            "timestamp": now.isoformat(),
-                            "channel_id": message.channel.id,
-                            "reason": reason
-                        }
-                        save_attendance_data(message.guild.id, data)
-                        database.increment_status_count(message.guild.id, message.author.id, "excused")
+                        await adb.record_attendance(
+                            message.guild.id, message.author.id, "excused", now.isoformat(),
+                            channel_id=message.channel.id, reason=reason, source="message"
+                        )
                         
                         await message.channel.send(f"Excused status marked for {message.author.mention}! Reason: {reason}", delete_after=10)
                         
@@ -2627,7 +3285,15 @@ async def on_message(message):
                 sticky_info["message_id"] = new_msg.id
 
 
+def handle_sigterm(signum, frame):
+    """Treat SIGTERM from the host platform like Ctrl+C so shutdown cleanup runs."""
+    raise KeyboardInterrupt
+
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    # Bring back database files lost with an ephemeral disk before anything opens them.
+    replication.restore()
     keep_alive()
 
     if not TOKEN:
@@ -2644,3 +3310,8 @@ if __name__ == "__main__":
             logger.error(f"Login failed: {e}")
         except Exception as e:
             logger.error(f"Bot crashed with error: {e}", exc_info=True)
+        finally:
+            adb.shutdown()
+            storage.backend.flush_snapshot()
+            replication.stop()
+            storage.backend.close()
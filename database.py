@@ -1,9 +1,20 @@
 import os
+import re
 import sqlite3
 import json
+import gzip
 import logging
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import attendance_archive
+import attendance_calendar
 
 
 def resolve_db_file():
@@ -33,10 +44,92 @@ def resolve_db_file():
     return "attendance.db"
 
 
+def env_int(name, default):
+    """Reads an integer environment variable, falling back to the default on bad input."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.getLogger(__name__).warning("Ignoring invalid integer for %s: %r", name, value)
+        return default
+
+
+def env_flag(name, default):
+    """Reads a boolean environment variable such as 1/0, true/false, yes/no or on/off."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off")
+
+
 DB_FILE = resolve_db_file()
-SNAPSHOT_FILE = os.getenv("DB_SNAPSHOT_FILE", str(Path(DB_FILE).with_name("attendance_snapshot.json")))
+SNAPSHOT_FILE = os.getenv("DB_SNAPSHOT_FILE", str(Path(DB_FILE).with_name("attendance_snapshot.jsonl.gz")))
+# Pre-streaming snapshots were a single indented JSON document; they are still restored if found.
+LEGACY_SNAPSHOT_FILE = str(Path(DB_FILE).with_name("attendance_snapshot.json"))
+SNAPSHOT_FORMAT = "registrar-snapshot"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_TABLES = (
+    "guild_configs", "attendance_records", "attendance_stats", "custom_commands", "attendance_events",
+    "attendance_calendar", "attendance_rollups", "attendance_streaks", "attendance_archived_counts",
+)
 logger = logging.getLogger(__name__)
 
+# Pragma profile applied to every connection. cache_size is negative so SQLite reads it as KiB.
+DB_PRAGMA_PROFILE = {
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+    "cache_size": env_int("DB_CACHE_SIZE", -16000),
+    "mmap_size": env_int("DB_MMAP_SIZE", 64 * 1024 * 1024),
+    "temp_store": os.getenv("DB_TEMP_STORE", "MEMORY"),
+    "busy_timeout": env_int("DB_BUSY_TIMEOUT", 5000),
+}
+DB_READER_POOL_SIZE = env_int("DB_READER_POOL_SIZE", 4)
+# Minimum number of seconds between two snapshot writes; 0 writes after every mutation.
+SNAPSHOT_INTERVAL_SECONDS = env_int("DB_SNAPSHOT_INTERVAL", 30)
+# Rows per executemany batch when streaming a snapshot back in.
+SNAPSHOT_BATCH_SIZE = env_int("DB_SNAPSHOT_BATCH_SIZE", 500)
+# "json" writes the JSON Lines snapshot (plus delta log); "backup" copies the database with
+# SQLite's online backup API into BACKUP_FILE instead.
+SNAPSHOT_MODE = os.getenv("DB_SNAPSHOT_MODE", "json").strip().lower()
+BACKUP_FILE = os.getenv("DB_BACKUP_FILE", str(Path(DB_FILE).with_suffix(".backup.db")))
+BACKUP_PAGES_PER_STEP = env_int("DB_BACKUP_PAGES_PER_STEP", 64)
+BACKUP_STEP_PAUSE_MS = env_int("DB_BACKUP_STEP_PAUSE_MS", 5)
+# Append-only log of mutations since the base snapshot; folded into a new base once it
+# grows past DB_SNAPSHOT_COMPACT_BYTES. Set DB_SNAPSHOT_DELTAS=0 to write full snapshots instead.
+SNAPSHOT_DELTAS_ENABLED = SNAPSHOT_MODE == "json" and env_flag("DB_SNAPSHOT_DELTAS", True)
+DELTA_LOG_FILE = os.getenv("DB_SNAPSHOT_DELTA_FILE", SNAPSHOT_FILE + ".delta.jsonl")
+SNAPSHOT_COMPACT_BYTES = env_int("DB_SNAPSHOT_COMPACT_BYTES", 1024 * 1024)
+# Mutations queued within this many milliseconds of each other (up to GROUP_COMMIT_MAX_OPS)
+# share one transaction and one fsync; 0 only batches what is already waiting.
+GROUP_COMMIT_WINDOW_MS = env_int("DB_GROUP_COMMIT_WINDOW_MS", 2)
+GROUP_COMMIT_MAX_OPS = env_int("DB_GROUP_COMMIT_MAX_OPS", 128)
+# Optional sharding: "hash" spreads guilds over DB_SHARD_COUNT files and "guild" gives every
+# guild its own file, both under DB_SHARD_DIR; "none" keeps everything in DB_FILE. Each shard
+# has its own writer, so a burst in one guild never waits on another shard's commits.
+SHARD_MODES = ("none", "hash", "guild")
+DB_SHARD_MODE = os.getenv("DB_SHARD_MODE", "none").strip().lower()
+if DB_SHARD_MODE not in SHARD_MODES:
+    logger.warning("Unknown DB_SHARD_MODE %r; using 'none'.", DB_SHARD_MODE)
+    DB_SHARD_MODE = "none"
+DB_SHARD_COUNT = max(1, env_int("DB_SHARD_COUNT", 8))
+DB_SHARD_DIR = os.getenv("DB_SHARD_DIR", str(Path(DB_FILE).with_name("shards")))
+# Background maintenance (see run_maintenance). Retention (see RETENTION_RULES) is off unless DB_RETENTION_DAYS > 0.
+RETENTION_DAYS = env_int("DB_RETENTION_DAYS", 0)
+MAINTENANCE_BATCH_ROWS = env_int("DB_MAINTENANCE_BATCH_ROWS", 500)
+MAINTENANCE_VACUUM_PAGES = env_int("DB_MAINTENANCE_VACUUM_PAGES", 256)
+MAINTENANCE_MAX_VACUUM_STEPS = env_int("DB_MAINTENANCE_MAX_VACUUM_STEPS", 64)
+MAINTENANCE_STEP_PAUSE_MS = env_int("DB_MAINTENANCE_STEP_PAUSE_MS", 50)
+# Converting an existing file to incremental auto_vacuum needs one full VACUUM, which holds
+# the writer for the whole rewrite; opt in with DB_MAINTENANCE_CONVERT_VACUUM=1.
+MAINTENANCE_CONVERT_VACUUM = env_flag("DB_MAINTENANCE_CONVERT_VACUUM", False)
+# Cold archival of the attendance ledger (see archive_closed_months). When enabled, months
+# older than the current one plus DB_ARCHIVE_KEEP_MONTHS closed months leave the database.
+ARCHIVE_ENABLED = env_flag("DB_ARCHIVE_ENABLED", False)
+ARCHIVE_KEEP_MONTHS = env_int("DB_ARCHIVE_KEEP_MONTHS", 6)
+ARCHIVE_DIR = os.getenv("DB_ARCHIVE_DIR", str(Path(DB_FILE).with_name("archive")))
+GUILD_SHARD_PATTERN = re.compile(r"^guild-(\d+)(?:\.backup)?\.db$")
+
 
 def ensure_parent_directory(file_path):
     """Creates the parent directory for a file path when needed."""
@@ -49,31 +142,801 @@ def ensure_parent_directory(file_path):
     parent.mkdir(parents=True, exist_ok=True)
 
 
+def apply_pragmas(conn, pragmas=None):
+    """Applies a pragma profile (defaults to DB_PRAGMA_PROFILE) to a connection."""
+    for name, value in (DB_PRAGMA_PROFILE if pragmas is None else pragmas).items():
+        value = str(value).strip()
+        if not value.lstrip("-").isalnum():
+            logger.warning("Skipping invalid value for PRAGMA %s: %r", name, value)
+            continue
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+def open_connection(db_file, pragmas=None):
+    """Opens a SQLite connection with the pragma profile and Row factory applied."""
+    ensure_parent_directory(db_file)
+    conn = sqlite3.connect(db_file, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    apply_pragmas(conn, pragmas)
+    # INSERT OR REPLACE only fires the leaderboard_counts delete trigger with this on.
+    conn.execute("PRAGMA recursive_triggers = ON")
+    return conn
+
+
+# Remembers which manager's writer the current thread is inside, for record_change().
+_active_writer = threading.local()
+
+
+class ConnectionManager:
+    """Keeps one long-lived writer and a small pool of reader connections for a database file."""
+
+    def __init__(self, db_file, reader_pool_size=None, pragmas=None):
+        self.db_file = db_file
+        self.pragmas = dict(DB_PRAGMA_PROFILE if pragmas is None else pragmas)
+        self.reader_pool_size = max(1, reader_pool_size or DB_READER_POOL_SIZE)
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self._writer_owner = None
+        self._write_queue = queue.Queue()
+        self._committer = None
+        self._committer_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._closed = False
+        self._pending_changes = []
+        # Set once migrations have been applied to this file in the current process.
+        self.schema_ready = False
+        # Called with the change entries of each committed transaction while the writer lock is held.
+        self.after_commit = None
+
+    def _get_writer(self):
+        if self._writer is None:
+            conn = open_connection(self.db_file, self.pragmas)
+            # Only takes effect on a brand-new file (or after a full VACUUM); lets maintenance
+            # hand free pages back to the filesystem in small incremental steps.
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if str(mode).lower() != "wal":
+                logger.warning("SQLite refused WAL mode for %s (using %s).", self.db_file, mode)
+            self._writer = conn
+        return self._writer
+
+    @contextmanager
+    def writer(self):
+        """Yields the writer connection; the outermost block commits or rolls back."""
+        with self._writer_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError(f"Connection manager for {self.db_file} is closed")
+            conn = self._get_writer()
+            self._writer_depth += 1
+            self._writer_owner = threading.get_ident()
+            outer_manager = getattr(_active_writer, "manager", None)
+            _active_writer.manager = self
+            try:
+                yield conn
+                if self._writer_depth == 1:
+                    conn.commit()
+                    self._publish_changes()
+            except BaseException:
+                if self._writer_depth == 1:
+                    conn.rollback()
+                    self._pending_changes = []
+                raise
+            finally:
+                _active_writer.manager = outer_manager
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer_owner = None
+
+    def record_change(self, entry):
+        """Queues a change entry for after_commit; only valid inside a writer() block."""
+        self._pending_changes.append(entry)
+
+    def _publish_changes(self):
+        changes, self._pending_changes = self._pending_changes, []
+        if not changes or self.after_commit is None:
+            return
+        try:
+            self.after_commit(changes)
+        except Exception as e:
+            logger.warning("Failed to publish %s committed change(s) for %s: %s", len(changes), self.db_file, e)
+
+    def submit(self, func):
+        """Queues func(conn) for the group-commit writer and returns a Future for its result.
+
+        Each call runs inside its own savepoint, so a failing mutation only rolls back (and
+        raises) for its own caller while the rest of the batch commits together.
+        """
+        future = Future()
+        if self._writer_owner == threading.get_ident():
+            # Already inside a writer block (or on the committer thread): queueing would deadlock.
+            with self.writer() as conn:
+                try:
+                    future.set_result(func(conn))
+                except Exception as e:
+                    future.set_exception(e)
+            return future
+
+        if self._closed:
+            raise sqlite3.ProgrammingError(f"Connection manager for {self.db_file} is closed")
+        with self._committer_lock:
+            if self._committer is None:
+                self._committer = threading.Thread(
+                    target=self._commit_loop, name="registrar-db-writer", daemon=True
+                )
+                self._committer.start()
+        self._write_queue.put((func, future))
+        return future
+
+    def _commit_loop(self):
+        window = max(0, GROUP_COMMIT_WINDOW_MS) / 1000
+        max_ops = max(1, GROUP_COMMIT_MAX_OPS)
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + window
+            while len(batch) < max_ops:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._write_queue.get(timeout=timeout) if timeout > 0 else self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        completed = []
+        try:
+            with self.writer() as conn:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN")
+                for func, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    mark = len(self._pending_changes)
+                    conn.execute("SAVEPOINT group_commit_op")
+                    try:
+                        result = func(conn)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO group_commit_op")
+                        conn.execute("RELEASE group_commit_op")
+                        del self._pending_changes[mark:]
+                        future.set_exception(e)
+                    else:
+                        conn.execute("RELEASE group_commit_op")
+                        completed.append((future, result))
+        except Exception as e:
+            logger.error("Group commit of %s mutation(s) failed for %s: %s", len(batch), self.db_file, e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            for future, _ in completed:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in completed:
+            future.set_result(result)
+
+    def _stop_committer(self):
+        with self._committer_lock:
+            committer, self._committer = self._committer, None
+        if committer is None:
+            return
+        self._write_queue.put(None)
+        if committer is not threading.current_thread():
+            committer.join()
+        while True:
+            try:
+                item = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(sqlite3.ProgrammingError(f"Connection manager for {self.db_file} is closed"))
+
+    def _acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        if self._writer is None:
+            # Make sure the file exists in WAL mode before readers attach to it.
+            with self.writer():
+                pass
+
+        with self._reader_lock:
+            if self._reader_count < self.reader_pool_size:
+                self._reader_count += 1
+                try:
+                    return open_connection(self.db_file, self.pragmas)
+                except Exception:
+                    self._reader_count -= 1
+                    raise
+
+        return self._readers.get()
+
+    def _release_reader(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        self._readers.put(conn)
+
+    @contextmanager
+    def reader(self):
+        """Yields a pooled reader connection and returns it to the pool afterwards."""
+        if self._closed:
+            raise sqlite3.ProgrammingError(f"Connection manager for {self.db_file} is closed")
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            self._release_reader(conn)
+
+    def close(self):
+        """Drains the write queue, then closes the writer and every idle reader connection."""
+        self._closed = True
+        self._stop_committer()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(db_file=None):
+    """Returns the shared connection manager for a database file (DB_FILE by default)."""
+    db_file = db_file or DB_FILE
+    with _managers_lock:
+        manager = _managers.get(db_file)
+        if manager is None:
+            manager = ConnectionManager(db_file)
+            if SNAPSHOT_DELTAS_ENABLED:
+                manager.after_commit = delta_log.append
+            _managers[db_file] = manager
+        return manager
+
+
+def shard_file(guild_id, mode=None, count=None, shard_dir=None):
+    """Returns the database file holding guild_id under a shard layout (the configured one by default)."""
+    mode = mode or DB_SHARD_MODE
+    shard_dir = Path(shard_dir or DB_SHARD_DIR)
+    if mode == "hash":
+        count = count or DB_SHARD_COUNT
+        return str(shard_dir / f"attendance-{int(guild_id) % count:03d}-of-{count:03d}.db")
+    if mode == "guild":
+        return str(shard_dir / f"guild-{int(guild_id)}.db")
+    return DB_FILE
+
+
+def shard_files(mode=None, count=None, shard_dir=None):
+    """Lists the database files of a shard layout; for "guild", those with a database or backup on disk."""
+    mode = mode or DB_SHARD_MODE
+    shard_dir = Path(shard_dir or DB_SHARD_DIR)
+    if mode == "hash":
+        count = count or DB_SHARD_COUNT
+        return [shard_file(index, mode, count, shard_dir) for index in range(count)]
+    if mode == "guild":
+        guild_ids = set()
+        if shard_dir.is_dir():
+            for path in shard_dir.iterdir():
+                match = GUILD_SHARD_PATTERN.match(path.name)
+                if match:
+                    guild_ids.add(int(match.group(1)))
+        return [shard_file(guild_id, mode, shard_dir=shard_dir) for guild_id in sorted(guild_ids)]
+    return [DB_FILE]
+
+
+def shard_managers():
+    """Returns the connection manager of every shard in the configured layout."""
+    return [get_manager(db_file) for db_file in shard_files()]
+
+
+def guild_manager(guild_id=None):
+    """Returns the manager for the shard holding guild_id (DB_FILE when unsharded or guild_id is None)."""
+    if guild_id is None or DB_SHARD_MODE == "none":
+        return get_manager()
+    manager = get_manager(shard_file(guild_id))
+    if not manager.schema_ready:
+        # Shards appear on demand (always, for "guild"), so bring new files up to date here.
+        ensure_schema(manager)
+    return manager
+
+
+def read_connection(guild_id=None):
+    """Context manager yielding a pooled reader connection for the guild's shard."""
+    return guild_manager(guild_id).reader()
+
+
+def write_connection(guild_id=None):
+    """Context manager yielding the writer connection for the guild's shard inside a transaction."""
+    return guild_manager(guild_id).writer()
+
+
+def run_write(func, guild_id=None):
+    """Runs func(conn) through the guild shard's group-commit writer and returns its result."""
+    return guild_manager(guild_id).submit(func).result()
+
+
+def record_change(op, table, **fields):
+    """Records an idempotent change for the delta log; call inside write_connection() or run_write().
+
+    op is "upsert" (insert-or-replace fields["row"]) or "replace" (delete rows matching
+    fields["where"], then insert fields["rows"]).
+    """
+    if SNAPSHOT_DELTAS_ENABLED:
+        manager = getattr(_active_writer, "manager", None) or get_manager()
+        manager.record_change(dict(op=op, table=table, **fields))
+
+
+# Called as listener(guild_id, rows, version) after a stats write commits. rows lists the new
+# (user_id, present_count) pairs, version is the guild's leaderboard_counts.version at that
+# write; rows is None when the guild's stats (or every guild's, if guild_id is None) were replaced.
+stats_listeners = []
+
+
+def notify_stats_changed(guild_id, rows, version=None):
+    """Passes a committed stats change to every stats listener."""
+    for listener in stats_listeners:
+        try:
+            listener(guild_id, rows, version)
+        except Exception as e:
+            logger.warning("Stats listener %r failed for guild %s: %s", listener, guild_id, e)
+
+
+def _stats_version(conn, guild_id):
+    row = conn.execute('SELECT version FROM leaderboard_counts WHERE guild_id = ?', (guild_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def close_connections():
+    """Closes every managed connection (call on shutdown or before swapping DB_FILE)."""
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+    for manager in managers:
+        manager.close()
+    delta_log.close()
+
+
+def iter_table_rows(conn, table_name, batch_size=None):
+    """Yields (columns, row tuple) pairs for a table without materializing it."""
+    c = conn.execute(f"SELECT * FROM {table_name}")
+    columns = [description[0] for description in c.description]
+    while True:
+        rows = c.fetchmany(batch_size or SNAPSHOT_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield columns, tuple(row)
+
+
+def write_snapshot_tables(fileobj, tables, **header_fields):
+    """Writes (table_name, columns, row batches) triples as a gzip-compressed JSON Lines snapshot.
+
+    The first line is a header; each table is a {"table", "columns"} line followed by one
+    JSON array per row. Returns the number of rows written.
+    """
+    total = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6) as gz:
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "exported_at": datetime.utcnow().isoformat() + "Z",
+        }
+        header.update(header_fields)
+        gz.write((json.dumps(header) + "\n").encode("utf-8"))
+        for table_name, columns, batches in tables:
+            gz.write((json.dumps({"table": table_name, "columns": columns}) + "\n").encode("utf-8"))
+            for rows in batches:
+                gz.write("".join(json.dumps(list(row), default=json_default) + "\n" for row in rows).encode("utf-8"))
+                total += len(rows)
+    return total
+
+
+def write_snapshot_stream(conn, fileobj):
+    """Streams every snapshot table of one connection (or a list of shard connections) into fileobj.
+
+    Shard rows are written under one table header each. Returns the number of rows written.
+    """
+    conns = conn if isinstance(conn, (list, tuple)) else [conn]
+
+    def batches(table_name, columns):
+        for shard_conn in conns:
+            c = shard_conn.execute(f"SELECT {', '.join(columns)} FROM {table_name}")
+            while True:
+                rows = c.fetchmany(SNAPSHOT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+
+    tables = (
+        (table_name, schema_columns(table_name), batches(table_name, schema_columns(table_name)))
+        for table_name in SNAPSHOT_TABLES
+    )
+    return write_snapshot_tables(fileobj, tables, db_file=DB_FILE, shard_mode=DB_SHARD_MODE)
+
+
+def atomic_write(target_path, write_func, by_path=False):
+    """Calls write_func on a temp file beside target_path, then renames it into place.
+
+    write_func receives an open binary file, or the temp file's path when by_path is True.
+    """
+    target_path = Path(target_path)
+    ensure_parent_directory(target_path)
+    fd, tmp_name = tempfile.mkstemp(prefix=target_path.name + ".", suffix=".tmp", dir=str(target_path.parent))
+    try:
+        if by_path:
+            os.close(fd)
+            result = write_func(tmp_name)
+            fd = os.open(tmp_name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        else:
+            with os.fdopen(fd, "wb") as tmp_file:
+                result = write_func(tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        os.replace(tmp_name, target_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+    return result
+
+
+def pin_read_snapshot(conn):
+    """Starts a read transaction and takes its snapshot now rather than at the first query."""
+    conn.execute("BEGIN")
+    conn.execute("SELECT 1 FROM guild_configs LIMIT 1").fetchall()
+
+
 def write_snapshot():
-    """Writes a JSON backup snapshot beside the SQLite database."""
+    """Writes a compressed JSON Lines backup snapshot of every shard beside the SQLite database.
+
+    With delta logging enabled this is a compaction: the delta log is rotated under the
+    writer locks, the base is written from the same point in time, and the rotated log
+    is removed once the new base is in place.
+    """
     try:
-        snapshot_path = Path(SNAPSHOT_FILE)
-        ensure_parent_directory(snapshot_path)
-        payload = export_all_data()
-        snapshot_path.write_text(
-            json.dumps(payload, indent=2, sort_keys=True),
-            encoding="utf-8"
-        )
+        with ExitStack() as stack:
+            managers = shard_managers()
+            conns = [stack.enter_context(manager.reader()) for manager in managers]
+            if SNAPSHOT_DELTAS_ENABLED:
+                with ExitStack() as writers:
+                    for manager in managers:
+                        writers.enter_context(manager.writer())
+                    delta_log.rotate()
+                    # Pin the read snapshots before new writes (and deltas) can land.
+                    for conn in conns:
+                        pin_read_snapshot(conn)
+                # A guild shard created since the listing only needs pinning after the
+                # rotation for the base to cover everything the rotated log holds.
+                for manager in shard_managers():
+                    if manager not in managers:
+                        conn = stack.enter_context(manager.reader())
+                        pin_read_snapshot(conn)
+                        conns.append(conn)
+            else:
+                # One read transaction per shard keeps each shard's tables consistent.
+                for conn in conns:
+                    pin_read_snapshot(conn)
+            row_count = atomic_write(SNAPSHOT_FILE, lambda f: write_snapshot_stream(conns, f))
+        if SNAPSHOT_DELTAS_ENABLED:
+            delta_log.discard_rotated()
+        logger.debug("Wrote snapshot %s (%s rows).", SNAPSHOT_FILE, row_count)
+        return True
     except Exception as e:
         logger.warning("Failed to write snapshot %s: %s", SNAPSHOT_FILE, e)
+        return False
+
+
+class DeltaLog:
+    """Append-only JSON Lines log of committed changes since the last base snapshot."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.rotated_path = Path(str(path) + ".compacting")
+        self._lock = threading.Lock()
+        self._file = None
+
+    def append(self, entries):
+        """Appends change entries; called after each commit while the writer lock is held."""
+        lines = "".join(json.dumps(entry, separators=(",", ":"), default=json_default) + "\n" for entry in entries)
+        with self._lock:
+            if self._file is None:
+                ensure_parent_directory(self.path)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(lines)
+            self._file.flush()
+
+    def size(self):
+        """Returns the size of the live log in bytes."""
+        with self._lock:
+            try:
+                return self.path.stat().st_size
+            except FileNotFoundError:
+                return 0
+
+    def sync(self):
+        """Forces appended entries to disk."""
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Moves the live log aside so a compaction can fold it into a new base."""
+        with self._lock:
+            self._close()
+            if not self.path.exists():
+                return
+            if self.rotated_path.exists():
+                # A previous compaction failed; keep its entries ahead of the newer ones.
+                with open(self.rotated_path, "a", encoding="utf-8") as target:
+                    target.write(self.path.read_text(encoding="utf-8"))
+                self.path.unlink()
+            else:
+                os.replace(self.path, self.rotated_path)
+
+    def discard_rotated(self):
+        """Deletes the rotated log once its entries are part of a base snapshot."""
+        with self._lock:
+            try:
+                self.rotated_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def iter_entries(self):
+        """Yields logged entries oldest first, including any left over from a failed compaction."""
+        for path in (self.rotated_path, self.path):
+            if not path.exists():
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # A crash mid-append can only truncate the final line.
+                        logger.warning("Skipping unreadable delta %s:%s", path, line_number)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+delta_log = DeltaLog(DELTA_LOG_FILE)
+
+
+def backup_file_for(db_file):
+    """Returns the backup-mode copy path for a database or shard file."""
+    return BACKUP_FILE if db_file == DB_FILE else str(Path(db_file).with_suffix(".backup.db"))
+
+
+def write_backup(target_path=None, pages_per_step=None, db_file=None):
+    """Copies a live database (DB_FILE by default) into a sibling .db file with the online backup API.
+
+    The copy runs from a pooled reader in steps of a few pages, pausing between steps, so
+    it never takes the writer lock. If writers keep changing pages the copy has already
+    passed, SQLite restarts it; after a few restarts the rest is copied in a single step.
+    """
+    db_file = db_file or DB_FILE
+    target_path = Path(target_path or backup_file_for(db_file))
+    pages_per_step = pages_per_step or BACKUP_PAGES_PER_STEP
+    restarts = 0
+    last_remaining = None
+
+    class TooManyRestarts(Exception):
+        pass
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining >= last_remaining:
+            restarts += 1
+            if restarts > 3:
+                raise TooManyRestarts()
+        last_remaining = remaining
+        if BACKUP_STEP_PAUSE_MS > 0:
+            time.sleep(BACKUP_STEP_PAUSE_MS / 1000)
+
+    def copy(tmp_name):
+        target = sqlite3.connect(tmp_name)
+        try:
+            with get_manager(db_file).reader() as source:
+                try:
+                    source.backup(target, pages=pages_per_step, progress=progress)
+                except TooManyRestarts:
+                    # Readers do not block writers in WAL mode, so one step is still safe.
+                    source.backup(target)
+            # Keep the copy a self-contained single file.
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+
+    try:
+        started = time.time()
+        atomic_write(target_path, copy, by_path=True)
+        logger.debug("Wrote backup %s in %.3fs (%s restarts).", target_path, time.time() - started, restarts)
+        return True
+    except Exception as e:
+        logger.warning("Failed to write backup %s: %s", target_path, e)
+        return False
+
+
+def restore_backup_if_needed(conn, backup_path=None):
+    """Copies a backup (BACKUP_FILE by default) into a brand-new database file via the backup API."""
+    backup_path = Path(backup_path or BACKUP_FILE)
+    if not backup_path.exists():
+        return False
+    if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        return False
+
+    source = sqlite3.connect(f"file:{backup_path}?mode=ro", uri=True)
+    try:
+        source.backup(conn, pages=BACKUP_PAGES_PER_STEP)
+    finally:
+        source.close()
+    logger.info("Restored database from backup %s", backup_path)
+    return True
+
+
+def sync_snapshot():
+    """Persists pending changes: full snapshot, or delta sync plus compaction when due."""
+    if SNAPSHOT_MODE == "backup":
+        # Every shard is copied on its own, so one busy shard never holds up the rest.
+        results = [write_backup(db_file=db_file) for db_file in shard_files()]
+        return all(results)
+    if not SNAPSHOT_DELTAS_ENABLED:
+        return write_snapshot()
+
+    try:
+        delta_log.sync()
+    except Exception as e:
+        logger.warning("Failed to sync delta log %s: %s", DELTA_LOG_FILE, e)
+        return False
+    if delta_log.size() >= SNAPSHOT_COMPACT_BYTES or not Path(SNAPSHOT_FILE).exists():
+        logger.info("Compacting delta log %s into %s", DELTA_LOG_FILE, SNAPSHOT_FILE)
+        return write_snapshot()
+    return True
+
+
+class SnapshotScheduler:
+    """Coalesces snapshot requests so the backup is written at most once per interval."""
+
+    def __init__(self, write_func, interval):
+        self._write_func = write_func
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        self._writing = False
+        self._last_attempt_at = None
+        self.last_written_at = None
+        self.last_duration = None
+
+    def mark_dirty(self):
+        """Records that the database changed and schedules a write if none is pending."""
+        if self.interval <= 0:
+            self.write_now()
+            return
+
+        with self._lock:
+            self._dirty = True
+            # A running write reschedules itself on completion if more changes arrived.
+            if self._timer is None and not self._writing:
+                self._start_timer()
+
+    def _start_timer(self):
+        delay = 0.0
+        if self._last_attempt_at is not None:
+            delay = max(0.0, self.interval - (time.time() - self._last_attempt_at))
+        self._timer = threading.Timer(delay, self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run(self):
+        with self._lock:
+            self._timer = None
+            if not self._dirty:
+                return
+        self.write_now()
+
+    def write_now(self):
+        """Writes the snapshot immediately on the calling thread."""
+        with self._write_lock:
+            with self._lock:
+                self._dirty = False
+                self._writing = True
+            started = time.time()
+            try:
+                if self._write_func():
+                    self.last_written_at = started
+                    self.last_duration = time.time() - started
+            finally:
+                with self._lock:
+                    self._writing = False
+                    self._last_attempt_at = started
+                    if self._dirty and self._timer is None and self.interval > 0:
+                        self._start_timer()
+
+    def flush(self):
+        """Cancels the pending timer and writes any outstanding changes (used on shutdown)."""
+        with self._lock:
+            timer, self._timer = self._timer, None
+            dirty = self._dirty
+        if timer is not None:
+            timer.cancel()
+        if dirty:
+            self.write_now()
+
+    def status(self):
+        """Returns snapshot health metrics for logging and health checks."""
+        last_written_at = self.last_written_at
+        if last_written_at is None and Path(SNAPSHOT_FILE).exists():
+            last_written_at = Path(SNAPSHOT_FILE).stat().st_mtime
+        return {
+            "snapshot_age_seconds": round(time.time() - last_written_at, 1) if last_written_at else None,
+            "snapshot_pending": self._dirty,
+            "snapshot_last_duration_seconds": round(self.last_duration, 3) if self.last_duration is not None else None,
+        }
+
+
+snapshot_scheduler = SnapshotScheduler(sync_snapshot, SNAPSHOT_INTERVAL_SECONDS)
+
+
+def schedule_snapshot():
+    """Marks the database dirty so the snapshot scheduler writes it soon."""
+    snapshot_scheduler.mark_dirty()
+
+
+def flush_snapshot():
+    """Writes any pending snapshot right away (call on graceful shutdown)."""
+    snapshot_scheduler.flush()
+
+
+def get_snapshot_age():
+    """Returns the number of seconds since the last snapshot was written, or None."""
+    return snapshot_scheduler.status()["snapshot_age_seconds"]
 
 
 def export_all_data():
     """Exports the database contents as plain JSON-serializable structures."""
-    conn = get_connection()
-    c = conn.cursor()
-
-    tables = {}
-    for table_name in ("guild_configs", "attendance_records", "attendance_stats", "custom_commands"):
-        c.execute(f"SELECT * FROM {table_name}")
-        tables[table_name] = [dict(row) for row in c.fetchall()]
+    tables = {table_name: [] for table_name in SNAPSHOT_TABLES}
+    for manager in shard_managers():
+        with manager.reader() as conn:
+            for table_name in SNAPSHOT_TABLES:
+                tables[table_name].extend(
+                    encode_blobs(table_name, dict(zip(columns, row))) for columns, row in iter_table_rows(conn, table_name)
+                )
 
-    conn.close()
     return {
         "exported_at": datetime.utcnow().isoformat() + "Z",
         "db_file": DB_FILE,
@@ -83,89 +946,304 @@ def export_all_data():
 
 def is_database_empty(conn):
     """Returns True when all persisted tables are empty."""
-    c = conn.cursor()
-    for table_name in ("guild_configs", "attendance_records", "attendance_stats", "custom_commands"):
-        c.execute(f"SELECT COUNT(*) AS count FROM {table_name}")
-        row = c.fetchone()
-        if row and row["count"]:
+    for table_name in SNAPSHOT_TABLES:
+        if conn.execute(f"SELECT 1 FROM {table_name} LIMIT 1").fetchone():
             return False
     return True
 
 
-def restore_snapshot_if_needed(conn):
-    """Restores the JSON snapshot into a new empty database."""
-    snapshot_path = Path(SNAPSHOT_FILE)
-    if not snapshot_path.exists() or not is_database_empty(conn):
-        return
+def get_table_columns(conn, table_name):
+    """Returns the column names of a table."""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info('{table_name}')")]
 
-    try:
-        payload = json.loads(snapshot_path.read_text(encoding="utf-8"))
-        tables = payload.get("tables", {})
-        c = conn.cursor()
 
-        c.executemany(
-            '''INSERT INTO guild_configs (
-                   guild_id, attendance_role_id, absent_role_id, excused_role_id,
-                   welcome_channel_id, report_channel_id, last_report_message_id,
-                   last_report_channel_id, attendance_mode, attendance_expiry_hours,
-                   window_start_time, window_end_time, last_processed_date,
-                   last_opened_date, allow_self_marking, require_admin_excuse,
-                   auto_nick_on_join, enforce_suffix, remove_suffix_on_role_loss,
-                   suffix_format, present_channel_id
-               ) VALUES (
-                   :guild_id, :attendance_role_id, :absent_role_id, :excused_role_id,
-                   :welcome_channel_id, :report_channel_id, :last_report_message_id,
-                   :last_report_channel_id, :attendance_mode, :attendance_expiry_hours,
-                   :window_start_time, :window_end_time, :last_processed_date,
-                   :last_opened_date, :allow_self_marking, :require_admin_excuse,
-                   :auto_nick_on_join, :enforce_suffix, :remove_suffix_on_role_loss,
-                   :suffix_format, :present_channel_id
-               )''',
-            tables.get("guild_configs", [])
-        )
-        c.executemany(
-            '''INSERT INTO attendance_records (
-                   id, guild_id, user_id, status, timestamp, channel_id, reason
-               ) VALUES (
-                   :id, :guild_id, :user_id, :status, :timestamp, :channel_id, :reason
-               )''',
-            tables.get("attendance_records", [])
-        )
-        c.executemany(
-            '''INSERT INTO attendance_stats (
-                   guild_id, user_id, present_count, absent_count, excused_count
-               ) VALUES (
-                   :guild_id, :user_id, :present_count, :absent_count, :excused_count
-               )''',
-            tables.get("attendance_stats", [])
-        )
-        c.executemany(
-            '''INSERT INTO custom_commands (
-                   guild_id, command_name, response_text
-               ) VALUES (
-                   :guild_id, :command_name, :response_text
-               )''',
-            tables.get("custom_commands", [])
+def is_gzip_file(path):
+    """Returns True when a file starts with the gzip magic bytes."""
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+class ShardWriters:
+    """Holds one writer transaction per shard touched and commits them all when the block exits."""
+
+    def __init__(self, created=None):
+        # Shards first opened here get their schema but not their user_version; the caller
+        # records it once the whole restore has succeeded.
+        self.created = created if created is not None else []
+        self._stack = ExitStack()
+        self._conns = {}
+
+    def __enter__(self):
+        self._stack.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._stack.__exit__(*exc_info)
+
+    def connection(self, guild_id):
+        """Returns the open writer connection of the shard holding guild_id."""
+        db_file = shard_file(guild_id)
+        conn = self._conns.get(db_file)
+        if conn is None:
+            manager = get_manager(db_file)
+            if not manager.schema_ready:
+                ensure_schema(manager, record_version=False)
+                self.created.append(manager)
+            conn = self._conns[db_file] = self._stack.enter_context(manager.writer())
+        return conn
+
+
+def connection_router(target):
+    """Returns a guild_id -> connection function for a connection or a ShardWriters."""
+    if isinstance(target, ShardWriters):
+        return target.connection
+    return lambda guild_id: target
+
+
+def read_snapshot_stream(fileobj):
+    """Yields (table_name, columns, values) for every row of a compressed JSON Lines snapshot."""
+    with gzip.GzipFile(fileobj=fileobj, mode="rb") as gz:
+        header = json.loads(gz.readline() or b"{}")
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError("not a registrar snapshot")
+
+        table_name = columns = None
+        for line in gz:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                table_name, columns = item["table"], item["columns"]
+                continue
+            yield table_name, columns, item
+
+
+def restore_snapshot_stream(conn, fileobj):
+    """Streams a compressed JSON Lines snapshot into the database in fixed-size batches.
+
+    Runs inside the caller's transaction; conn may be a ShardWriters to route rows to their
+    guild's shard. Columns missing from the current schema are skipped. Returns the number
+    of rows restored.
+    """
+    return restore_row_stream(conn, read_snapshot_stream(fileobj))
+
+
+def restore_row_stream(conn, items):
+    """Inserts (table_name, columns, values) items the way restore_snapshot_stream does.
+
+    BLOB columns may be given as hex strings. Returns the number of rows inserted.
+    """
+    route = connection_router(conn)
+    total = 0
+    pending = 0
+    batches = {}
+    current_table = current_columns = None
+    insert_sql = None
+    keep_indexes = None
+    kept = None
+    guild_index = None
+    blob_indexes = ()
+    fresh_guilds = set()
+
+    def flush():
+        nonlocal total, pending
+        if insert_sql:
+            for target, rows in batches.items():
+                insert_table_rows(target, current_table, kept, rows, insert_sql, fresh_guilds)
+                total += len(rows)
+        batches.clear()
+        pending = 0
+
+    for table_name, columns, values in items:
+        if table_name != current_table or columns is not current_columns:
+            flush()
+            current_table, current_columns = table_name, columns
+            insert_sql = None
+            if table_name not in SNAPSHOT_TABLES:
+                continue
+            existing = set(portable_columns(table_name))
+            keep_indexes = [i for i, name in enumerate(columns) if name in existing]
+            kept = [columns[i] for i in keep_indexes]
+            guild_index = kept.index("guild_id")
+            blob_indexes = [i for i, name in enumerate(kept) if name in BLOB_COLUMNS.get(table_name, ())]
+            # OR REPLACE collapses duplicate members found in snapshots taken before
+            # attendance_records had its unique (guild_id, user_id) index.
+            insert_sql = (
+                f"INSERT OR REPLACE INTO {table_name} ({', '.join(kept)}) "
+                f"VALUES ({', '.join('?' for _ in kept)})"
+            )
+
+        if insert_sql is None:
+            continue
+        values = [values[i] for i in keep_indexes]
+        for i in blob_indexes:
+            if isinstance(values[i], str):
+                values[i] = bytes.fromhex(values[i])
+        batches.setdefault(route(values[guild_index]), []).append(values)
+        pending += 1
+        if pending >= SNAPSHOT_BATCH_SIZE:
+            flush()
+    flush()
+    return total
+
+
+def restore_legacy_snapshot(conn, snapshot_path):
+    """Restores a pre-streaming snapshot (one indented JSON document)."""
+    payload = json.loads(Path(snapshot_path).read_text(encoding="utf-8"))
+    restore_tables(conn, payload.get("tables", {}))
+
+
+def restore_tables(conn, tables):
+    """Inserts export_all_data()-style {table: [row dicts]} into a connection or ShardWriters."""
+    route = connection_router(conn)
+
+    def executemany(sql, rows):
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(route(row["guild_id"]), []).append(row)
+        for target, shard_rows in by_shard.items():
+            target.executemany(sql, shard_rows)
+
+    executemany(
+        '''INSERT INTO guild_configs (
+               guild_id, attendance_role_id, absent_role_id, excused_role_id,
+               welcome_channel_id, report_channel_id, last_report_message_id,
+               last_report_channel_id, attendance_mode, attendance_expiry_hours,
+               window_start_time, window_end_time, last_processed_date,
+               last_opened_date, allow_self_marking, require_admin_excuse,
+               auto_nick_on_join, enforce_suffix, remove_suffix_on_role_loss,
+               suffix_format, present_channel_id
+           ) VALUES (
+               :guild_id, :attendance_role_id, :absent_role_id, :excused_role_id,
+               :welcome_channel_id, :report_channel_id, :last_report_message_id,
+               :last_report_channel_id, :attendance_mode, :attendance_expiry_hours,
+               :window_start_time, :window_end_time, :last_processed_date,
+               :last_opened_date, :allow_self_marking, :require_admin_excuse,
+               :auto_nick_on_join, :enforce_suffix, :remove_suffix_on_role_loss,
+               :suffix_format, :present_channel_id
+           )''',
+        tables.get("guild_configs", [])
+    )
+    executemany(
+        '''INSERT OR REPLACE INTO attendance_records (
+               id, guild_id, user_id, status, timestamp, channel_id, reason
+           ) VALUES (
+               :id, :guild_id, :user_id, :status, :timestamp, :channel_id, :reason
+           )''',
+        tables.get("attendance_records", [])
+    )
+    executemany(
+        '''INSERT INTO attendance_stats (
+               guild_id, user_id, present_count, absent_count, excused_count
+           ) VALUES (
+               :guild_id, :user_id, :present_count, :absent_count, :excused_count
+           )''',
+        tables.get("attendance_stats", [])
+    )
+    executemany(
+        '''INSERT INTO custom_commands (
+               guild_id, command_name, response_text
+           ) VALUES (
+               :guild_id, :command_name, :response_text
+           )''',
+        tables.get("custom_commands", [])
+    )
+    by_shard = {}
+    for row in tables.get("attendance_events", []):
+        by_shard.setdefault(route(row["guild_id"]), []).append(row)
+    for target, shard_rows in by_shard.items():
+        insert_events(target, shard_rows)
+    for table_name in ("attendance_calendar", "attendance_rollups", "attendance_streaks", "attendance_archived_counts"):
+        columns = portable_columns(table_name)
+        executemany(
+            f"INSERT OR REPLACE INTO {table_name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join(':' + name for name in columns)})",
+            [decode_blobs(table_name, dict(row)) for row in tables.get(table_name, [])]
         )
 
-        conn.commit()
-        logger.info("Restored database contents from snapshot %s", snapshot_path)
+
+def replay_delta_entries(conn, entries):
+    """Applies delta log entries in order; every entry is idempotent. Returns the count."""
+    route = connection_router(conn)
+    applied = 0
+    fresh_guilds = set()
+    for entry in entries:
+        table_name = entry.get("table")
+        if table_name not in SNAPSHOT_TABLES:
+            continue
+        existing = set(portable_columns(table_name))
+
+        if entry.get("op") == "replace":
+            where = {k: v for k, v in entry.get("where", {}).items() if k in existing}
+            target = route(where.get("guild_id"))
+            if where:
+                target.execute(
+                    f"DELETE FROM {table_name} WHERE " + " AND ".join(f"{k} = ?" for k in where),
+                    list(where.values())
+                )
+            rows = entry.get("rows", [])
+        elif entry.get("op") == "upsert":
+            rows = [entry["row"]]
+            target = route(entry["row"].get("guild_id"))
+        else:
+            continue
+
+        for row in rows:
+            row = decode_blobs(table_name, {k: v for k, v in row.items() if k in existing})
+            insert_table_rows(target, table_name, list(row), [list(row.values())], fresh_guilds=fresh_guilds)
+        applied += 1
+    return applied
+
+
+def restore_snapshot_if_needed(created=None):
+    """Restores the latest base snapshot plus delta log while every shard is still empty.
+
+    Shards opened for the first time during the restore are appended to created. Returns
+    False only when a restore was attempted and failed.
+    """
+    snapshot_path = Path(SNAPSHOT_FILE)
+    if not snapshot_path.exists():
+        snapshot_path = Path(LEGACY_SNAPSHOT_FILE)
+    has_deltas = SNAPSHOT_DELTAS_ENABLED and (delta_log.path.exists() or delta_log.rotated_path.exists())
+    if not (snapshot_path.exists() or has_deltas):
+        return True
+    for manager in shard_managers():
+        with manager.reader() as conn:
+            if not is_database_empty(conn):
+                return True
+
+    try:
+        with ShardWriters(created) as writers:
+            if not snapshot_path.exists():
+                pass
+            elif is_gzip_file(snapshot_path):
+                with open(snapshot_path, "rb") as f:
+                    restore_snapshot_stream(writers, f)
+            else:
+                restore_legacy_snapshot(writers, snapshot_path)
+
+            replayed = replay_delta_entries(writers, delta_log.iter_entries()) if has_deltas else 0
+        logger.info("Restored database contents from snapshot %s (+%s deltas)", snapshot_path, replayed)
+        return True
     except Exception as e:
-        conn.rollback()
         logger.warning("Failed to restore snapshot %s: %s", snapshot_path, e)
+        return False
+
+def import_data(payload):
+    """Loads an export_all_data() payload into the database, routing rows to their shards."""
+    with ShardWriters() as writers:
+        restore_tables(writers, payload.get("tables", {}))
+    notify_stats_changed(None, None)
+    if SNAPSHOT_DELTAS_ENABLED:
+        # Imported rows bypass the delta log, so fold them into a new base right away.
+        write_snapshot()
+    else:
+        schedule_snapshot()
 
 def get_connection():
-    """Establishes a connection to the SQLite database."""
-    ensure_parent_directory(DB_FILE)
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Opens a standalone connection to the SQLite database (the caller must close it)."""
+    return open_connection(DB_FILE)
 
-def init_db():
-    """Initializes the database tables."""
-    conn = get_connection()
-    c = conn.cursor()
-    
+def migrate_base_schema(c):
+    """Creates the original tables and indexes, adding columns missing from older databases."""
     # Guild Configuration Table
     c.execute('''CREATE TABLE IF NOT EXISTS guild_configs (
         guild_id INTEGER PRIMARY KEY,
@@ -190,7 +1268,7 @@ def init_db():
         suffix_format TEXT DEFAULT ' [𝙼𝚂𝚄𝚊𝚗]',
         present_channel_id INTEGER
     )''')
-    
+
     # Ensure new columns exist on older databases
     c.execute("PRAGMA table_info('guild_configs')")
     existing_guild_columns = [row[1] for row in c.fetchall()]
@@ -208,7 +1286,7 @@ def init_db():
         reason TEXT,
         FOREIGN KEY(guild_id) REFERENCES guild_configs(guild_id)
     )''')
-    
+
     # Index for faster lookups
     c.execute('CREATE INDEX IF NOT EXISTS idx_records_guild_user ON attendance_records (guild_id, user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_records_guild_date ON attendance_records (guild_id, timestamp)')
@@ -240,159 +1318,843 @@ def init_db():
     if 'excused_count' not in existing_columns:
         c.execute("ALTER TABLE attendance_stats ADD COLUMN excused_count INTEGER DEFAULT 0")
 
-    conn.commit()
-    restore_snapshot_if_needed(conn)
-    conn.close()
-    logger.info("Database initialized at %s (snapshot: %s).", DB_FILE, SNAPSHOT_FILE)
+
+def migrate_unique_member_records(c):
+    """Keeps one attendance record per (guild_id, user_id) and enforces it with a unique index."""
+    # Older databases may hold duplicates; keep the newest row for each member.
+    has_unique_index = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uq_records_guild_user'"
+    ).fetchone()
+    if not has_unique_index:
+        c.execute('''DELETE FROM attendance_records WHERE id NOT IN (
+                         SELECT MAX(id) FROM attendance_records GROUP BY guild_id, user_id)''')
+        c.execute('DROP INDEX IF EXISTS idx_records_guild_user')
+        c.execute('CREATE UNIQUE INDEX uq_records_guild_user ON attendance_records (guild_id, user_id)')
+
+
+def migrate_leaderboard_index(c):
+    """Adds the covering leaderboard index and a trigger-maintained member count per guild."""
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_stats_leaderboard ON attendance_stats
+                 (guild_id, present_count DESC, user_id, absent_count, excused_count)''')
+    # version changes on every stats write so callers can tell when cached pages are stale.
+    c.execute('''CREATE TABLE IF NOT EXISTS leaderboard_counts (
+        guild_id INTEGER PRIMARY KEY,
+        member_count INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_count_insert AFTER INSERT ON attendance_stats
+                 BEGIN
+                     INSERT INTO leaderboard_counts (guild_id, member_count, version) VALUES (NEW.guild_id, 1, 1)
+                     ON CONFLICT(guild_id) DO UPDATE SET member_count = member_count + 1, version = version + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_count_delete AFTER DELETE ON attendance_stats
+                 BEGIN
+                     UPDATE leaderboard_counts SET member_count = member_count - 1, version = version + 1
+                     WHERE guild_id = OLD.guild_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_count_update AFTER UPDATE ON attendance_stats
+                 BEGIN
+                     UPDATE leaderboard_counts SET version = version + 1 WHERE guild_id = NEW.guild_id;
+                 END''')
+    c.execute('DELETE FROM leaderboard_counts')
+    c.execute('''INSERT INTO leaderboard_counts (guild_id, member_count)
+                 SELECT guild_id, COUNT(*) FROM attendance_stats GROUP BY guild_id''')
+
+
+def migrate_attendance_events(c):
+    """Adds the append-only attendance_events ledger."""
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance_events (
+        id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        reason TEXT,
+        ts INTEGER NOT NULL,
+        source TEXT
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_events_guild_ts ON attendance_events (guild_id, ts)')
+    # Not unique: a member can repeat a status within one second. Replays are keyed on id.
+    c.execute('CREATE INDEX IF NOT EXISTS idx_events_guild_user_ts ON attendance_events (guild_id, user_id, ts)')
+
+
+def migrate_rollups(c):
+    """Adds per-day statuses, week/month rollups and streaks maintained at session close-out."""
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance_daily (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        status TEXT NOT NULL,
+        PRIMARY KEY (guild_id, user_id, day)
+    )''')
+    # period is 'YYYY-MM' for months and 'YYYY-Www' (ISO week) for weeks.
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance_rollups (
+        guild_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        present_count INTEGER NOT NULL DEFAULT 0,
+        absent_count INTEGER NOT NULL DEFAULT 0,
+        excused_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, period, user_id)
+    )''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_rollups_leaderboard ON attendance_rollups
+                 (guild_id, period, present_count DESC, user_id, absent_count, excused_count)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance_streaks (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        current_streak INTEGER NOT NULL DEFAULT 0,
+        best_streak INTEGER NOT NULL DEFAULT 0,
+        last_day TEXT,
+        PRIMARY KEY (guild_id, user_id)
+    )''')
+
+
+def migrate_attendance_calendar(c):
+    """Replaces the one-row-per-day attendance_daily table with 2-bit-per-day calendars."""
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance_calendar (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        days BLOB NOT NULL,
+        PRIMARY KEY (guild_id, user_id, year)
+    ) WITHOUT ROWID''')
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attendance_daily'").fetchone():
+        return
+    calendars = {}
+    for guild_id, user_id, day, status in c.execute('SELECT guild_id, user_id, day, status FROM attendance_daily'):
+        if status not in attendance_calendar.CODES:
+            continue
+        year, index = attendance_calendar.day_index(day)
+        key = (guild_id, user_id, year)
+        calendars[key] = attendance_calendar.set_day(calendars.get(key), index, status)
+    c.executemany(
+        'INSERT OR REPLACE INTO attendance_calendar (guild_id, user_id, year, days) VALUES (?, ?, ?, ?)',
+        [(*key, days) for key, days in calendars.items()]
+    )
+    c.execute('DROP TABLE attendance_daily')
+
+
+def migrate_excuse_search(c):
+    """Adds the excuse_search FTS5 index over excused ledger events' reasons."""
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'excuse_search'").fetchone()
+    try:
+        # External content: the text lives in attendance_events, the index stores only tokens.
+        # Only excused rows are indexed, so FTS5 'rebuild' and content-checking integrity
+        # checks (rank = 1) do not apply; the triggers below keep it in step instead.
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS excuse_search USING fts5(
+            reason, content='attendance_events', content_rowid='id', tokenize='porter unicode61'
+        )''')
+    except sqlite3.OperationalError as e:
+        logger.warning("SQLite has no FTS5 support; excuse search is disabled: %s", e)
+        return
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_excuse_search_insert AFTER INSERT ON attendance_events
+                 WHEN new.status = 'excused' AND new.reason IS NOT NULL BEGIN
+                     INSERT INTO excuse_search (rowid, reason) VALUES (new.id, new.reason);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_excuse_search_delete AFTER DELETE ON attendance_events
+                 WHEN old.status = 'excused' AND old.reason IS NOT NULL BEGIN
+                     INSERT INTO excuse_search (excuse_search, rowid, reason) VALUES ('delete', old.id, old.reason);
+                 END''')
+    if not exists:
+        c.execute('''INSERT INTO excuse_search (rowid, reason)
+                     SELECT id, reason FROM attendance_events WHERE status = 'excused' AND reason IS NOT NULL''')
+
+
+def migrate_archived_counts(c):
+    """Adds the per-member counts of archived ledger events that rebuild_attendance_stats adds back."""
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance_archived_counts (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        present_count INTEGER NOT NULL DEFAULT 0,
+        absent_count INTEGER NOT NULL DEFAULT 0,
+        excused_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id)
+    )''')
+
+
+# Ordered schema migrations; PRAGMA user_version stores how many have been applied. Append new
+# steps to the end and never reorder them. Databases created before user_version was tracked
+# start at 0, so every step must be safe to run against a schema that already has its changes.
+SCHEMA_MIGRATIONS = (
+    migrate_base_schema,
+    migrate_unique_member_records,
+    migrate_leaderboard_index,
+    migrate_attendance_events,
+    migrate_rollups,
+    migrate_attendance_calendar,
+    migrate_excuse_search,
+    migrate_archived_counts,
+)
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+
+def get_schema_version(conn):
+    """Returns the number of schema migrations recorded in PRAGMA user_version."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_schema_version(conn):
+    """Records that every schema migration has been applied."""
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def apply_migrations(conn):
+    """Runs the migrations a connection's database has not had yet; returns how many ran.
+
+    Does not commit or record the new version; callers do both.
+    """
+    version = get_schema_version(conn)
+    c = conn.cursor()
+    for step, migrate in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        logger.info("Applying schema migration %s (%s)", step, migrate.__name__)
+        migrate(c)
+    return max(0, SCHEMA_VERSION - version)
+
+
+def ensure_schema(manager, record_version=True):
+    """Brings a shard opened after startup up to the current schema."""
+    with manager.writer() as conn:
+        if apply_migrations(conn) and record_version:
+            set_schema_version(conn)
+    manager.schema_ready = True
+
+
+_schema_columns = {}
+# Surrogate keys only mean something inside one file; rows copied between files (or shard
+# layouts) are matched on their natural keys instead. Ledger events have no natural key (the
+# same member can repeat a status within one second), so their id travels with them and
+# insert_events() resolves clashes between files.
+LOCAL_ONLY_COLUMNS = {"attendance_records": ("id",)}
+# BLOB columns travel through JSON snapshots, delta entries and exports as hex strings.
+BLOB_COLUMNS = {"attendance_calendar": ("days",)}
+
+
+def json_default(value):
+    """json.dumps default hook: writes BLOB values as hex strings."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_blobs(table_name, row):
+    """Replaces a row dict's BLOB values with hex strings (in place) and returns it."""
+    for name in BLOB_COLUMNS.get(table_name, ()):
+        if isinstance(row.get(name), (bytes, bytearray, memoryview)):
+            row[name] = bytes(row[name]).hex()
+    return row
+
+
+def decode_blobs(table_name, row):
+    """Turns a portable row dict's hex strings back into BLOB values (in place) and returns it."""
+    for name in BLOB_COLUMNS.get(table_name, ()):
+        if isinstance(row.get(name), str):
+            row[name] = bytes.fromhex(row[name])
+    return row
+
+
+def schema_columns(table_name):
+    """Returns a table's columns in the current schema, independent of any live shard."""
+    if not _schema_columns:
+        conn = sqlite3.connect(":memory:")
+        try:
+            apply_migrations(conn)
+            for name in SNAPSHOT_TABLES:
+                _schema_columns[name] = get_table_columns(conn, name)
+        finally:
+            conn.close()
+    return _schema_columns[table_name]
+
+
+def portable_columns(table_name):
+    """Returns the columns that identify a row in any shard (schema columns minus surrogate keys)."""
+    local_only = LOCAL_ONLY_COLUMNS.get(table_name, ())
+    return [name for name in schema_columns(table_name) if name not in local_only]
+
+
+def init_db():
+    """Applies pending schema migrations to every shard and restores a snapshot into a new database.
+
+    Returns after one PRAGMA read per shard when user_version says the schema is current.
+    """
+    files = shard_files()
+    location = DB_FILE if DB_SHARD_MODE == "none" else f"{DB_SHARD_DIR} ({DB_SHARD_MODE} shards)"
+    pending = []
+    for db_file in files:
+        manager = get_manager(db_file)
+        with manager.writer() as conn:
+            if SNAPSHOT_MODE == "backup" and get_schema_version(conn) == 0:
+                restore_backup_if_needed(conn, backup_file_for(db_file))
+            if apply_migrations(conn):
+                pending.append(manager)
+        manager.schema_ready = True
+
+    # A "guild" layout with no files yet is as new as a freshly migrated database.
+    if not pending and files:
+        logger.info("Database at %s is ready (schema version %s).", location, SCHEMA_VERSION)
+        return
+
+    # Versions are recorded only after the restore check, so an interrupted first start retries it.
+    if restore_snapshot_if_needed(pending):
+        for manager in pending:
+            with manager.writer() as conn:
+                set_schema_version(conn)
+    logger.info("Database initialized at %s (schema version %s, snapshot: %s).", location, SCHEMA_VERSION, SNAPSHOT_FILE)
+
+
+def rebalance_shards(from_mode, to_mode, from_count=None, to_count=None, shard_dir=None):
+    """Copies every row from one shard layout into another (run while the bot is stopped).
+
+    Target files must be new or empty; the source files are left untouched so the old layout
+    keeps working until DB_SHARD_MODE/DB_SHARD_COUNT are switched. The JSON snapshot routes
+    rows by guild_id, so it stays valid across layouts. Returns a summary dict.
+    """
+    sources = [f for f in shard_files(from_mode, from_count, shard_dir) if Path(f).exists()]
+    source_set = {str(Path(f).resolve()) for f in sources}
+    targets = {}
+    copied = 0
+    fresh_guilds = set()
+
+    def target_for(guild_id):
+        path = shard_file(guild_id, to_mode, to_count, shard_dir)
+        conn = targets.get(path)
+        if conn is None:
+            if str(Path(path).resolve()) in source_set:
+                raise ValueError(f"{path} belongs to both layouts; pick a different mode, count or directory")
+            conn = open_connection(path)
+            conn.execute("PRAGMA journal_mode = WAL")
+            targets[path] = conn
+            apply_migrations(conn)
+            set_schema_version(conn)
+            if not is_database_empty(conn):
+                raise ValueError(f"{path} already holds data")
+        return conn
+
+    try:
+        for source_file in sources:
+            source = open_connection(source_file)
+            try:
+                if get_schema_version(source) == 0 and is_database_empty(source):
+                    continue
+                for table_name in SNAPSHOT_TABLES:
+                    existing = set(portable_columns(table_name))
+                    batches = {}
+                    insert_sql = None
+                    for columns, row in iter_table_rows(source, table_name):
+                        if insert_sql is None:
+                            keep_indexes = [i for i, name in enumerate(columns) if name in existing]
+                            kept = [columns[i] for i in keep_indexes]
+                            guild_index = kept.index("guild_id")
+                            insert_sql = (
+                                f"INSERT OR REPLACE INTO {table_name} ({', '.join(kept)}) "
+                                f"VALUES ({', '.join('?' for _ in kept)})"
+                            )
+                        values = [row[i] for i in keep_indexes]
+                        target = target_for(values[guild_index])
+                        batch = batches.setdefault(target, [])
+                        batch.append(values)
+                        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+                            insert_table_rows(target, table_name, kept, batch, insert_sql, fresh_guilds)
+                            copied += len(batch)
+                            batch.clear()
+                    for target, rows in batches.items():
+                        if rows:
+                            insert_table_rows(target, table_name, kept, rows, insert_sql, fresh_guilds)
+                            copied += len(rows)
+            finally:
+                source.close()
+        for conn in targets.values():
+            conn.commit()
+    except BaseException:
+        for conn in targets.values():
+            conn.rollback()
+        raise
+    finally:
+        for conn in targets.values():
+            conn.close()
+
+    logger.info("Rebalanced %s row(s) from %s %s file(s) into %s %s file(s).",
+                copied, len(sources), from_mode, len(targets), to_mode)
+    return {"source_files": len(sources), "target_files": len(targets), "rows": copied}
 
 def get_guild_config(guild_id):
     """Retrieves configuration for a guild."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('SELECT * FROM guild_configs WHERE guild_id = ?', (guild_id,))
-    row = c.fetchone()
-    conn.close()
+    with read_connection(guild_id) as conn:
+        row = conn.execute('SELECT * FROM guild_configs WHERE guild_id = ?', (guild_id,)).fetchone()
     if row:
         return dict(row)
     return None
 
 def update_guild_config(guild_id, **kwargs):
     """Updates specific fields in the guild configuration."""
-    conn = get_connection()
-    c = conn.cursor()
-    
-    # Check if exists
-    c.execute('SELECT 1 FROM guild_configs WHERE guild_id = ?', (guild_id,))
-    exists = c.fetchone()
-    
-    if not exists:
-        # Create default entry first
-        c.execute('INSERT INTO guild_configs (guild_id) VALUES (?)', (guild_id,))
-    
-    if kwargs:
-        columns = ', '.join(f"{k} = ?" for k in kwargs.keys())
-        values = list(kwargs.values()) + [guild_id]
-        c.execute(f'UPDATE guild_configs SET {columns} WHERE guild_id = ?', values)
-    
-    conn.commit()
-    conn.close()
-    write_snapshot()
+    def apply(conn):
+        c = conn.cursor()
+
+        # Check if exists
+        c.execute('SELECT 1 FROM guild_configs WHERE guild_id = ?', (guild_id,))
+        exists = c.fetchone()
+
+        if not exists:
+            # Create default entry first
+            c.execute('INSERT INTO guild_configs (guild_id) VALUES (?)', (guild_id,))
+
+        if kwargs:
+            columns = ', '.join(f"{k} = ?" for k in kwargs.keys())
+            values = list(kwargs.values()) + [guild_id]
+            c.execute(f'UPDATE guild_configs SET {columns} WHERE guild_id = ?', values)
+
+        row = c.execute('SELECT * FROM guild_configs WHERE guild_id = ?', (guild_id,)).fetchone()
+        record_change("upsert", "guild_configs", row=dict(row))
+
+    run_write(apply, guild_id)
+    schedule_snapshot()
+
+# --- Attendance ledger (attendance_events) ---
+
+# Statuses that count towards attendance_stats; other ledger statuses are history only.
+COUNTED_STATUSES = ("present", "absent", "excused")
+# clear_attendance_stats leaves this guild-wide marker so a rebuild starts after it.
+RESET_EVENT_USER_ID = 0
+RESET_EVENT_STATUS = "stats_reset"
+INSERT_EVENT_SQL = '''INSERT INTO attendance_events (guild_id, user_id, status, reason, ts, source)
+                      VALUES (?, ?, ?, ?, ?, ?)'''
+EVENT_COLUMNS = ("guild_id", "user_id", "status", "reason", "ts", "source")
+
+def event_ts(timestamp):
+    """Converts an ISO timestamp (naive means local time), datetime or epoch to integer epoch seconds."""
+    if timestamp is None:
+        return int(time.time())
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return int(timestamp.timestamp())
+
+def append_event(conn, guild_id, user_id, status, ts, reason=None, source=None):
+    """Appends one ledger event inside an open write; call from run_write()/write_connection()."""
+    append_events(conn, guild_id, [user_id], status, ts, reason, source)
+
+def append_events(conn, guild_id, user_ids, status, ts, reason=None, source=None):
+    """Appends the same event for several members inside an open write."""
+    ts = event_ts(ts)
+    user_ids = [int(uid) for uid in user_ids]
+    if not user_ids:
+        return
+    if SNAPSHOT_DELTAS_ENABLED:
+        # New rows get ids above the current maximum while this writer holds the file.
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM attendance_events').fetchone()[0]
+    conn.executemany(INSERT_EVENT_SQL, [(guild_id, uid, status, reason, ts, source) for uid in user_ids])
+    if SNAPSHOT_DELTAS_ENABLED:
+        for row in conn.execute('SELECT * FROM attendance_events WHERE id > ? ORDER BY id', (last_id,)):
+            record_change("upsert", "attendance_events", row=dict(row))
+
+def insert_events(conn, rows, fresh_guilds=None):
+    """Inserts ledger event dicts from a snapshot, delta log, export or another shard file.
+
+    An event keeps its id, so loading it again replaces it instead of adding a copy. When the
+    id already belongs to another guild's event (rows from a different shard file), every
+    event of that guild in this load (fresh_guilds, shared across calls) gets a new id
+    instead, in the original order, so id order still follows time within the guild.
+    """
+    fresh_guilds = set() if fresh_guilds is None else fresh_guilds
+    rows = sorted(rows, key=lambda row: (row.get("id") is None, int(row.get("id") or 0)))
+    ids = [int(row["id"]) for row in rows if row.get("id") is not None]
+    owners = {}
+    for first in range(0, len(ids), 500):
+        chunk = ids[first:first + 500]
+        owners.update(conn.execute(
+            f"SELECT id, guild_id FROM attendance_events WHERE id IN ({', '.join('?' for _ in chunk)})", chunk
+        ).fetchall())
+    claimed = {}
+    for row in rows:
+        if row.get("id") is None:
+            continue
+        guild_id, event_id = int(row["guild_id"]), int(row["id"])
+        owner = claimed.get(event_id, owners.get(event_id))
+        if owner is not None and owner != guild_id:
+            fresh_guilds.add(guild_id)
+        claimed.setdefault(event_id, guild_id)
+
+    keyed, fresh = [], []
+    for row in rows:
+        values = [row.get(name) for name in EVENT_COLUMNS]
+        if row.get("id") is None or int(row["guild_id"]) in fresh_guilds:
+            fresh.append(values)
+        else:
+            keyed.append([int(row["id"])] + values)
+    conn.executemany(
+        f"INSERT OR REPLACE INTO attendance_events (id, {', '.join(EVENT_COLUMNS)}) "
+        f"VALUES (?, {', '.join('?' for _ in EVENT_COLUMNS)})",
+        keyed
+    )
+    # After the keyed rows, so new ids land above every id kept in this load.
+    conn.executemany(INSERT_EVENT_SQL, fresh)
+
+def insert_table_rows(conn, table_name, columns, rows, insert_sql=None, fresh_guilds=None):
+    """INSERT OR REPLACEs value lists for columns into a snapshot table; events use insert_events()."""
+    if table_name == "attendance_events":
+        insert_events(conn, [dict(zip(columns, values)) for values in rows], fresh_guilds)
+        return
+    conn.executemany(
+        insert_sql or f"INSERT OR REPLACE INTO {table_name} ({', '.join(columns)}) "
+                      f"VALUES ({', '.join('?' for _ in columns)})",
+        rows
+    )
+
+def log_attendance_event(guild_id, user_id, status, timestamp=None, reason=None, source=None):
+    """Appends a history-only event (e.g. "removed") without touching records or stats."""
+    run_write(lambda conn: append_event(conn, guild_id, user_id, status, timestamp, reason, source), guild_id)
+    schedule_snapshot()
+
+def get_attendance_history(guild_id, user_id, since=None, until=None, limit=50):
+    """Returns a member's ledger events (newest first) with since <= ts < until (epoch seconds).
+
+    Months moved out by archive_closed_months are read back from their archive files.
+    """
+    since = event_ts(since) if since is not None else 0
+    until = event_ts(until) if until is not None else 2 ** 62
+    with read_connection(guild_id) as conn:
+        rows = conn.execute(
+            '''SELECT status, reason, ts, source FROM attendance_events
+               WHERE guild_id = ? AND user_id = ? AND ts >= ? AND ts < ?
+               ORDER BY ts DESC, id DESC
+               LIMIT ?''',
+            (guild_id, user_id, since, until, limit)
+        ).fetchall()
+    events = [dict(row) for row in rows]
+    if len(events) < limit:
+        archived = attendance_archive.read_history(ARCHIVE_DIR, guild_id, user_id, since, until)
+        archived.sort(key=lambda event: event["ts"], reverse=True)
+        events.extend(archived[:limit - len(events)])
+    return events
+
+def fts_query(terms):
+    """Builds an FTS5 MATCH expression that ANDs the words of terms; a trailing * keeps prefix search."""
+    words = []
+    for word in re.findall(r"[\w']+\*?", terms or ""):
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            words.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(words)
+
+def search_excuses(guild_id, terms, since=None, until=None, limit=10, offset=0):
+    """Full-text searches excuse reasons, best match first; returns (total matches, rows).
+
+    Rows are {user_id, reason, ts, source, snippet}; snippet wraps the matched words in **.
+    Months moved out by archive_closed_months are searched in their archive files and listed
+    after the live matches.
+    """
+    query = fts_query(terms)
+    if not query:
+        return 0, []
+    since = event_ts(since) if since is not None else 0
+    until = event_ts(until) if until is not None else 2 ** 62
+    match = '''FROM excuse_search JOIN attendance_events e ON e.id = excuse_search.rowid
+               WHERE excuse_search MATCH ? AND e.guild_id = ? AND e.ts >= ? AND e.ts < ?'''
+    params = (query, guild_id, since, until)
+    with read_connection(guild_id) as conn:
+        total = conn.execute(f'SELECT COUNT(*) {match}', params).fetchone()[0]
+        rows = conn.execute(
+            f'''SELECT e.user_id, e.reason, e.ts, e.source,
+                       snippet(excuse_search, 0, '**', '**', '…', 16) AS snippet
+                {match}
+                ORDER BY bm25(excuse_search), e.ts DESC
+                LIMIT ? OFFSET ?''',
+            params + (limit, offset)
+        ).fetchall()
+    rows = [dict(row) for row in rows]
+
+    archived = search_archived_excuses(guild_id, query, since, until)
+    if archived:
+        start = max(0, offset - total)
+        rows.extend(archived[start:start + limit - len(rows)])
+    return total + len(archived), rows
+
+def search_archived_excuses(guild_id, query, since, until):
+    """Runs an fts_query() over the guild's archived excuses in range; returns search_excuses rows.
+
+    The reasons go into a throwaway in-memory FTS5 table with excuse_search's tokenizer, so
+    matching and snippets are the same as for live excuses.
+    """
+    excuses = attendance_archive.read_excuses(ARCHIVE_DIR, guild_id, since, until)
+    if not excuses:
+        return []
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE archived_excuses USING fts5(reason, tokenize='porter unicode61')")
+        conn.executemany('INSERT INTO archived_excuses (rowid, reason) VALUES (?, ?)',
+                         [(index, excuse["reason"]) for index, excuse in enumerate(excuses)])
+        matches = conn.execute(
+            '''SELECT rowid, snippet(archived_excuses, 0, '**', '**', '…', 16) FROM archived_excuses
+               WHERE archived_excuses MATCH ? ORDER BY bm25(archived_excuses), rowid''',
+            (query,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(excuses[index], snippet=snippet) for index, snippet in matches]
+
+def get_analytics_rows(guild_id):
+    """Returns a guild's stats and ledger in bulk for analytics.
+
+    {"stats": [(user_id, present, absent, excused)], "events": [(user_id, status, ts)]}; events
+    are the counted statuses since the guild's latest stats reset, oldest first.
+    """
+    counted = ", ".join(f"'{status}'" for status in COUNTED_STATUSES)
+    with read_connection(guild_id) as conn:
+        stats = conn.execute(
+            'SELECT user_id, present_count, absent_count, excused_count FROM attendance_stats WHERE guild_id = ?',
+            (guild_id,)
+        ).fetchall()
+        reset_id = conn.execute(
+            'SELECT MAX(id) FROM attendance_events WHERE guild_id = ? AND user_id = ? AND status = ?',
+            (guild_id, RESET_EVENT_USER_ID, RESET_EVENT_STATUS)
+        ).fetchone()[0]
+        events = conn.execute(
+            f'''SELECT user_id, status, ts FROM attendance_events
+                WHERE guild_id = ? AND id > ? AND status IN ({counted})
+                ORDER BY id''',
+            (guild_id, reset_id or 0)
+        ).fetchall()
+    return {"stats": [tuple(row) for row in stats], "events": [tuple(row) for row in events]}
+
+def rebuild_attendance_stats(guild_id=None):
+    """Recomputes attendance_stats from the ledger in one pass per shard; returns rows written.
+
+    Counts every present/absent/excused event after the guild's latest stats reset, plus the
+    attendance_archived_counts of events archived since then. Members whose counts came only
+    from before the ledger existed lose those counts.
+    """
+    counted = ", ".join(f"'{status}'" for status in COUNTED_STATUSES)
+    guild_filter = "" if guild_id is None else "AND e.guild_id = ?"
+    archived_filter = "" if guild_id is None else "WHERE guild_id = ?"
+    params = () if guild_id is None else (guild_id,)
+    managers = shard_managers() if guild_id is None else [guild_manager(guild_id)]
+    total = 0
+    for manager in managers:
+        def apply(conn):
+            conn.execute(
+                'DELETE FROM attendance_stats' + ('' if guild_id is None else ' WHERE guild_id = ?'), params
+            )
+            c = conn.execute(
+                f'''INSERT INTO attendance_stats (guild_id, user_id, present_count, absent_count, excused_count)
+                    SELECT guild_id, user_id, SUM(present), SUM(absent), SUM(excused) FROM (
+                        SELECT e.guild_id, e.user_id,
+                               e.status = 'present' AS present, e.status = 'absent' AS absent,
+                               e.status = 'excused' AS excused
+                        FROM attendance_events e
+                        LEFT JOIN (
+                            SELECT guild_id, MAX(id) AS reset_id FROM attendance_events
+                            WHERE user_id = ? AND status = ? GROUP BY guild_id
+                        ) r ON r.guild_id = e.guild_id
+                        WHERE e.status IN ({counted}) AND e.id > COALESCE(r.reset_id, 0) {guild_filter}
+                        UNION ALL
+                        SELECT guild_id, user_id, present_count, absent_count, excused_count
+                        FROM attendance_archived_counts {archived_filter}
+                    )
+                    GROUP BY guild_id, user_id''',
+                (RESET_EVENT_USER_ID, RESET_EVENT_STATUS) + params + params
+            )
+            return c.rowcount
+        total += manager.submit(apply).result()
+
+    notify_stats_changed(guild_id, None)
+    if SNAPSHOT_DELTAS_ENABLED:
+        # The rebuilt table is not in the delta log; fold it into a new base right away.
+        write_snapshot()
+    else:
+        schedule_snapshot()
+    return total
+
+def record_attendance(guild_id, user_id, status, timestamp, channel_id=None, reason=None, source=None):
+    """Marks a member in one transaction: current record, stats counter and a ledger event."""
+    def apply(conn):
+        conn.execute(UPSERT_RECORD_SQL, (guild_id, user_id, status, timestamp, channel_id, reason))
+        row = conn.execute(
+            'SELECT * FROM attendance_records WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        ).fetchone()
+        record_change("upsert", "attendance_records", row=dict(row))
+        append_event(conn, guild_id, user_id, status, timestamp, reason, source)
+        if status not in COUNTED_STATUSES:
+            return None
+        column = f"{status}_count"
+        conn.execute(
+            f'''INSERT INTO attendance_stats (guild_id, user_id, {column}) VALUES (?, ?, 1)
+                ON CONFLICT(guild_id, user_id) DO UPDATE SET {column} = {column} + 1''',
+            (guild_id, user_id)
+        )
+        row = conn.execute(
+            'SELECT * FROM attendance_stats WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        ).fetchone()
+        record_change("upsert", "attendance_stats", row=dict(row))
+        return row['present_count'], _stats_version(conn, guild_id)
+
+    result = run_write(apply, guild_id)
+    if result is not None:
+        notify_stats_changed(guild_id, [(int(user_id), result[0])], result[1])
+    schedule_snapshot()
+
+def record_from_row(row):
+    """Converts an attendance_records row to the {status, timestamp, ...} dict the bot uses."""
+    return {
+        "status": row['status'],
+        "timestamp": row['timestamp'],
+        "channel_id": row['channel_id'],
+        "reason": row['reason']
+    }
 
 def get_attendance_records(guild_id):
     """Retrieves all attendance records for a guild."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('SELECT * FROM attendance_records WHERE guild_id = ?', (guild_id,))
-    rows = c.fetchall()
-    conn.close()
-    
+    with read_connection(guild_id) as conn:
+        rows = conn.execute('SELECT * FROM attendance_records WHERE guild_id = ?', (guild_id,)).fetchall()
+
     # Convert to dictionary format expected by bot {user_id: {status, timestamp, ...}}
-    records = {}
-    for row in rows:
-        records[str(row['user_id'])] = {
-            "status": row['status'],
-            "timestamp": row['timestamp'],
-            "channel_id": row['channel_id'],
-            "reason": row['reason']
-        }
-    return records
+    return {str(row['user_id']): record_from_row(row) for row in rows}
+
+def get_record(guild_id, user_id):
+    """Returns one member's current attendance record, or None."""
+    with read_connection(guild_id) as conn:
+        row = conn.execute(
+            'SELECT * FROM attendance_records WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        ).fetchone()
+    return record_from_row(row) if row else None
+
+UPSERT_RECORD_SQL = '''INSERT INTO attendance_records (guild_id, user_id, status, timestamp, channel_id, reason)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(guild_id, user_id) DO UPDATE SET
+                       status = excluded.status,
+                       timestamp = excluded.timestamp,
+                       channel_id = excluded.channel_id,
+                       reason = excluded.reason'''
+
+def upsert_record(guild_id, user_id, status, timestamp, channel_id=None, reason=None):
+    """Inserts or updates one member's attendance record."""
+    def apply(conn):
+        conn.execute(UPSERT_RECORD_SQL, (guild_id, user_id, status, timestamp, channel_id, reason))
+        row = conn.execute(
+            'SELECT * FROM attendance_records WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        ).fetchone()
+        record_change("upsert", "attendance_records", row=dict(row))
+
+    run_write(apply, guild_id)
+    schedule_snapshot()
 
 def add_or_update_record(guild_id, user_id, status, timestamp, channel_id=None, reason=None):
-    """Adds or updates an attendance record."""
-    conn = get_connection()
-    c = conn.cursor()
-    
-    # Upsert logic
-    c.execute('''INSERT INTO attendance_records (guild_id, user_id, status, timestamp, channel_id, reason)
-                 VALUES (?, ?, ?, ?, ?, ?)
-                 ON CONFLICT(id) DO UPDATE SET
-                 status=excluded.status,
-                 timestamp=excluded.timestamp,
-                 channel_id=excluded.channel_id,
-                 reason=excluded.reason
-    ''', (guild_id, user_id, status, timestamp, channel_id, reason))
-    
-    # Wait, SQLite UPSERT usually requires a unique constraint to conflict on.
-    # We don't have a unique constraint on (guild_id, user_id) because we might want history?
-    # But the current bot only stores ONE record per user per guild (current status).
-    # So we should probably DELETE old record for this user or UPDATE it.
-    
-    # Let's clean up: Delete existing record for this user in this guild first
-    # (Since we only track 'current' status in the JSON version)
-    
-    # Actually, let's use a unique constraint if we only want one record per user per day/session.
-    # The JSON structure is `records: { "user_id": { ... } }`, so only one active record per user.
-    
-    conn.rollback() # Undo the insert above
-    
-    # Delete previous record for this user
-    c.execute('DELETE FROM attendance_records WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
-    
-    # Insert new
-    c.execute('''INSERT INTO attendance_records (guild_id, user_id, status, timestamp, channel_id, reason)
-                 VALUES (?, ?, ?, ?, ?, ?)''', (guild_id, user_id, status, timestamp, channel_id, reason))
-    
-    conn.commit()
-    conn.close()
-    write_snapshot()
+    """Adds or updates an attendance record (kept for older callers; see upsert_record)."""
+    upsert_record(guild_id, user_id, status, timestamp, channel_id, reason)
+
+def delete_record(guild_id, user_id):
+    """Deletes one member's attendance record and returns whether a row was removed."""
+    def apply(conn):
+        c = conn.execute(
+            'DELETE FROM attendance_records WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        )
+        deleted = c.rowcount > 0
+        if deleted:
+            record_change(
+                "replace", "attendance_records",
+                where={"guild_id": guild_id, "user_id": user_id}, rows=[]
+            )
+        return deleted
+
+    deleted = run_write(apply, guild_id)
+    if deleted:
+        schedule_snapshot()
+    return deleted
+
+def bulk_upsert_records(guild_id, records_dict):
+    """Upserts many records ({user_id: {status, timestamp, channel_id, reason}}) in one transaction."""
+    if not records_dict:
+        return
+
+    def apply(conn):
+        conn.executemany(UPSERT_RECORD_SQL, [
+            (
+                guild_id,
+                uid,
+                info.get('status', 'present'),
+                info.get('timestamp'),
+                info.get('channel_id'),
+                info.get('reason')
+            )
+            for uid, info in records_dict.items()
+        ])
+        if SNAPSHOT_DELTAS_ENABLED:
+            # Reads back only the upserted members, through the (guild_id, user_id) unique index.
+            user_ids = sorted({int(uid) for uid in records_dict})
+            for first in range(0, len(user_ids), 500):
+                chunk = user_ids[first:first + 500]
+                for row in conn.execute(
+                    f"SELECT * FROM attendance_records WHERE guild_id = ? AND user_id IN ({', '.join('?' for _ in chunk)})",
+                    [guild_id] + chunk
+                ):
+                    record_change("upsert", "attendance_records", row=dict(row))
+
+    run_write(apply, guild_id)
+    schedule_snapshot()
 
 def replace_all_records(guild_id, records_dict):
     """Replaces all attendance records for a guild (bulk save)."""
-    conn = get_connection()
-    c = conn.cursor()
-    
-    # Transaction
-    try:
+    def apply(conn):
+        c = conn.cursor()
+
         # Delete all existing
         c.execute('DELETE FROM attendance_records WHERE guild_id = ?', (guild_id,))
-        
+
         # Insert new
         # records_dict is {user_id: {status, timestamp, channel_id, reason}}
         to_insert = []
         for uid, info in records_dict.items():
             to_insert.append((
-                guild_id, 
-                uid, 
-                info.get('status', 'present'), 
-                info.get('timestamp'), 
+                guild_id,
+                uid,
+                info.get('status', 'present'),
+                info.get('timestamp'),
                 info.get('channel_id'),
                 info.get('reason')
             ))
-            
+
         if to_insert:
             c.executemany('''INSERT INTO attendance_records (guild_id, user_id, status, timestamp, channel_id, reason)
                              VALUES (?, ?, ?, ?, ?, ?)''', to_insert)
-        
-        conn.commit()
+
+        rows = c.execute('SELECT * FROM attendance_records WHERE guild_id = ?', (guild_id,)).fetchall()
+        record_change("replace", "attendance_records", where={"guild_id": guild_id}, rows=[dict(row) for row in rows])
+
+    try:
+        run_write(apply, guild_id)
     except Exception as e:
-        conn.rollback()
         logger.error(f"Failed to replace records for guild {guild_id}: {e}")
         raise
-    finally:
-        conn.close()
-    write_snapshot()
+    schedule_snapshot()
 
 def clear_attendance_records(guild_id):
     """Clears all attendance records for a guild (e.g., reset)."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM attendance_records WHERE guild_id = ?', (guild_id,))
-    conn.commit()
-    conn.close()
-    write_snapshot()
+    def apply(conn):
+        conn.execute('DELETE FROM attendance_records WHERE guild_id = ?', (guild_id,))
+        record_change("replace", "attendance_records", where={"guild_id": guild_id}, rows=[])
+
+    run_write(apply, guild_id)
+    schedule_snapshot()
 
 def clear_attendance_stats(guild_id):
     """Clears all attendance stats (present/absent/excused counts) for a guild."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM attendance_stats WHERE guild_id = ?', (guild_id,))
-    conn.commit()
-    conn.close()
-    write_snapshot()
+    def apply(conn):
+        conn.execute('DELETE FROM attendance_stats WHERE guild_id = ?', (guild_id,))
+        record_change("replace", "attendance_stats", where={"guild_id": guild_id}, rows=[])
+        conn.execute('DELETE FROM attendance_archived_counts WHERE guild_id = ?', (guild_id,))
+        record_change("replace", "attendance_archived_counts", where={"guild_id": guild_id}, rows=[])
+        # rebuild_attendance_stats only counts ledger events after the latest reset marker.
+        append_event(conn, guild_id, RESET_EVENT_USER_ID, RESET_EVENT_STATUS, time.time(), source="reset")
+
+    run_write(apply, guild_id)
+    notify_stats_changed(guild_id, None)
+    schedule_snapshot()
 
 def increment_status_count(guild_id, user_id, status, count=1):
-    conn = get_connection()
-    c = conn.cursor()
     present = 0
     absent = 0
     excused = 0
@@ -406,101 +2168,665 @@ def increment_status_count(guild_id, user_id, status, count=1):
         excused = count
         column = 'excused_count'
     else:
-        conn.close()
         return
-    c.execute(
-        f'''INSERT INTO attendance_stats (guild_id, user_id, present_count, absent_count, excused_count)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(guild_id, user_id) DO UPDATE SET {column} = {column} + ?''',
-        (guild_id, user_id, present, absent, excused, count)
+
+    def apply(conn):
+        conn.execute(
+            f'''INSERT INTO attendance_stats (guild_id, user_id, present_count, absent_count, excused_count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(guild_id, user_id) DO UPDATE SET {column} = {column} + ?''',
+            (guild_id, user_id, present, absent, excused, count)
+        )
+        # Log the resulting counters rather than the increment so replays stay idempotent.
+        row = conn.execute(
+            'SELECT * FROM attendance_stats WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        ).fetchone()
+        record_change("upsert", "attendance_stats", row=dict(row))
+        return row['present_count'], _stats_version(conn, guild_id)
+
+    present_count, version = run_write(apply, guild_id)
+    notify_stats_changed(guild_id, [(int(user_id), present_count)], version)
+    schedule_snapshot()
+
+def close_session(guild_id, date, absent_user_ids, timestamp=None,
+                  reason="Auto-marked at end of attendance window", clear=True):
+    """Closes a guild's attendance session for date in one transaction.
+
+    Members in absent_user_ids without a record get an absent record and one more
+    absent_count; the session records are then cleared (unless clear=False) and
+    last_processed_date is set to date. Returns the closed session as
+    {user_id (str): record dict}, or None when date was already closed.
+    """
+    timestamp = timestamp or datetime.now().isoformat()
+
+    def apply(conn):
+        processed = conn.execute(
+            'SELECT last_processed_date FROM guild_configs WHERE guild_id = ?', (guild_id,)
+        ).fetchone()
+        if processed and processed[0] == date:
+            return None
+
+        existing = {
+            row[0] for row in conn.execute(
+                'SELECT user_id FROM attendance_records WHERE guild_id = ?', (guild_id,)
+            )
+        }
+        absent_ids = sorted({int(uid) for uid in absent_user_ids} - existing)
+        conn.executemany(
+            UPSERT_RECORD_SQL,
+            [(guild_id, uid, "absent", timestamp, None, reason) for uid in absent_ids]
+        )
+        conn.executemany(
+            '''INSERT INTO attendance_stats (guild_id, user_id, present_count, absent_count, excused_count)
+               VALUES (?, ?, 0, 1, 0)
+               ON CONFLICT(guild_id, user_id) DO UPDATE SET absent_count = absent_count + 1''',
+            [(guild_id, uid) for uid in absent_ids]
+        )
+        append_events(conn, guild_id, absent_ids, "absent", event_ts(timestamp), reason, source="auto_close")
+
+        session = {
+            str(row['user_id']): record_from_row(row)
+            for row in conn.execute('SELECT * FROM attendance_records WHERE guild_id = ?', (guild_id,))
+        }
+        update_rollups(conn, guild_id, date, {int(uid): record['status'] for uid, record in session.items()})
+        if clear:
+            conn.execute('DELETE FROM attendance_records WHERE guild_id = ?', (guild_id,))
+        if processed is None:
+            conn.execute('INSERT INTO guild_configs (guild_id) VALUES (?)', (guild_id,))
+        conn.execute(
+            'UPDATE guild_configs SET last_processed_date = ? WHERE guild_id = ?', (date, guild_id)
+        )
+
+        stats_rows = []
+        if SNAPSHOT_DELTAS_ENABLED or stats_listeners:
+            absent_set = set(absent_ids)
+            for row in conn.execute('SELECT * FROM attendance_stats WHERE guild_id = ?', (guild_id,)):
+                if row['user_id'] in absent_set:
+                    record_change("upsert", "attendance_stats", row=dict(row))
+                    stats_rows.append((row['user_id'], row['present_count']))
+        if SNAPSHOT_DELTAS_ENABLED:
+            rows = conn.execute('SELECT * FROM attendance_records WHERE guild_id = ?', (guild_id,)).fetchall()
+            record_change("replace", "attendance_records", where={"guild_id": guild_id},
+                          rows=[dict(row) for row in rows])
+            row = conn.execute('SELECT * FROM guild_configs WHERE guild_id = ?', (guild_id,)).fetchone()
+            record_change("upsert", "guild_configs", row=dict(row))
+        return session, stats_rows, _stats_version(conn, guild_id)
+
+    result = run_write(apply, guild_id)
+    if result is None:
+        return None
+    session, stats_rows, version = result
+    if stats_rows:
+        notify_stats_changed(guild_id, stats_rows, version)
+    schedule_snapshot()
+    return session
+
+# --- Rollups and streaks (maintained by close_session) ---
+
+def period_keys(day):
+    """Returns the (ISO week, month) rollup periods of a 'YYYY-MM-DD' day, e.g. ('2026-W37', '2026-09')."""
+    parsed = datetime.strptime(day, "%Y-%m-%d").date()
+    year, week, _ = parsed.isocalendar()
+    return f"{year}-W{week:02d}", parsed.strftime("%Y-%m")
+
+def next_streak(streak, status, day):
+    """Returns (current_streak, best_streak, last_day) after one closed session.
+
+    Present extends the streak, absent ends it and excused leaves it unchanged.
+    """
+    current, best, last_day = streak or (0, 0, None)
+    if last_day is not None and last_day >= day:
+        return current, best, last_day  # Already counted.
+    if status == "present":
+        current += 1
+    elif status == "absent":
+        current = 0
+    return current, max(best, current), day
+
+def update_rollups(conn, guild_id, day, statuses):
+    """Adds one closed session ({user_id: status}) to the calendar, week/month and streak tables."""
+    statuses = {uid: status for uid, status in statuses.items() if status in COUNTED_STATUSES}
+    if not statuses:
+        return
+    user_ids = set(statuses)
+
+    year, index = attendance_calendar.day_index(day)
+    calendars = {
+        row['user_id']: row['days']
+        for row in conn.execute(
+            'SELECT user_id, days FROM attendance_calendar WHERE guild_id = ? AND year = ?', (guild_id, year)
+        )
+        if row['user_id'] in user_ids
+    }
+    calendar_rows = [
+        (guild_id, uid, year, attendance_calendar.set_day(calendars.get(uid), index, status))
+        for uid, status in statuses.items()
+    ]
+    conn.executemany(
+        'INSERT OR REPLACE INTO attendance_calendar (guild_id, user_id, year, days) VALUES (?, ?, ?, ?)',
+        calendar_rows
+    )
+    periods = period_keys(day)
+    conn.executemany(
+        '''INSERT INTO attendance_rollups (guild_id, period, user_id, present_count, absent_count, excused_count)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT(guild_id, period, user_id) DO UPDATE SET
+           present_count = present_count + excluded.present_count,
+           absent_count = absent_count + excluded.absent_count,
+           excused_count = excused_count + excluded.excused_count''',
+        [
+            (guild_id, period, uid, int(status == "present"), int(status == "absent"), int(status == "excused"))
+            for period in periods
+            for uid, status in statuses.items()
+        ]
     )
-    conn.commit()
-    conn.close()
-    write_snapshot()
 
-def get_attendance_leaderboard_count(guild_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) AS total FROM attendance_stats WHERE guild_id = ?', (guild_id,))
-    row = c.fetchone()
-    conn.close()
-    return row['total'] if row else 0
+    streaks = {
+        row['user_id']: (row['current_streak'], row['best_streak'], row['last_day'])
+        for row in conn.execute('SELECT * FROM attendance_streaks WHERE guild_id = ?', (guild_id,))
+        if row['user_id'] in user_ids
+    }
+    conn.executemany(
+        'INSERT OR REPLACE INTO attendance_streaks (guild_id, user_id, current_streak, best_streak, last_day) '
+        'VALUES (?, ?, ?, ?, ?)',
+        [(guild_id, uid, *next_streak(streaks.get(uid), status, day)) for uid, status in statuses.items()]
+    )
 
+    if SNAPSHOT_DELTAS_ENABLED:
+        for guild, uid, year, days in calendar_rows:
+            record_change("upsert", "attendance_calendar", row={
+                "guild_id": guild, "user_id": uid, "year": year, "days": days,
+            })
+        for period in periods:
+            for row in conn.execute(
+                'SELECT * FROM attendance_rollups WHERE guild_id = ? AND period = ?', (guild_id, period)
+            ):
+                if row['user_id'] in user_ids:
+                    record_change("upsert", "attendance_rollups", row=dict(row))
+        for row in conn.execute('SELECT * FROM attendance_streaks WHERE guild_id = ?', (guild_id,)):
+            if row['user_id'] in user_ids:
+                record_change("upsert", "attendance_streaks", row=dict(row))
 
-def get_attendance_leaderboard(guild_id, limit=10, offset=0):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute(
-        '''SELECT user_id, present_count, absent_count, excused_count
-           FROM attendance_stats
-           WHERE guild_id = ?
-           ORDER BY present_count DESC, user_id ASC
-           LIMIT ? OFFSET ?''',
-        (guild_id, limit, offset)
+def get_calendar(guild_id, user_id, year):
+    """Returns a member's attendance_calendar BLOB for a year, or None without closed sessions."""
+    with read_connection(guild_id) as conn:
+        row = conn.execute(
+            'SELECT days FROM attendance_calendar WHERE guild_id = ? AND user_id = ? AND year = ?',
+            (guild_id, user_id, year)
+        ).fetchone()
+    return row[0] if row else None
+
+def get_guild_calendars(guild_id, year):
+    """Returns {user_id: attendance_calendar BLOB} for every member of a guild with sessions that year."""
+    with read_connection(guild_id) as conn:
+        return dict(conn.execute(
+            'SELECT user_id, days FROM attendance_calendar WHERE guild_id = ? AND year = ?', (guild_id, year)
+        ))
+
+def get_member_stats(guild_id, user_id, period):
+    """Returns a member's counts, attendance rate and streaks for a rollup period ('YYYY-MM' or 'YYYY-Www')."""
+    with read_connection(guild_id) as conn:
+        rollup = conn.execute(
+            '''SELECT present_count, absent_count, excused_count FROM attendance_rollups
+               WHERE guild_id = ? AND period = ? AND user_id = ?''',
+            (guild_id, period, user_id)
+        ).fetchone()
+        streak = conn.execute(
+            'SELECT current_streak, best_streak, last_day FROM attendance_streaks WHERE guild_id = ? AND user_id = ?',
+            (guild_id, user_id)
+        ).fetchone()
+    return member_stats(period, dict(rollup) if rollup else None, dict(streak) if streak else None)
+
+def member_stats(period, rollup, streak):
+    """Builds get_member_stats()'s result from a rollup row and a streak row (either may be None)."""
+    present, absent, excused = (
+        (rollup['present_count'], rollup['absent_count'], rollup['excused_count']) if rollup else (0, 0, 0)
     )
-    rows = c.fetchall()
-    conn.close()
+    sessions = present + absent + excused
+    return {
+        "period": period,
+        "present": present,
+        "absent": absent,
+        "excused": excused,
+        "sessions": sessions,
+        "rate": round(100 * present / sessions, 1) if sessions else None,
+        "current_streak": streak['current_streak'] if streak else 0,
+        "best_streak": streak['best_streak'] if streak else 0,
+        "last_day": streak['last_day'] if streak else None,
+    }
+
+def get_period_leaderboard(guild_id, period, limit=10, offset=0):
+    """Returns (ranked member count, rows ordered by present_count DESC, user_id ASC) for a period."""
+    with read_connection(guild_id) as conn:
+        total = conn.execute(
+            'SELECT COUNT(*) FROM attendance_rollups WHERE guild_id = ? AND period = ?', (guild_id, period)
+        ).fetchone()[0]
+        rows = conn.execute(
+            '''SELECT user_id, present_count, absent_count, excused_count
+               FROM attendance_rollups
+               WHERE guild_id = ? AND period = ?
+               ORDER BY present_count DESC, user_id ASC
+               LIMIT ? OFFSET ?''',
+            (guild_id, period, limit, offset)
+        ).fetchall()
+    return total, [dict(row) for row in rows]
+
+def get_leaderboard_state(guild_id):
+    """Returns {"members": ranked member count, "version": changes on every stats write}."""
+    with read_connection(guild_id) as conn:
+        row = conn.execute(
+            'SELECT member_count, version FROM leaderboard_counts WHERE guild_id = ?', (guild_id,)
+        ).fetchone()
+    if not row:
+        return {"members": 0, "version": 0}
+    return {"members": row['member_count'], "version": row['version']}
+
+
+def get_attendance_leaderboard_count(guild_id):
+    return get_leaderboard_state(guild_id)["members"]
+
+
+def get_present_counts(guild_id=None):
+    """Returns [(guild_id, user_id, present_count)] for one guild, or every guild on every shard."""
+    if guild_id is not None:
+        with read_connection(guild_id) as conn:
+            return [tuple(row) for row in conn.execute(
+                'SELECT guild_id, user_id, present_count FROM attendance_stats WHERE guild_id = ?', (guild_id,)
+            )]
+    rows = []
+    for manager in shard_managers():
+        with manager.reader() as conn:
+            rows.extend(tuple(row) for row in conn.execute(
+                'SELECT guild_id, user_id, present_count FROM attendance_stats'
+            ))
     return rows
 
 
+def get_attendance_leaderboard(guild_id, limit=10, offset=0, after=None):
+    """Returns stats rows ordered by present_count DESC, user_id ASC.
+
+    Pass after=(present_count, user_id) of the last row already shown to seek straight to
+    the next page on idx_stats_leaderboard; offset is only used without it.
+    """
+    with read_connection(guild_id) as conn:
+        if after is not None:
+            present_count, user_id = after
+            return conn.execute(
+                '''SELECT user_id, present_count, absent_count, excused_count
+                   FROM attendance_stats
+                   WHERE guild_id = ? AND present_count <= ?
+                     AND (present_count < ? OR user_id > ?)
+                   ORDER BY present_count DESC, user_id ASC
+                   LIMIT ?''',
+                (guild_id, present_count, present_count, user_id, limit)
+            ).fetchall()
+        return conn.execute(
+            '''SELECT user_id, present_count, absent_count, excused_count
+               FROM attendance_stats
+               WHERE guild_id = ?
+               ORDER BY present_count DESC, user_id ASC
+               LIMIT ? OFFSET ?''',
+            (guild_id, limit, offset)
+        ).fetchall()
+
+
 def get_custom_commands(guild_id):
     """Returns all custom commands for a guild keyed by normalized command name."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute(
-        '''SELECT command_name, response_text
-           FROM custom_commands
-           WHERE guild_id = ?
-           ORDER BY command_name ASC''',
-        (guild_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
+    with read_connection(guild_id) as conn:
+        rows = conn.execute(
+            '''SELECT command_name, response_text
+               FROM custom_commands
+               WHERE guild_id = ?
+               ORDER BY command_name ASC''',
+            (guild_id,)
+        ).fetchall()
     return {row['command_name']: row['response_text'] for row in rows}
 
 
 def get_custom_command(guild_id, command_name):
     """Returns the response text for one custom command."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute(
-        '''SELECT response_text
-           FROM custom_commands
-           WHERE guild_id = ? AND command_name = ?''',
-        (guild_id, command_name)
-    )
-    row = c.fetchone()
-    conn.close()
+    with read_connection(guild_id) as conn:
+        row = conn.execute(
+            '''SELECT response_text
+               FROM custom_commands
+               WHERE guild_id = ? AND command_name = ?''',
+            (guild_id, command_name)
+        ).fetchone()
     return row['response_text'] if row else None
 
 
 def upsert_custom_command(guild_id, command_name, response_text):
     """Creates or updates a custom command for a guild."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute(
-        '''INSERT INTO custom_commands (guild_id, command_name, response_text)
-           VALUES (?, ?, ?)
-           ON CONFLICT(guild_id, command_name) DO UPDATE SET
-           response_text = excluded.response_text''',
-        (guild_id, command_name, response_text)
-    )
-    conn.commit()
-    conn.close()
-    write_snapshot()
+    def apply(conn):
+        conn.execute(
+            '''INSERT INTO custom_commands (guild_id, command_name, response_text)
+               VALUES (?, ?, ?)
+               ON CONFLICT(guild_id, command_name) DO UPDATE SET
+               response_text = excluded.response_text''',
+            (guild_id, command_name, response_text)
+        )
+        record_change(
+            "upsert", "custom_commands",
+            row={"guild_id": guild_id, "command_name": command_name, "response_text": response_text}
+        )
+
+    run_write(apply, guild_id)
+    schedule_snapshot()
 
 
 def delete_custom_command(guild_id, command_name):
     """Deletes a custom command and returns whether a row was removed."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute(
-        'DELETE FROM custom_commands WHERE guild_id = ? AND command_name = ?',
-        (guild_id, command_name)
-    )
-    deleted = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    def apply(conn):
+        c = conn.execute(
+            'DELETE FROM custom_commands WHERE guild_id = ? AND command_name = ?',
+            (guild_id, command_name)
+        )
+        deleted = c.rowcount > 0
+        if deleted:
+            record_change(
+                "replace", "custom_commands",
+                where={"guild_id": guild_id, "command_name": command_name}, rows=[]
+            )
+        return deleted
+
+    deleted = run_write(apply, guild_id)
     if deleted:
-        write_snapshot()
+        schedule_snapshot()
     return deleted
+
+
+# --- Maintenance ---
+
+# Tables whose old rows retention may delete, with the condition selecting them; the named
+# parameters come from retention_cutoffs(). Ledger events are handled by _retire_events().
+RETENTION_RULES = {
+    "attendance_records": "timestamp IS NOT NULL AND timestamp < :timestamp",
+    # Weeks ('YYYY-Www') and months ('YYYY-MM') share the column but do not sort together.
+    "attendance_rollups": "CASE WHEN period LIKE '%-W%' THEN period < :week ELSE period < :month END",
+    "attendance_calendar": "year < :year",
+}
+
+
+def retention_cutoffs(cutoff):
+    """Returns the RETENTION_RULES parameters for a cutoff datetime: rows, events, rollup
+    periods and calendar years that ended before it."""
+    year, week, _ = cutoff.isocalendar()
+    return {
+        "timestamp": cutoff.isoformat(),
+        "ts": int(cutoff.timestamp()),
+        "week": f"{year}-W{week:02d}",
+        "month": cutoff.strftime("%Y-%m"),
+        "year": cutoff.year,
+    }
+
+
+@contextmanager
+def _timed_write(manager):
+    """Yields (conn, timing); timing["writer_ms"] is how long the writer was held."""
+    timing = {}
+    started = None
+    try:
+        with manager.writer() as conn:
+            started = time.perf_counter()
+            yield conn, timing
+    finally:
+        held = time.perf_counter() - started if started is not None else 0
+        timing["writer_ms"] = round(held * 1000, 2)
+
+
+def _maintenance_pause():
+    if MAINTENANCE_STEP_PAUSE_MS > 0:
+        time.sleep(MAINTENANCE_STEP_PAUSE_MS / 1000)
+
+
+def apply_retention(guild_id, cutoff):
+    """Deletes a guild's rows older than cutoff (a datetime) in small batches; returns step reports.
+
+    Deleted ledger events keep their counts in attendance_archived_counts, like archived ones,
+    so rebuild_attendance_stats is unaffected. With archiving on, events are left to
+    archive_closed_months, so none is deleted before it has been written to the archive.
+    """
+    manager = guild_manager(guild_id)
+    batch_rows = max(1, MAINTENANCE_BATCH_ROWS)
+    params = retention_cutoffs(cutoff)
+    steps = []
+    table_names = tuple(RETENTION_RULES) if ARCHIVE_ENABLED else ("attendance_events",) + tuple(RETENTION_RULES)
+    for table_name in table_names:
+        deleted = 0
+        batches = 0
+        max_writer_ms = 0.0
+        while True:
+            with _timed_write(manager) as (conn, timing):
+                if table_name == "attendance_events":
+                    count = _retire_events(conn, guild_id, params["ts"], batch_rows)
+                else:
+                    # WITHOUT ROWID tables (attendance_calendar) are matched on their key instead.
+                    key = "rowid" if table_name != "attendance_calendar" else "guild_id, user_id, year"
+                    count = conn.execute(
+                        f'''DELETE FROM {table_name} WHERE ({key}) IN (
+                               SELECT {key} FROM {table_name}
+                               WHERE guild_id = :guild_id AND ({RETENTION_RULES[table_name]})
+                               LIMIT :limit)''',
+                        dict(params, guild_id=guild_id, limit=batch_rows)
+                    ).rowcount
+            deleted += count
+            batches += 1
+            max_writer_ms = max(max_writer_ms, timing["writer_ms"])
+            if count < batch_rows:
+                break
+            _maintenance_pause()
+        steps.append({
+            "step": "retention", "guild_id": guild_id, "table": table_name,
+            "rows": deleted, "batches": batches, "max_writer_ms": max_writer_ms,
+        })
+    return steps
+
+
+def incremental_vacuum(manager):
+    """Returns free pages to the filesystem a few at a time; returns a step report."""
+    with manager.reader() as conn:
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    report = {"step": "incremental_vacuum", "file": manager.db_file, "free_pages": free_pages}
+
+    if auto_vacuum != 2:
+        if not MAINTENANCE_CONVERT_VACUUM:
+            report["skipped"] = "auto_vacuum is not INCREMENTAL (set DB_MAINTENANCE_CONVERT_VACUUM=1 to convert)"
+            return report
+        with _timed_write(manager) as (conn, timing):
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.executescript("VACUUM;")
+        report.update(converted=True, max_writer_ms=timing["writer_ms"], pages=free_pages, steps=1)
+        return report
+
+    freed = 0
+    steps = 0
+    max_writer_ms = 0.0
+    pages_per_step = max(1, MAINTENANCE_VACUUM_PAGES)
+    while free_pages > 0 and steps < max(1, MAINTENANCE_MAX_VACUUM_STEPS):
+        with _timed_write(manager) as (conn, timing):
+            # executescript steps the pragma to completion; execute() would free one page.
+            conn.executescript(f"PRAGMA incremental_vacuum({pages_per_step});")
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        freed += free_pages - remaining
+        free_pages = remaining
+        steps += 1
+        max_writer_ms = max(max_writer_ms, timing["writer_ms"])
+        _maintenance_pause()
+    report.update(pages=freed, steps=steps, max_writer_ms=max_writer_ms, free_pages=free_pages)
+    return report
+
+
+def optimize_statistics(manager):
+    """Refreshes planner statistics (full ANALYZE the first time, PRAGMA optimize after); returns a step report."""
+    with _timed_write(manager) as (conn, timing):
+        analyzed = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        ).fetchone()
+        if analyzed:
+            conn.execute("PRAGMA analysis_limit = 400")
+            conn.execute("PRAGMA optimize").fetchall()
+        else:
+            conn.execute("ANALYZE")
+    return {
+        "step": "optimize" if analyzed else "analyze",
+        "file": manager.db_file,
+        "max_writer_ms": timing["writer_ms"],
+    }
+
+
+def archive_cutoff(keep_months=None, now=None):
+    """Returns the epoch start of the oldest month that stays live (keep_months closed months back)."""
+    keep_months = ARCHIVE_KEEP_MONTHS if keep_months is None else keep_months
+    current = attendance_archive.month_key(now if now is not None else time.time())
+    year, month = map(int, current.split("-"))
+    month -= max(0, keep_months)
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return attendance_archive.month_bounds(f"{year:04d}-{month:02d}")[0]
+
+
+def write_archive_month(guild_id, month, rows):
+    """Writes (user_id, status, reason, ts, source, id) rows to the month's archive file, merged
+    with any earlier file for it by event id. Returns (path, rows in the file)."""
+    path = attendance_archive.archive_path(ARCHIVE_DIR, guild_id, month)
+    archived = {}
+    if path.exists():
+        # Left by an interrupted run, or written before late events for the month arrived.
+        archived = {row[5]: row for row in attendance_archive.read_rows(path)}
+    for row in rows:
+        archived[row[5]] = row
+    attendance_archive.write_month(ARCHIVE_DIR, guild_id, month, list(archived.values()))
+    return path, len(archived)
+
+
+def archive_closed_months(guild_id, keep_months=None, now=None):
+    """Moves a guild's ledger events from closed months into attendance_archive files.
+
+    Every month before the current one and its keep_months predecessors is written to
+    ARCHIVE_DIR (merged with any earlier file for that month) and then deleted in batches of
+    MAINTENANCE_BATCH_ROWS, oldest first. Each batch also adds its counted events to
+    attendance_archived_counts, unless a later stats reset makes them irrelevant, so
+    rebuild_attendance_stats still sees them. Returns one step report per month.
+    """
+    cutoff = archive_cutoff(keep_months, now)
+    manager = guild_manager(guild_id)
+    batch_rows = max(1, MAINTENANCE_BATCH_ROWS)
+    steps = []
+    start = 0
+    while True:
+        with read_connection(guild_id) as conn:
+            oldest = conn.execute(
+                'SELECT MIN(ts) FROM attendance_events WHERE guild_id = ? AND ts >= ? AND ts < ?',
+                (guild_id, start, cutoff)
+            ).fetchone()[0]
+        if oldest is None:
+            break
+        month_key = attendance_archive.month_key(oldest)
+        start, end = attendance_archive.month_bounds(month_key)
+        with read_connection(guild_id) as conn:
+            rows = conn.execute(
+                '''SELECT id, user_id, status, reason, ts, source FROM attendance_events
+                   WHERE guild_id = ? AND ts >= ? AND ts < ? ORDER BY id''',
+                (guild_id, start, end)
+            ).fetchall()
+        path, archived = write_archive_month(guild_id, month_key, [tuple(row)[1:] + (row['id'],) for row in rows])
+
+        deleted = 0
+        batches = 0
+        max_writer_ms = 0.0
+        for first in range(0, len(rows), batch_rows):
+            batch = rows[first:first + batch_rows]
+            with _timed_write(manager) as (conn, timing):
+                _archive_batch(conn, guild_id, batch)
+            deleted += len(batch)
+            batches += 1
+            max_writer_ms = max(max_writer_ms, timing["writer_ms"])
+            _maintenance_pause()
+        steps.append({
+            "step": "archive", "guild_id": guild_id, "month": month_key, "file": str(path),
+            "rows": deleted, "archived_rows": archived, "batches": batches, "max_writer_ms": max_writer_ms,
+        })
+        start = end
+    return steps
+
+
+def _retire_events(conn, guild_id, cutoff_ts, limit):
+    """Deletes up to limit of a guild's ledger events with ts < cutoff_ts, oldest first; returns how many."""
+    batch = conn.execute(
+        '''SELECT id, user_id, status FROM attendance_events
+           WHERE guild_id = ? AND ts < ? ORDER BY id LIMIT ?''',
+        (guild_id, cutoff_ts, limit)
+    ).fetchall()
+    _archive_batch(conn, guild_id, batch)
+    return len(batch)
+
+
+def _archive_batch(conn, guild_id, batch):
+    """Deletes one batch of archived events (ordered by id) and keeps their counts for rebuilds."""
+    # Events older than the latest stats reset no longer count towards anything.
+    reset_id = conn.execute(
+        'SELECT MAX(id) FROM attendance_events WHERE guild_id = ? AND user_id = ? AND status = ?',
+        (guild_id, RESET_EVENT_USER_ID, RESET_EVENT_STATUS)
+    ).fetchone()[0] or 0
+    counts = {}
+    for row in batch:
+        if row['user_id'] == RESET_EVENT_USER_ID and row['status'] == RESET_EVENT_STATUS:
+            conn.execute('DELETE FROM attendance_archived_counts WHERE guild_id = ?', (guild_id,))
+            counts.clear()
+        elif row['status'] in COUNTED_STATUSES and row['id'] > reset_id:
+            user_counts = counts.setdefault(row['user_id'], [0, 0, 0])
+            user_counts[COUNTED_STATUSES.index(row['status'])] += 1
+    conn.executemany(
+        '''INSERT INTO attendance_archived_counts (guild_id, user_id, present_count, absent_count, excused_count)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(guild_id, user_id) DO UPDATE SET
+           present_count = present_count + excluded.present_count,
+           absent_count = absent_count + excluded.absent_count,
+           excused_count = excused_count + excluded.excused_count''',
+        [(guild_id, user_id, *user_counts) for user_id, user_counts in counts.items()]
+    )
+    conn.executemany('DELETE FROM attendance_events WHERE id = ?', [(row['id'],) for row in batch])
+
+
+def run_maintenance(guild_ids, retention_days=None):
+    """Runs retention (and archival, when enabled) for the given (off-window) guilds, then
+    vacuum and statistics for every shard whose guilds are all among them. Returns
+    {"steps": [...], "duration_seconds": ...}.
+    """
+    started = time.time()
+    guild_ids = set(guild_ids)
+    retention_days = RETENTION_DAYS if retention_days is None else retention_days
+    steps = []
+
+    if retention_days > 0:
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        for guild_id in sorted(guild_ids):
+            steps.extend(apply_retention(guild_id, cutoff))
+
+    if ARCHIVE_ENABLED:
+        for guild_id in sorted(guild_ids):
+            try:
+                steps.extend(archive_closed_months(guild_id))
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Archiving guild %s failed: %s", guild_id, e)
+                steps.append({"step": "error", "guild_id": guild_id, "error": str(e)})
+
+    for manager in shard_managers():
+        with manager.reader() as conn:
+            shard_guilds = {row[0] for row in conn.execute("SELECT guild_id FROM guild_configs")}
+        # Shared files are only touched once every guild stored in them is outside its window.
+        if not shard_guilds or not shard_guilds <= guild_ids:
+            continue
+        try:
+            steps.append(incremental_vacuum(manager))
+            steps.append(optimize_statistics(manager))
+        except sqlite3.Error as e:
+            logger.warning("Maintenance of %s failed: %s", manager.db_file, e)
+            steps.append({"step": "error", "file": manager.db_file, "error": str(e)})
+
+    if SNAPSHOT_DELTAS_ENABLED and any(step.get("rows") for step in steps if step["step"] in ("retention", "archive")):
+        # Retention and archive deletes are not in the delta log; fold them into a new base right away.
+        write_snapshot()
+
+    return {"steps": steps, "duration_seconds": round(time.time() - started, 3)}
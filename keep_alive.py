@@ -4,6 +4,9 @@ from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
 
+import replication
+import storage
+
 
 class _HealthHandler(BaseHTTPRequestHandler):
     def _platform_name(self):
@@ -40,6 +43,8 @@ class _HealthHandler(BaseHTTPRequestHandler):
         payload = self._health_payload()
         if self.path == "/readyz":
             payload["token_configured"] = bool(os.getenv("DISCORD_TOKEN"))
+            payload.update(storage.backend.snapshot_status())
+            payload.update(replication.status())
 
         self._send_json(payload)
 
@@ -1,101 +1,217 @@
-import os
+"""Loads the legacy per-guild JSON files (data/<guild_id>.json) into the database.
+
+Files are parsed in a process pool while the main process loads each parsed guild in one
+transaction (one executemany for its records). The snapshot is written once at the end.
+Finished guilds are appended to a progress file, so an interrupted run picks up where it
+stopped; a guild file that changed since it was loaded is loaded again.
+"""
+import argparse
 import json
-import sqlite3
-from database import init_db, update_guild_config, add_or_update_record, DB_FILE
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import database
 
 DATA_DIR = "data"
+PROGRESS_FILE = str(Path(database.DB_FILE).with_name("migrate_to_db.progress.jsonl"))
+
+# guild_configs columns filled from the top level of a guild file and from its "settings".
+TOP_LEVEL_FIELDS = (
+    "attendance_role_id", "absent_role_id", "excused_role_id", "welcome_channel_id",
+    "report_channel_id", "last_report_message_id", "last_report_channel_id",
+)
+SETTINGS_DEFAULTS = {
+    "attendance_mode": "duration",
+    "attendance_expiry_hours": 12,
+    "window_start_time": "08:00",
+    "window_end_time": "17:00",
+    "last_processed_date": None,
+    "last_opened_date": None,  # Might be missing in some JSONs
+    "allow_self_marking": True,
+    "require_admin_excuse": False,
+    "auto_nick_on_join": False,
+    "enforce_suffix": False,
+    "remove_suffix_on_role_loss": False,
+    "suffix_format": " [𝙼𝚂𝚄𝚊𝚗]",
+}
+CONFIG_COLUMNS = TOP_LEVEL_FIELDS + tuple(SETTINGS_DEFAULTS)
+UPSERT_CONFIG_SQL = (
+    f"INSERT INTO guild_configs (guild_id, {', '.join(CONFIG_COLUMNS)}) "
+    f"VALUES (?, {', '.join('?' for _ in CONFIG_COLUMNS)}) "
+    f"ON CONFLICT(guild_id) DO UPDATE SET {', '.join(f'{name} = excluded.{name}' for name in CONFIG_COLUMNS)}"
+)
+
+
+def file_key(path):
+    """Identifies one version of a guild file: (name, size, mtime_ns)."""
+    stat = path.stat()
+    return path.name, stat.st_size, stat.st_mtime_ns
 
-def migrate():
-    print("Initializing database...")
-    init_db()
-    
-    if not os.path.exists(DATA_DIR):
-        print("No data directory found. Skipping migration.")
-        return
 
-    files = [f for f in os.listdir(DATA_DIR) if f.endswith('.json')]
-    print(f"Found {len(files)} guild data files to migrate.")
+def parse_guild_file(path):
+    """Reads a guild file into {guild_id, config, records, skipped} (runs in a worker process).
 
-    for filename in files:
-        guild_id_str = filename.replace('.json', '')
+    records holds (guild_id, user_id, status, timestamp, channel_id, reason) tuples ready
+    for UPSERT_RECORD_SQL; skipped counts records whose user id is not a number.
+    """
+    guild_id = int(path.stem)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    settings = data.get("settings", {})
+    config = [data.get(name) for name in TOP_LEVEL_FIELDS]
+    config += [settings.get(name, default) for name, default in SETTINGS_DEFAULTS.items()]
+
+    records = []
+    skipped = 0
+    for user_id, record in data.get("records", {}).items():
         try:
-            guild_id = int(guild_id_str)
+            user_id = int(user_id)
         except ValueError:
-            print(f"Skipping invalid filename: {filename}")
+            skipped += 1
             continue
-            
-        filepath = os.path.join(DATA_DIR, filename)
-        print(f"Migrating guild {guild_id} from {filepath}...")
-        
-        try:
-            with open(filepath, 'r') as f:
-                data = json.load(f)
-        except Exception as e:
-            print(f"Error reading {filename}: {e}")
-            continue
-            
-        # 1. Migrate Settings & Config
-        settings = data.get('settings', {})
-        
-        config_update = {
-            "attendance_role_id": data.get('attendance_role_id'),
-            "absent_role_id": data.get('absent_role_id'),
-            "excused_role_id": data.get('excused_role_id'),
-            "welcome_channel_id": data.get('welcome_channel_id'),
-            "report_channel_id": data.get('report_channel_id'),
-            "last_report_message_id": data.get('last_report_message_id'),
-            "last_report_channel_id": data.get('last_report_channel_id'),
-            
-            # Flatten settings
-            "attendance_mode": settings.get('attendance_mode', 'duration'),
-            "attendance_expiry_hours": settings.get('attendance_expiry_hours', 12),
-            "window_start_time": settings.get('window_start_time', '08:00'),
-            "window_end_time": settings.get('window_end_time', '17:00'),
-            "last_processed_date": settings.get('last_processed_date'),
-            "last_opened_date": settings.get('last_opened_date'), # Might be missing in some JSONs
-            "allow_self_marking": settings.get('allow_self_marking', True),
-            "require_admin_excuse": settings.get('require_admin_excuse', False),
-            "auto_nick_on_join": settings.get('auto_nick_on_join', False),
-            "enforce_suffix": settings.get('enforce_suffix', False),
-            "remove_suffix_on_role_loss": settings.get('remove_suffix_on_role_loss', False),
-            "suffix_format": settings.get('suffix_format', ' [𝙼𝚂𝚄𝚊𝚗]')
-        }
-        
-        # Filter out None values to let DB defaults apply? 
-        # Actually update_guild_config will handle it. 
-        # But if key is missing in JSON, we might want to preserve DB default if it's a new row.
-        # But here we are creating the row.
-        
-        update_guild_config(guild_id, **config_update)
-        
-        # 2. Migrate Records
-        records = data.get('records', {})
-        count = 0
-        for user_id_str, record in records.items():
-            try:
-                user_id = int(user_id_str)
-                # Handle different record formats if any (old string format vs new dict)
-                if isinstance(record, str):
-                     # Legacy format: just timestamp? or "present"?
-                     # Code says: info = {"status": "present", "timestamp": info, "channel_id": None}
-                     status = "present"
-                     timestamp = record
-                     channel_id = None
-                     reason = None
-                else:
-                    status = record.get('status', 'present')
-                    timestamp = record.get('timestamp')
-                    channel_id = record.get('channel_id')
-                    reason = record.get('reason')
-                
-                add_or_update_record(guild_id, user_id, status, timestamp, channel_id, reason)
-                count += 1
-            except Exception as e:
-                print(f"Failed to migrate record for user {user_id_str}: {e}")
-        
-        print(f"  - Migrated {count} records.")
-
-    print("Migration complete.")
+        if isinstance(record, str):
+            # Legacy format: the value is the check-in timestamp of a present member.
+            records.append((guild_id, user_id, "present", record, None, None))
+        else:
+            records.append((
+                guild_id, user_id, record.get("status", "present"), record.get("timestamp"),
+                record.get("channel_id"), record.get("reason"),
+            ))
+    return {"guild_id": guild_id, "config": config, "records": records, "skipped": skipped}
+
+
+def parse_task(path):
+    try:
+        return path, parse_guild_file(path), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def load_guild(parsed):
+    """Writes one parsed guild (config and every record) in a single transaction."""
+    guild_id = parsed["guild_id"]
+    # Rows bypass the delta log; the snapshot written at the end of the run covers them.
+    with database.write_connection(guild_id) as conn:
+        conn.execute(UPSERT_CONFIG_SQL, [guild_id] + parsed["config"])
+        conn.executemany(database.UPSERT_RECORD_SQL, parsed["records"])
+
+
+def read_progress(progress_file):
+    """Returns the (name, size, mtime_ns) keys of guild files already loaded."""
+    done = set()
+    try:
+        with open(progress_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    done.add((entry["file"], entry["size"], entry["mtime_ns"]))
+                except (ValueError, KeyError):
+                    continue  # a line cut short by a crash
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def parsed_in_order(paths, workers):
+    """Yields parse_task results in file order, keeping at most 2 * workers parses in flight."""
+    if workers <= 1:
+        yield from map(parse_task, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(parse_task, path))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_final_snapshot():
+    if database.SNAPSHOT_MODE == "backup":
+        return database.sync_snapshot()
+    return database.write_snapshot()
+
+
+def migrate(data_dir=DATA_DIR, workers=None, progress_file=PROGRESS_FILE, restart=False):
+    print("Initializing database...")
+    database.init_db()
+
+    data_dir = Path(data_dir)
+    if not data_dir.is_dir():
+        print("No data directory found. Skipping migration.")
+        return True
+
+    paths = []
+    for path in sorted(data_dir.glob("*.json")):
+        if path.stem.isdigit():
+            paths.append(path)
+        else:
+            print(f"Skipping invalid filename: {path.name}")
+
+    if restart:
+        Path(progress_file).unlink(missing_ok=True)
+    done = read_progress(progress_file)
+    todo = [path for path in paths if file_key(path) not in done]
+    print(f"Found {len(paths)} guild data files; {len(paths) - len(todo)} already migrated, {len(todo)} to go.")
+
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    loaded = failed = total_records = 0
+    database.ensure_parent_directory(progress_file)
+    with open(progress_file, "a", encoding="utf-8") as progress:
+        for index, (path, parsed, error) in enumerate(parsed_in_order(todo, workers), start=1):
+            if error is None:
+                try:
+                    load_guild(parsed)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+            if error is not None:
+                failed += 1
+                print(f"[{index}/{len(todo)}] Error migrating {path.name}: {error}")
+                continue
+
+            name, size, mtime_ns = file_key(path)
+            progress.write(json.dumps({
+                "file": name, "size": size, "mtime_ns": mtime_ns,
+                "guild_id": parsed["guild_id"], "records": len(parsed["records"]),
+            }) + "\n")
+            progress.flush()
+            loaded += 1
+            total_records += len(parsed["records"])
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            skipped = f", skipped {parsed['skipped']} invalid" if parsed["skipped"] else ""
+            print(
+                f"[{index}/{len(todo)}] Guild {parsed['guild_id']}: {len(parsed['records'])} records{skipped} "
+                f"({loaded / elapsed:.1f} guilds/s, {total_records / elapsed:.0f} records/s)"
+            )
+
+    if loaded or done:
+        print("Writing snapshot...")
+        write_final_snapshot()
+    database.close_connections()
+    elapsed = time.perf_counter() - started
+    print(f"Migration complete: {loaded} guild(s), {total_records} records in {elapsed:.1f}s ({failed} failed).")
+    if failed:
+        print("Fix the failed files and run again; migrated guilds are skipped.")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load legacy per-guild JSON files into the database.")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="directory holding <guild_id>.json files")
+    parser.add_argument("--workers", type=int, help="parser processes (default: one per CPU; 1 parses in this process)")
+    parser.add_argument("--progress-file", default=PROGRESS_FILE, help="where finished guilds are recorded")
+    parser.add_argument("--restart", action="store_true", help="forget earlier progress and load every file again")
+    args = parser.parse_args()
+    ok = migrate(args.data_dir, args.workers, args.progress_file, args.restart)
+    sys.exit(0 if ok else 1)
+
 
 if __name__ == "__main__":
-    migrate()
+    main()
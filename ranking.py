@@ -0,0 +1,185 @@
+"""In-memory rank index over attendance_stats.present_count, one per guild.
+
+Ranks follow the leaderboard order (present_count DESC, user_id ASC). Each guild keeps a
+Fenwick tree counting members per present_count plus, for every count, the sorted user ids
+that share it, so rank and "who is at rank N" are O(log n) lookups that never touch SQLite.
+The index is filled by rebuild() on startup and kept current by storage.add_stats_listener.
+"""
+import bisect
+import logging
+import threading
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+class FenwickTree:
+    """Prefix sums over positions 1..size that grow on demand."""
+
+    def __init__(self, size=64):
+        self.size = 1
+        while self.size < size:
+            self.size *= 2
+        self.tree = [0] * (self.size + 1)
+
+    def add(self, position, delta):
+        while position <= self.size:
+            self.tree[position] += delta
+            position += position & -position
+
+    def prefix(self, position):
+        """Sum of positions 1..position."""
+        position = min(position, self.size)
+        total = 0
+        while position > 0:
+            total += self.tree[position]
+            position -= position & -position
+        return total
+
+    def find(self, k):
+        """Smallest position whose prefix sum reaches k (k >= 1)."""
+        position = 0
+        step = self.size
+        while step:
+            nxt = position + step
+            if nxt <= self.size and self.tree[nxt] < k:
+                position = nxt
+                k -= self.tree[nxt]
+            step //= 2
+        return position + 1
+
+
+class GuildRanking:
+    """Order-statistic index of one guild's members by present_count."""
+
+    def __init__(self, rows=()):
+        self.counts = {}
+        self.versions = {}
+        self.buckets = {}
+        rows = list(rows)
+        for user_id, present_count in rows:
+            self.counts[user_id] = present_count or 0
+        for user_id in sorted(self.counts):
+            self.buckets.setdefault(self.counts[user_id], []).append(user_id)
+        self.tree = FenwickTree(max(self.buckets, default=0) + 2)
+        for present_count, users in self.buckets.items():
+            self.tree.add(present_count + 1, len(users))
+
+    @property
+    def total(self):
+        return len(self.counts)
+
+    def _grow(self, present_count):
+        if present_count + 1 <= self.tree.size:
+            return
+        self.tree = FenwickTree(present_count + 2)
+        for count, users in self.buckets.items():
+            self.tree.add(count + 1, len(users))
+
+    def update(self, user_id, present_count, version=None):
+        """Sets a member's present_count; skips updates older than the last one applied."""
+        if version is not None:
+            if version < self.versions.get(user_id, 0):
+                return
+            self.versions[user_id] = version
+        present_count = present_count or 0
+        old = self.counts.get(user_id)
+        if old == present_count:
+            return
+        if old is not None:
+            bucket = self.buckets[old]
+            bucket.pop(bisect.bisect_left(bucket, user_id))
+            if not bucket:
+                del self.buckets[old]
+            self.tree.add(old + 1, -1)
+        self._grow(present_count)
+        self.counts[user_id] = present_count
+        bisect.insort(self.buckets.setdefault(present_count, []), user_id)
+        self.tree.add(present_count + 1, 1)
+
+    def rank(self, user_id):
+        """Returns the member's 1-based leaderboard rank, or None if they have no stats."""
+        present_count = self.counts.get(user_id)
+        if present_count is None:
+            return None
+        above = self.total - self.tree.prefix(present_count + 1)
+        return above + bisect.bisect_left(self.buckets[present_count], user_id) + 1
+
+    def entry_at(self, rank):
+        """Returns (user_id, present_count) at a 1-based rank, or None when out of range."""
+        if rank < 1 or rank > self.total:
+            return None
+        present_count = self.tree.find(self.total - rank + 1) - 1
+        above = self.total - self.tree.prefix(present_count + 1)
+        return self.buckets[present_count][rank - above - 1], present_count
+
+
+_guilds = {}
+_lock = threading.RLock()
+
+
+def _guild(guild_id):
+    ranking = _guilds.get(guild_id)
+    if ranking is None:
+        # Not loaded yet (or dropped after a bulk replace): read this guild's counts once.
+        rows = storage.backend.get_present_counts(guild_id)
+        ranking = _guilds[guild_id] = GuildRanking((user_id, count) for _, user_id, count in rows)
+    return ranking
+
+
+def rebuild():
+    """Reloads every guild's index from the stats table (called on startup)."""
+    by_guild = {}
+    for guild_id, user_id, present_count in storage.backend.get_present_counts():
+        by_guild.setdefault(guild_id, []).append((user_id, present_count))
+    with _lock:
+        _guilds.clear()
+        for guild_id, rows in by_guild.items():
+            _guilds[guild_id] = GuildRanking(rows)
+    logger.info("Rank index rebuilt for %s guild(s).", len(by_guild))
+
+
+def on_stats_changed(guild_id, rows, version=None):
+    """Stats listener: applies committed present_count changes."""
+    with _lock:
+        if rows is None:
+            if guild_id is None:
+                _guilds.clear()
+            else:
+                _guilds.pop(int(guild_id), None)
+            return
+        ranking = _guilds.get(int(guild_id))
+        if ranking is None:
+            return  # Loaded from the table (including this change) on first lookup.
+        for user_id, present_count in rows:
+            ranking.update(int(user_id), present_count, version)
+
+
+def get_rank(guild_id, user_id, neighbours=2):
+    """Returns the member's rank, percentile and nearby members, or None without stats.
+
+    The result is {"rank", "total", "present_count", "percentile", "above", "below"}; above
+    and below list up to `neighbours` (rank, user_id, present_count) tuples each.
+    """
+    with _lock:
+        ranking = _guild(int(guild_id))
+        rank = ranking.rank(int(user_id))
+        if rank is None:
+            return None
+        total = ranking.total
+        above = [(r, *ranking.entry_at(r)) for r in range(max(1, rank - neighbours), rank)]
+        below = [(r, *ranking.entry_at(r)) for r in range(rank + 1, min(total, rank + neighbours) + 1)]
+        present_count = ranking.counts[int(user_id)]
+    return {
+        "rank": rank,
+        "total": total,
+        "present_count": present_count,
+        # Share of ranked members this member is ahead of.
+        "percentile": round(100 * (total - rank) / total, 1),
+        "above": above,
+        "below": below,
+    }
+
+
+storage.add_stats_listener(on_stats_changed)
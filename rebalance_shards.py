@@ -0,0 +1,27 @@
+import argparse
+
+from database import SHARD_MODES, DB_SHARD_DIR, rebalance_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy attendance data from one shard layout into another. Stop the bot first."
+    )
+    parser.add_argument("--from-mode", choices=SHARD_MODES, required=True)
+    parser.add_argument("--to-mode", choices=SHARD_MODES, required=True)
+    parser.add_argument("--from-count", type=int, help="DB_SHARD_COUNT of the source layout (hash mode)")
+    parser.add_argument("--to-count", type=int, help="DB_SHARD_COUNT of the target layout (hash mode)")
+    parser.add_argument("--shard-dir", default=DB_SHARD_DIR, help="Directory holding shard files")
+    args = parser.parse_args()
+
+    print(f"Rebalancing {args.from_mode} -> {args.to_mode} in {args.shard_dir}...")
+    summary = rebalance_shards(
+        args.from_mode, args.to_mode,
+        from_count=args.from_count, to_count=args.to_count, shard_dir=args.shard_dir
+    )
+    print(f"Copied {summary['rows']} rows from {summary['source_files']} file(s) into {summary['target_files']} file(s).")
+    print("Set DB_SHARD_MODE (and DB_SHARD_COUNT) to the new layout, then restart the bot.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""Offline administration of the attendance database: python3 -m registrar_admin <command>.
+
+    export     stream each guild to <out>/guild-<id>.jsonl.gz (snapshot format) or <out>/<id>/<table>.csv
+    import     load exported JSONL/CSV files (or a bot snapshot), one transaction per file
+    snapshot   write the JSON Lines snapshot (DB_SNAPSHOT_FILE, or --out)
+    restore    load a snapshot into an empty database
+    compact    checkpoint, VACUUM and re-analyze every database file
+    integrity  run SQLite's integrity check plus the bot's own consistency checks
+    stats      per-guild row counts and estimated size
+
+The database location and shard layout come from the same environment variables as the bot.
+Stop the bot before import, restore and compact; the read-only commands are safe while it
+runs. export, stats, integrity and compact spread guilds (or shard files) over --workers
+processes.
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from pathlib import Path
+
+import database
+
+# Tables that can hold a guild's rows; the union of their guild_ids lists the guilds.
+GUILD_TABLES = ("guild_configs", "attendance_stats", "attendance_records", "attendance_events", "custom_commands")
+EXPORT_FORMATS = ("jsonl", "csv")
+
+
+def existing_files():
+    """Returns the configured database files that exist on disk."""
+    return [db_file for db_file in database.shard_files() if Path(db_file).exists()]
+
+
+def table_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def list_guilds():
+    """Returns {guild_id: db_file} for every guild with rows in any database file."""
+    guilds = {}
+    for db_file in existing_files():
+        conn = database.open_connection(db_file)
+        try:
+            tables = [name for name in GUILD_TABLES if name in table_names(conn)]
+            if not tables:
+                continue
+            query = " UNION ".join(f"SELECT guild_id FROM {name}" for name in tables)
+            for (guild_id,) in conn.execute(query):
+                guilds[guild_id] = db_file
+        finally:
+            conn.close()
+    return guilds
+
+
+def run_parallel(func, items, workers, label):
+    """Runs func(item) for every item over a process pool and yields results as they finish.
+
+    workers <= 1 runs in this process. Shows a progress line on stderr when it is a terminal.
+    """
+    items = list(items)
+    started = time.perf_counter()
+    interactive = sys.stderr.isatty()
+
+    def progress(done):
+        if not interactive:
+            return
+        elapsed = time.perf_counter() - started
+        print(f"\r{label}: {done}/{len(items)} ({elapsed:.1f}s)", end="", file=sys.stderr, flush=True)
+
+    if workers <= 1 or len(items) <= 1:
+        for done, item in enumerate(items, start=1):
+            yield func(item)
+            progress(done)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(func, item) for item in items]
+            for done, future in enumerate(as_completed(futures), start=1):
+                yield future.result()
+                progress(done)
+    if items and interactive:
+        print(file=sys.stderr)
+
+
+# --- export ---
+
+def guild_table_batches(conn, table_name, columns, guild_id):
+    c = conn.execute(f"SELECT {', '.join(columns)} FROM {table_name} WHERE guild_id = ?", (guild_id,))
+    while True:
+        rows = c.fetchmany(database.SNAPSHOT_BATCH_SIZE)
+        if not rows:
+            break
+        yield rows
+
+
+def export_guild(task):
+    """Writes one guild's rows to out_dir; returns (guild_id, rows, bytes written)."""
+    guild_id, db_file, out_dir, fmt = task
+    conn = database.open_connection(db_file)
+    try:
+        present = table_names(conn)
+        # One read transaction keeps the guild's tables consistent with each other.
+        conn.execute("BEGIN")
+        tables = [
+            (name, database.get_table_columns(conn, name)) for name in database.SNAPSHOT_TABLES if name in present
+        ]
+        if fmt == "jsonl":
+            path = Path(out_dir) / f"guild-{guild_id}.jsonl.gz"
+            rows = database.atomic_write(path, lambda f: database.write_snapshot_tables(
+                f,
+                ((name, columns, guild_table_batches(conn, name, columns, guild_id)) for name, columns in tables),
+                db_file=db_file, guild_id=guild_id,
+            ))
+            return guild_id, rows, path.stat().st_size
+
+        guild_dir = Path(out_dir) / str(guild_id)
+        guild_dir.mkdir(parents=True, exist_ok=True)
+        rows = size = 0
+        for name, columns in tables:
+            path = guild_dir / f"{name}.csv"
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                for batch in guild_table_batches(conn, name, columns, guild_id):
+                    writer.writerows(
+                        [bytes(value).hex() if isinstance(value, bytes) else value for value in row] for row in batch
+                    )
+                    rows += len(batch)
+            size += path.stat().st_size
+        return guild_id, rows, size
+    finally:
+        conn.close()
+
+
+def command_export(args):
+    guilds = list_guilds()
+    selected = args.guild or sorted(guilds)
+    missing = [guild_id for guild_id in selected if guild_id not in guilds]
+    if missing:
+        print(f"No data for guild(s): {', '.join(map(str, missing))}", file=sys.stderr)
+    tasks = [(guild_id, guilds[guild_id], args.out, args.format) for guild_id in selected if guild_id in guilds]
+    Path(args.out).mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    total_rows = total_bytes = 0
+    for _, rows, size in run_parallel(export_guild, tasks, args.workers, "export"):
+        total_rows += rows
+        total_bytes += size
+    elapsed = time.perf_counter() - started
+    print(f"Exported {total_rows} rows from {len(tasks)} guild(s) to {args.out} ({total_bytes} bytes, {elapsed:.1f}s).")
+    return 0
+
+
+# --- import ---
+
+def read_csv_directory(directory):
+    """Yields (table_name, columns, values) for every <table>.csv in directory; empty cells are NULL."""
+    for table_name in database.SNAPSHOT_TABLES:
+        path = Path(directory) / f"{table_name}.csv"
+        if not path.exists():
+            continue
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            columns = next(reader, None)
+            if not columns:
+                continue
+            for row in reader:
+                yield table_name, columns, [value if value != "" else None for value in row]
+
+
+def import_sources(paths):
+    """Expands import arguments into snapshot files and CSV directories."""
+    sources = []
+    for path in map(Path, paths):
+        if path.is_file() or any(path.glob("*.csv")):
+            sources.append(path)
+        elif path.is_dir():
+            sources.extend(
+                child for child in sorted(path.iterdir())
+                if child.name.endswith(".jsonl.gz") or (child.is_dir() and any(child.glob("*.csv")))
+            )
+        else:
+            raise FileNotFoundError(path)
+    return sources
+
+
+def import_source(writers, source):
+    if source.is_dir():
+        return database.restore_row_stream(writers, read_csv_directory(source))
+    with open(source, "rb") as f:
+        return database.restore_snapshot_stream(writers, f)
+
+
+def command_import(args):
+    if args.batch_size:
+        database.SNAPSHOT_BATCH_SIZE = args.batch_size
+    database.init_db()
+    started = time.perf_counter()
+    total = 0
+    sources = import_sources(args.paths)
+    for index, source in enumerate(sources, start=1):
+        # One transaction per file (per shard it touches); rows go in executemany batches.
+        created = []
+        with database.ShardWriters(created) as writers:
+            rows = import_source(writers, source)
+        for manager in created:
+            with manager.writer() as conn:
+                database.set_schema_version(conn)
+        total += rows
+        elapsed = time.perf_counter() - started
+        print(f"[{index}/{len(sources)}] {source}: {rows} rows ({total / max(elapsed, 1e-9):.0f} rows/s)")
+    if total and not args.no_snapshot:
+        # Imported rows bypass the delta log, so fold them into a new base (as import_data does).
+        if database.SNAPSHOT_MODE == "backup":
+            database.sync_snapshot()
+        else:
+            database.write_snapshot()
+    database.close_connections()
+    print(f"Imported {total} rows from {len(sources)} source(s) in {time.perf_counter() - started:.1f}s.")
+    return 0
+
+
+# --- snapshot / restore ---
+
+def command_snapshot(args):
+    database.init_db()
+    started = time.perf_counter()
+    if args.out:
+        with ExitStack() as stack:
+            conns = [stack.enter_context(manager.reader()) for manager in database.shard_managers()]
+            for conn in conns:
+                database.pin_read_snapshot(conn)
+            rows = database.atomic_write(args.out, lambda f: database.write_snapshot_stream(conns, f))
+        target = args.out
+    else:
+        if not database.write_snapshot():
+            print(f"Failed to write {database.SNAPSHOT_FILE} (see the log).", file=sys.stderr)
+            return 1
+        rows = None
+        target = database.SNAPSHOT_FILE
+    database.close_connections()
+    details = f"{rows} rows, " if rows is not None else ""
+    print(f"Wrote {target} ({details}{Path(target).stat().st_size} bytes, {time.perf_counter() - started:.1f}s).")
+    return 0
+
+
+def command_restore(args):
+    source = Path(args.snapshot)
+    for manager in database.shard_managers():
+        database.ensure_schema(manager)
+        with manager.reader() as conn:
+            if not database.is_database_empty(conn):
+                print(f"{manager.db_file} already holds data; restore only fills an empty database.", file=sys.stderr)
+                return 1
+    started = time.perf_counter()
+    created = []
+    with database.ShardWriters(created) as writers:
+        if database.is_gzip_file(source):
+            with open(source, "rb") as f:
+                rows = database.restore_snapshot_stream(writers, f)
+        else:
+            database.restore_legacy_snapshot(writers, source)
+            rows = None
+    for manager in created:
+        with manager.writer() as conn:
+            database.set_schema_version(conn)
+    database.close_connections()
+    details = f"{rows} rows" if rows is not None else "legacy snapshot"
+    print(f"Restored {source} ({details}) in {time.perf_counter() - started:.1f}s.")
+    return 0
+
+
+# --- compact ---
+
+def compact_file(db_file):
+    """Checkpoints, VACUUMs and re-analyzes one database file; returns (db_file, bytes before, bytes after)."""
+    before = sum(Path(db_file + suffix).stat().st_size for suffix in ("", "-wal") if Path(db_file + suffix).exists())
+    conn = database.open_connection(db_file)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        # Takes effect with the VACUUM, so maintenance can use incremental vacuum afterwards.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.executescript("VACUUM; ANALYZE;")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    finally:
+        conn.close()
+    after = sum(Path(db_file + suffix).stat().st_size for suffix in ("", "-wal") if Path(db_file + suffix).exists())
+    return db_file, before, after
+
+
+def command_compact(args):
+    files = existing_files()
+    total_before = total_after = 0
+    for db_file, before, after in run_parallel(compact_file, files, args.workers, "compact"):
+        total_before += before
+        total_after += after
+        if args.verbose:
+            print(f"{db_file}: {before} -> {after} bytes")
+    print(f"Compacted {len(files)} file(s): {total_before} -> {total_after} bytes.")
+    return 0
+
+
+# --- integrity ---
+
+def check_file(task):
+    """Returns (db_file, list of problems) for one database file."""
+    db_file, quick = task
+    problems = []
+    conn = database.open_connection(db_file)
+    try:
+        pragma = "quick_check" if quick else "integrity_check"
+        results = [row[0] for row in conn.execute(f"PRAGMA {pragma}")]
+        if results != ["ok"]:
+            problems.extend(f"{pragma}: {result}" for result in results)
+        version = database.get_schema_version(conn)
+        if version != database.SCHEMA_VERSION:
+            problems.append(f"schema version {version}, expected {database.SCHEMA_VERSION}")
+        tables = table_names(conn)
+        if "leaderboard_counts" in tables:
+            for guild_id, counted, actual in conn.execute(
+                '''SELECT l.guild_id, l.member_count, (SELECT COUNT(*) FROM attendance_stats s WHERE s.guild_id = l.guild_id)
+                   FROM leaderboard_counts l'''
+            ):
+                if counted != actual:
+                    problems.append(f"guild {guild_id}: leaderboard_counts says {counted} members, attendance_stats has {actual}")
+        if "excuse_search_docsize" in tables:
+            # Only excused events with a reason are indexed, so FTS5's own content check does not apply.
+            indexed = conn.execute("SELECT COUNT(*) FROM excuse_search_docsize").fetchone()[0]
+            expected = conn.execute(
+                "SELECT COUNT(*) FROM attendance_events WHERE status = 'excused' AND reason IS NOT NULL"
+            ).fetchone()[0]
+            if indexed != expected:
+                problems.append(f"excuse_search indexes {indexed} reasons, attendance_events has {expected}")
+    finally:
+        conn.close()
+    return db_file, problems
+
+
+def command_integrity(args):
+    files = existing_files()
+    failed = 0
+    for db_file, problems in run_parallel(check_file, [(f, args.quick) for f in files], args.workers, "integrity"):
+        if problems:
+            failed += 1
+            print(f"{db_file}:")
+            for problem in problems:
+                print(f"  {problem}")
+    print(f"Checked {len(files)} file(s): {'all ok' if not failed else f'{failed} with problems'}.")
+    return 1 if failed else 0
+
+
+# --- stats ---
+
+_table_sizes = {}
+
+
+def table_sizes(conn, db_file):
+    """Returns {table: (rows, bytes including its indexes)} for a file, cached per process.
+
+    Bytes come from the dbstat virtual table when SQLite has it, otherwise from the file
+    size split by row count.
+    """
+    sizes = _table_sizes.get(db_file)
+    if sizes is not None:
+        return sizes
+    present = table_names(conn)
+    counts = {
+        name: conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        for name in database.SNAPSHOT_TABLES if name in present
+    }
+    try:
+        page_bytes = dict(conn.execute(
+            '''SELECT m.tbl_name, SUM(d.pgsize) FROM dbstat d JOIN sqlite_master m ON m.name = d.name
+               GROUP BY m.tbl_name'''
+        ).fetchall())
+    except sqlite3.OperationalError:
+        total_rows = sum(counts.values()) or 1
+        file_size = Path(db_file).stat().st_size
+        page_bytes = {name: file_size * count // total_rows for name, count in counts.items()}
+    sizes = _table_sizes[db_file] = {name: (count, page_bytes.get(name, 0)) for name, count in counts.items()}
+    return sizes
+
+
+def guild_stats(task):
+    """Returns {guild_id, file, rows: {table: count}, bytes, archive_bytes} for one guild."""
+    guild_id, db_file = task
+    conn = database.open_connection(db_file)
+    try:
+        sizes = table_sizes(conn, db_file)
+        rows = {
+            name: conn.execute(f"SELECT COUNT(*) FROM {name} WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+            for name in sizes
+        }
+    finally:
+        conn.close()
+    estimated = sum(
+        size * rows[name] // count for name, (count, size) in sizes.items() if count
+    )
+    archive_dir = Path(database.ARCHIVE_DIR) / str(guild_id)
+    archive_bytes = sum(path.stat().st_size for path in archive_dir.glob("*.csv.gz")) if archive_dir.is_dir() else 0
+    return {
+        "guild_id": guild_id,
+        "file": db_file,
+        "rows": rows,
+        "bytes": estimated,
+        "archive_bytes": archive_bytes,
+    }
+
+
+def command_stats(args):
+    guilds = list_guilds()
+    selected = [guild_id for guild_id in (args.guild or guilds) if guild_id in guilds]
+    results = list(run_parallel(guild_stats, [(guild_id, guilds[guild_id]) for guild_id in selected], args.workers, "stats"))
+    results.sort(key=lambda result: (-result["bytes"], result["guild_id"]))
+    if args.top:
+        results = results[:args.top]
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return 0
+    print(f"{'guild':>20} {'est. bytes':>12} {'archive':>10} {'members':>8} {'events':>9} {'records':>8}")
+    for result in results:
+        rows = result["rows"]
+        print(
+            f"{result['guild_id']:>20} {result['bytes']:>12} {result['archive_bytes']:>10} "
+            f"{rows.get('attendance_stats', 0):>8} {rows.get('attendance_events', 0):>9} {rows.get('attendance_records', 0):>8}"
+        )
+    print(f"{len(selected)} guild(s) in {len(existing_files())} file(s).")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m registrar_admin",
+        description="Offline administration of the attendance database (uses DB_FILE / DB_SHARD_* like the bot).",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    workers = dict(type=int, default=os.cpu_count() or 1, help="worker processes (1 runs in this process)")
+
+    export = subparsers.add_parser("export", help="stream guilds to JSONL (snapshot format) or CSV files")
+    export.add_argument("--out", required=True, help="output directory")
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+    export.add_argument("--guild", type=int, action="append", help="only this guild (repeatable)")
+    export.add_argument("--workers", **workers)
+    export.set_defaults(func=command_export)
+
+    load = subparsers.add_parser("import", help="load exported files or snapshots (stop the bot first)")
+    load.add_argument("paths", nargs="+", help="*.jsonl.gz files, CSV guild directories, or directories of either")
+    load.add_argument("--batch-size", type=int, help=f"rows per executemany (default {database.SNAPSHOT_BATCH_SIZE})")
+    load.add_argument("--no-snapshot", action="store_true", help="skip writing the snapshot afterwards")
+    load.set_defaults(func=command_import)
+
+    snapshot = subparsers.add_parser("snapshot", help="write the JSON Lines snapshot")
+    snapshot.add_argument("--out", help=f"write here instead of {database.SNAPSHOT_FILE}")
+    snapshot.set_defaults(func=command_snapshot)
+
+    restore = subparsers.add_parser("restore", help="load a snapshot into an empty database (stop the bot first)")
+    restore.add_argument("snapshot")
+    restore.set_defaults(func=command_restore)
+
+    compact = subparsers.add_parser("compact", help="VACUUM and re-analyze every database file (stop the bot first)")
+    compact.add_argument("--workers", **workers)
+    compact.add_argument("--verbose", action="store_true", help="print every file")
+    compact.set_defaults(func=command_compact)
+
+    integrity = subparsers.add_parser("integrity", help="check every database file")
+    integrity.add_argument("--quick", action="store_true", help="PRAGMA quick_check instead of integrity_check")
+    integrity.add_argument("--workers", **workers)
+    integrity.set_defaults(func=command_integrity)
+
+    stats = subparsers.add_parser("stats", help="per-guild row counts and estimated size")
+    stats.add_argument("--guild", type=int, action="append", help="only this guild (repeatable)")
+    stats.add_argument("--top", type=int, help="only the N largest guilds")
+    stats.add_argument("--json", action="store_true", help="one JSON object per guild")
+    stats.add_argument("--workers", **workers)
+    stats.set_defaults(func=command_stats)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,531 @@
+"""Continuous replication of the SQLite files to a durable sink by shipping WAL frames.
+
+Every DB_REPLICA_SYNC_SECONDS a background thread takes each shard's writer lock just long
+enough to read the WAL frames committed since its last pass, then uploads them as one
+gzipped segment. Only changed pages travel, so the cost of a sync follows the write volume,
+not the size of the database. The replicator owns checkpointing (wal_autocheckpoint is
+turned off on the writer): once DB_REPLICA_CHECKPOINT_PAGES pages have been shipped it runs
+PRAGMA wal_checkpoint(TRUNCATE) itself, so no frame is folded into the database before it
+has been read.
+
+Objects are laid out per database file as
+
+    <name>/generations/<generation>/snapshot.db.gz       full image when the generation began
+    <name>/generations/<generation>/wal/<seq>.wal.gz     WAL header plus committed frames
+
+A generation starts on boot, every DB_REPLICA_SNAPSHOT_HOURS, and whenever the WAL was reset
+behind the replicator's back. restore() rebuilds missing database files on startup from the
+newest generation that has a snapshot: the image is written out and every segment's frames
+are applied in order.
+
+Sinks: a local directory (a path or file:// URL) or any HTTP object endpoint that accepts
+PUT, GET and DELETE on <url>/<key> and lists keys with GET <url>/?prefix=... as a JSON array.
+`python3 replication.py serve <directory> [port]` runs such an endpoint locally.
+"""
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import database
+import storage
+
+# Empty disables replication; a directory path, file:// URL or http(s):// URL enables it.
+REPLICA_URL = os.getenv("DB_REPLICA_URL", "").strip()
+REPLICA_TOKEN = os.getenv("DB_REPLICA_TOKEN", "").strip()
+REPLICA_SYNC_SECONDS = max(1, database.env_int("DB_REPLICA_SYNC_SECONDS", 1))
+REPLICA_CHECKPOINT_PAGES = max(1, database.env_int("DB_REPLICA_CHECKPOINT_PAGES", 1000))
+REPLICA_SNAPSHOT_HOURS = database.env_int("DB_REPLICA_SNAPSHOT_HOURS", 24)
+REPLICA_RETAIN_GENERATIONS = max(1, database.env_int("DB_REPLICA_RETAIN_GENERATIONS", 2))
+REPLICA_TIMEOUT_SECONDS = database.env_int("DB_REPLICA_TIMEOUT_SECONDS", 30)
+
+WAL_HEADER_SIZE = 32
+FRAME_HEADER_SIZE = 24
+logger = logging.getLogger(__name__)
+
+
+class LocalDirectorySink:
+    """Stores objects as files under a directory."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, key):
+        return self.root.joinpath(*key.split("/"))
+
+    def put(self, key, data):
+        database.atomic_write(self._path(key), lambda f: f.write(data))
+
+    def get(self, key):
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix=""):
+        if not self.root.is_dir():
+            return []
+        keys = (path.relative_to(self.root).as_posix() for path in self.root.rglob("*") if path.is_file())
+        return sorted(key for key in keys if key.startswith(prefix) and not key.endswith(".tmp"))
+
+
+class HTTPSink:
+    """Stores objects through PUT/GET/DELETE on <base_url>/<key> (see the module docstring)."""
+
+    def __init__(self, base_url, token=None, timeout=None):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = REPLICA_TIMEOUT_SECONDS if timeout is None else timeout
+
+    def _request(self, method, path, data=None):
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if self.token:
+            request.add_header("Authorization", f"Bearer {self.token}")
+        if data is not None:
+            request.add_header("Content-Type", "application/octet-stream")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    def put(self, key, data):
+        self._request("PUT", "/" + urllib.parse.quote(key), data)
+
+    def get(self, key):
+        try:
+            return self._request("GET", "/" + urllib.parse.quote(key))
+        except urllib.error.HTTPError as e:
+            if e.code == HTTPStatus.NOT_FOUND:
+                return None
+            raise
+
+    def delete(self, key):
+        try:
+            self._request("DELETE", "/" + urllib.parse.quote(key))
+        except urllib.error.HTTPError as e:
+            if e.code != HTTPStatus.NOT_FOUND:
+                raise
+
+    def list(self, prefix=""):
+        return sorted(json.loads(self._request("GET", "/?" + urllib.parse.urlencode({"prefix": prefix}))))
+
+
+def open_sink(url=None, token=None):
+    """Returns the sink for url (DB_REPLICA_URL by default), or None when replication is off."""
+    url = REPLICA_URL if url is None else url
+    if not url:
+        return None
+    if url.startswith(("http://", "https://")):
+        return HTTPSink(url, token or REPLICA_TOKEN or None)
+    if url.startswith("file://"):
+        url = urllib.parse.urlparse(url).path
+    return LocalDirectorySink(url)
+
+
+def replica_name(db_file):
+    """Returns the object prefix of a database file: its name, under "shards/" for shard files."""
+    if Path(db_file).resolve() == Path(database.DB_FILE).resolve():
+        return Path(db_file).name
+    return f"shards/{Path(db_file).name}"
+
+
+def replica_target(name):
+    """Inverse of replica_name(): the local path a replicated database restores to."""
+    if name.startswith("shards/"):
+        return str(Path(database.DB_SHARD_DIR) / name[len("shards/"):])
+    return database.DB_FILE
+
+
+def new_generation_id():
+    # Millisecond timestamps sort generations by age; the suffix keeps two processes apart.
+    return f"{int(time.time() * 1000):013d}-{os.urandom(3).hex()}"
+
+
+class _WalReset(Exception):
+    """The WAL was checkpointed or rewritten without the replicator reading it first."""
+
+
+class _Stream:
+    """Replication state of one database file."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.name = replica_name(manager.db_file)
+        self.wal_path = manager.db_file + "-wal"
+        self.generation = None
+        self.started_at = 0
+        self.seq = 0
+        self.header = None
+        self.offset = 0
+        self.shipped_pages = 0
+        # (key, data) uploads waiting for the sink, oldest first.
+        self.pending = []
+
+    def prefix(self):
+        return f"{self.name}/generations/{self.generation}/"
+
+    def read_wal(self):
+        """Returns the WAL bytes committed since the last call (call with the writer lock held)."""
+        try:
+            f = open(self.wal_path, "rb")
+        except FileNotFoundError:
+            if self.header is not None:
+                raise _WalReset()
+            return b""
+        with f:
+            header = f.read(WAL_HEADER_SIZE)
+            if len(header) < WAL_HEADER_SIZE:
+                if self.header is not None:
+                    raise _WalReset()
+                return b""
+            if self.header is None:
+                self.header = header
+                self.offset = WAL_HEADER_SIZE
+            elif header[16:24] != self.header[16:24]:
+                raise _WalReset()
+            page_size = int.from_bytes(header[8:12], "big")
+            frame_size = FRAME_HEADER_SIZE + page_size
+            f.seek(self.offset)
+            data = f.read()
+
+        # Keep whole frames of this WAL's salt up to the last commit frame; anything after is
+        # either an uncommitted tail or a leftover from before the last reset.
+        committed = 0
+        position = 0
+        while position + frame_size <= len(data):
+            if data[position + 8:position + 16] != header[16:24]:
+                break
+            position += frame_size
+            if int.from_bytes(data[position - frame_size + 4:position - frame_size + 8], "big"):
+                committed = position
+        self.offset += committed
+        self.shipped_pages += committed // frame_size
+        return data[:committed]
+
+
+class Replicator:
+    """Background thread shipping every shard's committed WAL frames to a sink."""
+
+    def __init__(self, sink, interval=None, checkpoint_pages=None, snapshot_hours=None):
+        self.sink = sink
+        self.interval = REPLICA_SYNC_SECONDS if interval is None else interval
+        self.checkpoint_pages = checkpoint_pages or REPLICA_CHECKPOINT_PAGES
+        self.snapshot_seconds = 3600 * (REPLICA_SNAPSHOT_HOURS if snapshot_hours is None else snapshot_hours)
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_sync = None
+        self.last_error = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="registrar-replicator", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread after one last sync (call before closing the connections)."""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        self.sync()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sync()
+
+    def sync(self):
+        """Ships new frames of every shard; returns the number of bytes uploaded."""
+        uploaded = 0
+        with self._lock:
+            for manager in database.shard_managers():
+                stream = self._streams.get(manager.db_file)
+                if stream is None:
+                    stream = self._streams[manager.db_file] = _Stream(manager)
+                try:
+                    self._capture(stream)
+                    uploaded += self._upload(stream)
+                except Exception as e:
+                    self.last_error = f"{stream.name}: {e}"
+                    logger.warning("Replication of %s failed (retrying): %s", manager.db_file, e)
+            self.last_sync = time.time()
+        return uploaded
+
+    def _capture(self, stream):
+        manager = stream.manager
+        if not Path(manager.db_file).exists():
+            return
+        with manager.writer() as conn:
+            if stream.generation is None or time.time() - stream.started_at >= self.snapshot_seconds:
+                self._begin_generation(stream, conn)
+                return
+            try:
+                frames = stream.read_wal()
+            except _WalReset:
+                logger.warning("WAL of %s was reset outside the replicator; starting a new generation.", manager.db_file)
+                self._begin_generation(stream, conn)
+                return
+            if frames:
+                stream.seq += 1
+                stream.pending.append((f"{stream.prefix()}wal/{stream.seq:010d}.wal.gz", stream.header + frames))
+            if stream.shipped_pages >= self.checkpoint_pages:
+                busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+                if not busy:
+                    # The next commit writes a new WAL header with fresh salts.
+                    stream.header = None
+                    stream.offset = 0
+                    stream.shipped_pages = 0
+
+    def _begin_generation(self, stream, conn):
+        conn.execute("PRAGMA wal_autocheckpoint = 0")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        image = sqlite3.connect(":memory:")
+        try:
+            conn.backup(image)
+            data = image.serialize()
+        finally:
+            image.close()
+        stream.generation = new_generation_id()
+        stream.started_at = time.time()
+        stream.seq = 0
+        stream.header = None
+        stream.offset = 0
+        stream.shipped_pages = 0
+        # Frames already in the WAL (the checkpoint was blocked by a reader) are in the image.
+        stream.read_wal()
+        stream.shipped_pages = 0
+        stream.pending.append((f"{stream.prefix()}snapshot.db.gz", data))
+
+    def _upload(self, stream):
+        uploaded = 0
+        while stream.pending:
+            key, data = stream.pending[0]
+            body = gzip.compress(data, compresslevel=6, mtime=0)
+            self.sink.put(key, body)
+            stream.pending.pop(0)
+            uploaded += len(body)
+            if key.endswith("snapshot.db.gz"):
+                self._prune(stream.name)
+        return uploaded
+
+    def _prune(self, name):
+        generations = list_generations(self.sink, name)
+        for generation in generations[:-REPLICA_RETAIN_GENERATIONS]:
+            for key in self.sink.list(f"{name}/generations/{generation}/"):
+                self.sink.delete(key)
+
+    def status(self):
+        return {
+            "replica_last_sync": self.last_sync,
+            "replica_pending_uploads": sum(len(stream.pending) for stream in self._streams.values()),
+            "replica_last_error": self.last_error,
+        }
+
+
+def list_generations(sink, name):
+    """Returns the generations of a database that have a snapshot, oldest first."""
+    prefix = f"{name}/generations/"
+    return sorted({
+        key[len(prefix):].split("/", 1)[0]
+        for key in sink.list(prefix)
+        if key.endswith("/snapshot.db.gz")
+    })
+
+
+def apply_segment(f, segment):
+    """Writes a segment's frames into an open database file; returns the number of frames."""
+    page_size = int.from_bytes(segment[8:12], "big")
+    frame_size = FRAME_HEADER_SIZE + page_size
+    frames = 0
+    for position in range(WAL_HEADER_SIZE, len(segment) - frame_size + 1, frame_size):
+        page_number = int.from_bytes(segment[position:position + 4], "big")
+        commit_pages = int.from_bytes(segment[position + 4:position + 8], "big")
+        f.seek((page_number - 1) * page_size)
+        f.write(segment[position + FRAME_HEADER_SIZE:position + frame_size])
+        if commit_pages:
+            f.truncate(commit_pages * page_size)
+        frames += 1
+    return frames
+
+
+def restore_database(sink, name, target):
+    """Rebuilds target from the newest generation of name; returns False when there is none."""
+    generations = list_generations(sink, name)
+    if not generations:
+        return False
+    generation = generations[-1]
+    prefix = f"{name}/generations/{generation}/"
+    target = Path(target)
+
+    def write(f):
+        frames = 0
+        f.write(gzip.decompress(sink.get(prefix + "snapshot.db.gz")))
+        expected = 1
+        for key in sink.list(prefix + "wal/"):
+            seq = int(key.rsplit("/", 1)[1].split(".", 1)[0])
+            if seq != expected:
+                logger.warning("Replica %s is missing segment %s; restoring up to it.", name, expected)
+                break
+            frames += apply_segment(f, gzip.decompress(sink.get(key)))
+            expected += 1
+        # The old database's WAL must not be replayed over the restored file.
+        for suffix in ("-wal", "-shm"):
+            Path(str(target) + suffix).unlink(missing_ok=True)
+        return expected, frames
+
+    expected, frames = database.atomic_write(target, write)
+    logger.info("Restored %s from replica generation %s (%s segment(s), %s frame(s)).", target, generation, expected - 1, frames)
+    return True
+
+
+def restore(sink=None):
+    """Restores every replicated database file that is missing or empty locally.
+
+    Call before the database is opened. Returns the list of restored paths.
+    """
+    sink = sink or open_sink()
+    if sink is None or storage.backend.name != "sqlite":
+        return []
+    try:
+        keys = sink.list("")
+    except Exception as e:
+        logger.error("Failed to list the replica at %s: %s", REPLICA_URL, e)
+        return []
+    names = {key.split("/generations/", 1)[0] for key in keys if "/generations/" in key}
+    restored = []
+    for name in sorted(names):
+        target = replica_target(name)
+        path = Path(target)
+        if path.exists() and path.stat().st_size > 0:
+            continue
+        try:
+            if restore_database(sink, name, target):
+                restored.append(target)
+        except Exception as e:
+            logger.error("Failed to restore %s from the replica: %s", target, e)
+    return restored
+
+
+replicator = None
+
+
+def start():
+    """Starts replicating to DB_REPLICA_URL; a no-op when it is unset or the backend is not SQLite."""
+    global replicator
+    if replicator is not None:
+        return replicator
+    sink = open_sink()
+    if sink is None or storage.backend.name != "sqlite":
+        logger.info("Database replication is off (DB_REPLICA_URL unset or DB_BACKEND is not sqlite).")
+        return None
+    replicator = Replicator(sink)
+    replicator.start()
+    logger.info("Replicating %s to %s every %ss.", database.DB_FILE, REPLICA_URL, replicator.interval)
+    return replicator
+
+
+def stop():
+    """Ships the last frames and stops the replicator (call before close_connections)."""
+    global replicator
+    current, replicator = replicator, None
+    if current is not None:
+        current.stop()
+
+
+def status():
+    """Returns replication fields for /readyz (empty when replication is off)."""
+    return replicator.status() if replicator is not None else {}
+
+
+class _SinkHandler(BaseHTTPRequestHandler):
+    """Local stand-in for an object store, backed by a LocalDirectorySink."""
+
+    sink = None
+    token = None
+
+    def _authorized(self):
+        if self.token and self.headers.get("Authorization") != f"Bearer {self.token}":
+            self.send_error(HTTPStatus.UNAUTHORIZED)
+            return False
+        return True
+
+    def _key(self):
+        key = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip("/")
+        if not key or ".." in key.split("/"):
+            self.send_error(HTTPStatus.BAD_REQUEST)
+            return None
+        return key
+
+    def _send(self, body, content_type="application/octet-stream"):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urllib.parse.urlparse(self.path)
+        if url.path in ("", "/"):
+            prefix = urllib.parse.parse_qs(url.query).get("prefix", [""])[0]
+            self._send(json.dumps(self.sink.list(prefix)).encode("utf-8"), "application/json")
+            return
+        key = self._key()
+        if key is None:
+            return
+        data = self.sink.get(key)
+        if data is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self._send(data)
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        key = self._key()
+        if key is None:
+            return
+        self.sink.put(key, self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        self._send(b"")
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        key = self._key()
+        if key is None:
+            return
+        self.sink.delete(key)
+        self._send(b"")
+
+    def log_message(self, format, *args):
+        return
+
+
+def serve_directory(root, port=8090, host="127.0.0.1", token=None):
+    """Returns an HTTP server exposing a directory with the protocol HTTPSink speaks."""
+    handler = type("SinkHandler", (_SinkHandler,), {"sink": LocalDirectorySink(root), "token": token})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "serve":
+        sys.exit("usage: python3 replication.py serve <directory> [port]")
+    server = serve_directory(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 8090, token=REPLICA_TOKEN or None)
+    print(f"Serving {sys.argv[2]} on http://127.0.0.1:{server.server_address[1]}")
+    server.serve_forever()
@@ -0,0 +1,1072 @@
+"""Storage backends for the attendance data the bot reads and writes.
+
+StorageBackend lists every operation the bot relies on. SQLiteBackend is the normal engine
+(database.py, optionally sharded); MemoryBackend keeps everything in dicts and only touches
+disk to write the same compressed snapshot file, which suits tests, benchmarks and the
+ephemeral /tmp deployment. DB_BACKEND=sqlite|memory picks the engine behind `backend`.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import attendance_archive
+import attendance_calendar
+import database
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("sqlite", "memory")
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").strip().lower()
+
+STATUS_COLUMNS = {
+    "present": "present_count",
+    "absent": "absent_count",
+    "excused": "excused_count",
+}
+
+# The data operations every backend implements, with database.py's signatures.
+DATA_OPERATIONS = (
+    "init_db",
+    "get_guild_config",
+    "update_guild_config",
+    "get_attendance_records",
+    "get_record",
+    "upsert_record",
+    "add_or_update_record",
+    "delete_record",
+    "bulk_upsert_records",
+    "replace_all_records",
+    "clear_attendance_records",
+    "clear_attendance_stats",
+    "increment_status_count",
+    "close_session",
+    "record_attendance",
+    "log_attendance_event",
+    "get_attendance_history",
+    "rebuild_attendance_stats",
+    "search_excuses",
+    "get_analytics_rows",
+    "get_calendar",
+    "get_guild_calendars",
+    "get_member_stats",
+    "get_period_leaderboard",
+    "get_leaderboard_state",
+    "get_attendance_leaderboard_count",
+    "get_attendance_leaderboard",
+    "get_present_counts",
+    "get_custom_commands",
+    "get_custom_command",
+    "upsert_custom_command",
+    "delete_custom_command",
+    "export_all_data",
+    "import_data",
+    "run_maintenance",
+    "archive_closed_months",
+)
+
+
+class StorageBackend:
+    """The storage surface used by the bot; engines override every method."""
+
+    name = None
+
+    # Lifecycle
+    def init_db(self):
+        """Prepares the store (schema, restore from snapshot) before first use."""
+        raise NotImplementedError
+
+    def flush_snapshot(self):
+        """Writes any pending snapshot right away (called on shutdown)."""
+        raise NotImplementedError
+
+    def snapshot_status(self):
+        """Returns snapshot health metrics for /readyz."""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases connections and other resources."""
+        raise NotImplementedError
+
+    # Guild configuration
+    def get_guild_config(self, guild_id):
+        """Returns the guild's config row as a dict, or None."""
+        raise NotImplementedError
+
+    def update_guild_config(self, guild_id, **kwargs):
+        """Creates the config row if needed and updates the given columns."""
+        raise NotImplementedError
+
+    # Attendance records (one current record per member)
+    def get_attendance_records(self, guild_id):
+        """Returns {user_id (str): {status, timestamp, channel_id, reason}}."""
+        raise NotImplementedError
+
+    def get_record(self, guild_id, user_id):
+        """Returns one member's record dict, or None."""
+        raise NotImplementedError
+
+    def upsert_record(self, guild_id, user_id, status, timestamp, channel_id=None, reason=None):
+        """Inserts or updates one member's record."""
+        raise NotImplementedError
+
+    def add_or_update_record(self, guild_id, user_id, status, timestamp, channel_id=None, reason=None):
+        """Alias of upsert_record kept for older callers."""
+        self.upsert_record(guild_id, user_id, status, timestamp, channel_id, reason)
+
+    def delete_record(self, guild_id, user_id):
+        """Deletes one member's record; returns whether it existed."""
+        raise NotImplementedError
+
+    def bulk_upsert_records(self, guild_id, records_dict):
+        """Upserts {user_id: record dict} in one step."""
+        raise NotImplementedError
+
+    def replace_all_records(self, guild_id, records_dict):
+        """Replaces every record of a guild with {user_id: record dict}."""
+        raise NotImplementedError
+
+    def clear_attendance_records(self, guild_id):
+        """Deletes every record of a guild."""
+        raise NotImplementedError
+
+    # Attendance stats
+    def clear_attendance_stats(self, guild_id):
+        """Deletes every stats row of a guild."""
+        raise NotImplementedError
+
+    def increment_status_count(self, guild_id, user_id, status, count=1):
+        """Adds count to the member's present/absent/excused counter."""
+        raise NotImplementedError
+
+    def close_session(self, guild_id, date, absent_user_ids, timestamp=None,
+                      reason="Auto-marked at end of attendance window", clear=True):
+        """Marks missing members absent, clears the session and records date as processed,
+        all at once; returns the closed session records, or None if date was already closed.
+        """
+        raise NotImplementedError
+
+    # Rollups, streaks and calendars (updated by close_session)
+    def get_calendar(self, guild_id, user_id, year):
+        """Returns a member's 2-bit-per-day attendance_calendar for a year (see attendance_calendar), or None."""
+        raise NotImplementedError
+
+    def get_guild_calendars(self, guild_id, year):
+        """Returns {user_id: attendance calendar} for every member of a guild with sessions that year."""
+        raise NotImplementedError
+
+    def get_member_stats(self, guild_id, user_id, period):
+        """Returns {period, present, absent, excused, sessions, rate, current_streak, best_streak, last_day}."""
+        raise NotImplementedError
+
+    def get_period_leaderboard(self, guild_id, period, limit=10, offset=0):
+        """Returns (ranked member count, stats rows) for a 'YYYY-MM' or 'YYYY-Www' period."""
+        raise NotImplementedError
+
+    # Attendance ledger (attendance_events)
+    def record_attendance(self, guild_id, user_id, status, timestamp, channel_id=None, reason=None, source=None):
+        """Upserts the record, bumps the stats counter and appends a ledger event at once."""
+        raise NotImplementedError
+
+    def log_attendance_event(self, guild_id, user_id, status, timestamp=None, reason=None, source=None):
+        """Appends a history-only ledger event."""
+        raise NotImplementedError
+
+    def get_attendance_history(self, guild_id, user_id, since=None, until=None, limit=50):
+        """Returns a member's ledger events (newest first) as {status, reason, ts, source} dicts."""
+        raise NotImplementedError
+
+    def search_excuses(self, guild_id, terms, since=None, until=None, limit=10, offset=0):
+        """Full-text searches excuse reasons, best match first; returns (total matches, rows of
+        {user_id, reason, ts, source, snippet})."""
+        raise NotImplementedError
+
+    def get_analytics_rows(self, guild_id):
+        """Returns {"stats": [(user_id, present, absent, excused)], "events": [(user_id, status, ts)]}
+        with the counted ledger events since the latest stats reset, oldest first."""
+        raise NotImplementedError
+
+    def rebuild_attendance_stats(self, guild_id=None):
+        """Recomputes attendance_stats from the ledger; returns the number of stats rows."""
+        raise NotImplementedError
+
+    def get_leaderboard_state(self, guild_id):
+        """Returns {"members": ranked member count, "version": changes on every stats write}."""
+        raise NotImplementedError
+
+    def get_attendance_leaderboard_count(self, guild_id):
+        """Returns how many members have stats in a guild."""
+        raise NotImplementedError
+
+    def get_attendance_leaderboard(self, guild_id, limit=10, offset=0, after=None):
+        """Returns stats rows ordered by present_count DESC, user_id ASC, starting after the
+        (present_count, user_id) key of the previous page when given, else at offset."""
+        raise NotImplementedError
+
+    def get_present_counts(self, guild_id=None):
+        """Returns [(guild_id, user_id, present_count)] for one guild or all of them."""
+        raise NotImplementedError
+
+    # Custom commands
+    def get_custom_commands(self, guild_id):
+        """Returns {command_name: response_text}."""
+        raise NotImplementedError
+
+    def get_custom_command(self, guild_id, command_name):
+        """Returns one command's response text, or None."""
+        raise NotImplementedError
+
+    def upsert_custom_command(self, guild_id, command_name, response_text):
+        """Creates or updates a custom command."""
+        raise NotImplementedError
+
+    def delete_custom_command(self, guild_id, command_name):
+        """Deletes a custom command; returns whether it existed."""
+        raise NotImplementedError
+
+    # Export / restore
+    def export_all_data(self):
+        """Returns {"exported_at", "db_file", "tables": {table: [row dicts]}}."""
+        raise NotImplementedError
+
+    def import_data(self, payload):
+        """Loads an export_all_data() payload into an empty store."""
+        raise NotImplementedError
+
+    # Maintenance
+    def run_maintenance(self, guild_ids, retention_days=None):
+        """Runs retention/compaction for guilds outside their window; returns a step report."""
+        raise NotImplementedError
+
+    def archive_closed_months(self, guild_id, keep_months=None, now=None):
+        """Moves a guild's ledger events from closed months to archive files; returns step reports."""
+        raise NotImplementedError
+
+
+class SQLiteBackend(StorageBackend):
+    """The default engine: database.py on SQLite files."""
+
+    name = "sqlite"
+
+    def flush_snapshot(self):
+        database.flush_snapshot()
+
+    def snapshot_status(self):
+        return database.snapshot_scheduler.status()
+
+    def close(self):
+        database.close_connections()
+
+
+for _operation in DATA_OPERATIONS:
+    setattr(SQLiteBackend, _operation, staticmethod(getattr(database, _operation)))
+
+
+def schema_defaults(table_name):
+    """Returns the column defaults of a table in the current SQLite schema."""
+    conn = sqlite3.connect(":memory:")
+    try:
+        database.apply_migrations(conn)
+        return {
+            row[1]: None if row[4] is None else conn.execute(f"SELECT {row[4]}").fetchone()[0]
+            for row in conn.execute(f"PRAGMA table_info('{table_name}')")
+        }
+    finally:
+        conn.close()
+
+
+class MemoryBackend(StorageBackend):
+    """Dict-backed engine that snapshots to database.SNAPSHOT_FILE on the usual schedule."""
+
+    name = "memory"
+
+    def __init__(self, snapshot_file=None, snapshot_interval=None):
+        self.snapshot_file = snapshot_file or database.SNAPSHOT_FILE
+        # Sharing the SQLite engine's snapshot file means sharing (and retiring) its delta log.
+        self.uses_delta_log = database.SNAPSHOT_DELTAS_ENABLED and self.snapshot_file == database.SNAPSHOT_FILE
+        self._lock = threading.RLock()
+        self._configs = {}
+        self._records = {}
+        self._stats = {}
+        self._stats_versions = {}
+        self._commands = {}
+        self._events = {}
+        self._event_ids = {}
+        self._calendars = {}
+        self._rollups = {}
+        self._streaks = {}
+        self._archived_counts = {}
+        self._next_record_id = 1
+        self._next_event_id = 1
+        self._config_defaults = schema_defaults("guild_configs")
+        interval = database.SNAPSHOT_INTERVAL_SECONDS if snapshot_interval is None else snapshot_interval
+        self._scheduler = database.SnapshotScheduler(self.write_snapshot, interval)
+
+    # Lifecycle
+    def init_db(self):
+        snapshot_path = Path(self.snapshot_file)
+        if not snapshot_path.exists():
+            snapshot_path = Path(database.LEGACY_SNAPSHOT_FILE)
+        delta_log = database.delta_log if self.uses_delta_log else None
+        has_deltas = delta_log is not None and (delta_log.path.exists() or delta_log.rotated_path.exists())
+        if not (snapshot_path.exists() or has_deltas) or not self._is_empty():
+            logger.info("In-memory storage ready (snapshot: %s).", self.snapshot_file)
+            return
+        try:
+            rows = 0
+            if not snapshot_path.exists():
+                pass
+            elif database.is_gzip_file(snapshot_path):
+                with open(snapshot_path, "rb") as f:
+                    rows = self._load_rows(database.read_snapshot_stream(f))
+            else:
+                payload = json.loads(snapshot_path.read_text(encoding="utf-8"))
+                self.import_data(payload, snapshot=False)
+                rows = sum(len(table_rows) for table_rows in payload.get("tables", {}).values())
+            # A snapshot written by the SQLite engine may have changes in its delta log.
+            replayed = self._replay(delta_log.iter_entries()) if has_deltas else 0
+            logger.info("Restored %s rows (+%s deltas) into in-memory storage from %s", rows, replayed, snapshot_path)
+        except Exception as e:
+            logger.warning("Failed to restore snapshot %s: %s", snapshot_path, e)
+
+    def flush_snapshot(self):
+        self._scheduler.flush()
+
+    def snapshot_status(self):
+        return self._scheduler.status()
+
+    def close(self):
+        pass
+
+    def write_snapshot(self):
+        """Writes every table to the snapshot file (same format as the SQLite engine)."""
+        with self._lock:
+            tables = [
+                (table_name, database.schema_columns(table_name), [self._table_rows(table_name)])
+                for table_name in database.SNAPSHOT_TABLES
+            ]
+        try:
+            database.atomic_write(
+                self.snapshot_file,
+                lambda f: database.write_snapshot_tables(f, tables, db_file=":memory:")
+            )
+            if self.uses_delta_log:
+                # The full snapshot supersedes any deltas the SQLite engine left behind.
+                database.delta_log.rotate()
+                database.delta_log.discard_rotated()
+            return True
+        except Exception as e:
+            logger.warning("Failed to write snapshot %s: %s", self.snapshot_file, e)
+            return False
+
+    def _is_empty(self):
+        with self._lock:
+            return not (self._configs or self._records or self._stats or self._commands or self._events
+                        or self._calendars or self._rollups or self._streaks
+                        or self._archived_counts)
+
+    def _table_rows(self, table_name):
+        columns = database.schema_columns(table_name)
+        if table_name == "guild_configs":
+            rows = self._configs.values()
+        elif table_name == "attendance_records":
+            rows = (row for records in self._records.values() for row in records.values())
+        elif table_name == "attendance_stats":
+            rows = (row for stats in self._stats.values() for row in stats.values())
+        elif table_name == "custom_commands":
+            rows = (
+                {"guild_id": guild_id, "command_name": name, "response_text": text}
+                for guild_id, commands in self._commands.items()
+                for name, text in commands.items()
+            )
+        elif table_name == "attendance_events":
+            rows = (row for events in self._events.values() for row in events)
+        elif table_name == "attendance_calendar":
+            rows = (
+                {"guild_id": guild_id, "user_id": user_id, "year": year, "days": days}
+                for (guild_id, user_id, year), days in self._calendars.items()
+            )
+        elif table_name == "attendance_rollups":
+            rows = self._rollups.values()
+        elif table_name == "attendance_archived_counts":
+            rows = self._archived_counts.values()
+        else:
+            rows = self._streaks.values()
+        return [[row.get(column) for column in columns] for row in rows]
+
+    def _load_rows(self, rows):
+        count = 0
+        with self._lock:
+            for table_name, columns, values in rows:
+                if table_name in database.SNAPSHOT_TABLES:
+                    self._insert_row(table_name, dict(zip(columns, values)))
+                    count += 1
+        return count
+
+    def _replay(self, entries):
+        applied = 0
+        with self._lock:
+            for entry in entries:
+                table_name = entry.get("table")
+                if table_name not in database.SNAPSHOT_TABLES:
+                    continue
+                if entry.get("op") == "replace":
+                    self._delete_where(table_name, entry.get("where", {}))
+                    rows = entry.get("rows", [])
+                elif entry.get("op") == "upsert":
+                    rows = [entry["row"]]
+                else:
+                    continue
+                for row in rows:
+                    self._insert_row(table_name, dict(row))
+                applied += 1
+        return applied
+
+    def _delete_where(self, table_name, where):
+        guild_id = int(where["guild_id"])
+        if table_name == "guild_configs":
+            self._configs.pop(guild_id, None)
+        elif table_name in ("attendance_records", "attendance_stats"):
+            rows = self._records if table_name == "attendance_records" else self._stats
+            if table_name == "attendance_stats":
+                self._stats_changed(guild_id)
+            if "user_id" in where:
+                rows.get(guild_id, {}).pop(int(where["user_id"]), None)
+            else:
+                rows.pop(guild_id, None)
+        elif table_name in ("attendance_calendar", "attendance_rollups", "attendance_streaks",
+                            "attendance_archived_counts"):
+            # Only ever upserted; a replace here can only come from a whole-guild reset.
+            rows = {"attendance_calendar": self._calendars, "attendance_rollups": self._rollups,
+                    "attendance_streaks": self._streaks, "attendance_archived_counts": self._archived_counts}[table_name]
+            for key in [key for key in rows if key[0] == guild_id]:
+                del rows[key]
+        elif table_name == "attendance_events":
+            events = self._events.get(guild_id, [])
+            kept = [row for row in events if any(row.get(k) != v for k, v in where.items() if k != "guild_id")]
+            kept_ids = {row["id"] for row in kept}
+            for row in events:
+                if row["id"] not in kept_ids:
+                    self._event_ids.pop(row["id"], None)
+            self._events[guild_id] = kept
+        elif "command_name" in where:
+            self._commands.get(guild_id, {}).pop(where["command_name"], None)
+        else:
+            self._commands.pop(guild_id, None)
+
+    def _insert_row(self, table_name, row):
+        guild_id = int(row["guild_id"])
+        row["guild_id"] = guild_id
+        if table_name == "guild_configs":
+            config = dict(self._config_defaults)
+            config.update((k, v) for k, v in row.items() if k in config)
+            self._configs[guild_id] = config
+        elif table_name == "attendance_records":
+            self._put_record(guild_id, row["user_id"], row.get("status"), row.get("timestamp"),
+                             row.get("channel_id"), row.get("reason"))
+        elif table_name == "attendance_stats":
+            self._stats_changed(guild_id)
+            stats = self._stats.setdefault(guild_id, {})
+            user_id = int(row["user_id"])
+            stats[user_id] = {
+                "guild_id": guild_id,
+                "user_id": user_id,
+                "present_count": row.get("present_count") or 0,
+                "absent_count": row.get("absent_count") or 0,
+                "excused_count": row.get("excused_count") or 0,
+            }
+        elif table_name == "custom_commands":
+            self._commands.setdefault(guild_id, {})[row["command_name"]] = row["response_text"]
+        elif table_name == "attendance_events":
+            self._append_event(guild_id, row["user_id"], row["status"], row["ts"], row.get("reason"),
+                               row.get("source"), event_id=row.get("id"))
+        elif table_name == "attendance_calendar":
+            database.decode_blobs(table_name, row)
+            self._calendars[(guild_id, int(row["user_id"]), int(row["year"]))] = bytes(row["days"])
+        elif table_name == "attendance_rollups":
+            user_id = int(row["user_id"])
+            self._rollups[(guild_id, row["period"], user_id)] = {
+                "guild_id": guild_id, "period": row["period"], "user_id": user_id,
+                "present_count": row.get("present_count") or 0,
+                "absent_count": row.get("absent_count") or 0,
+                "excused_count": row.get("excused_count") or 0,
+            }
+        elif table_name == "attendance_archived_counts":
+            user_id = int(row["user_id"])
+            self._archived_counts[(guild_id, user_id)] = {
+                "guild_id": guild_id, "user_id": user_id,
+                "present_count": row.get("present_count") or 0,
+                "absent_count": row.get("absent_count") or 0,
+                "excused_count": row.get("excused_count") or 0,
+            }
+        elif table_name == "attendance_streaks":
+            user_id = int(row["user_id"])
+            self._streaks[(guild_id, user_id)] = {
+                "guild_id": guild_id, "user_id": user_id,
+                "current_streak": row.get("current_streak") or 0,
+                "best_streak": row.get("best_streak") or 0,
+                "last_day": row.get("last_day"),
+            }
+
+    def _put_record(self, guild_id, user_id, status, timestamp, channel_id, reason):
+        records = self._records.setdefault(guild_id, {})
+        user_id = int(user_id)
+        existing = records.get(user_id)
+        if existing is None:
+            existing = records[user_id] = {"id": self._next_record_id, "guild_id": guild_id, "user_id": user_id}
+            self._next_record_id += 1
+        existing.update(status=status, timestamp=timestamp, channel_id=channel_id, reason=reason)
+
+    def _changed(self):
+        self._scheduler.mark_dirty()
+
+    def _append_event(self, guild_id, user_id, status, ts, reason=None, source=None, event_id=None):
+        """Appends a ledger event; a given event_id of the same guild replaces that event, like
+        database.insert_events(), and one taken by another guild gets a new id."""
+        user_id, ts = int(user_id), database.event_ts(ts)
+        owner = self._event_ids.get(int(event_id)) if event_id is not None else None
+        if owner is not None and owner["guild_id"] == guild_id:
+            owner.update(user_id=user_id, status=status, reason=reason, ts=ts, source=source)
+            return
+        if event_id is None or owner is not None:
+            event_id = self._next_event_id
+        event_id = int(event_id)
+        row = {
+            "id": event_id, "guild_id": guild_id, "user_id": user_id,
+            "status": status, "reason": reason, "ts": ts, "source": source,
+        }
+        self._events.setdefault(guild_id, []).append(row)
+        self._event_ids[event_id] = row
+        self._next_event_id = max(self._next_event_id, event_id + 1)
+
+    def _bump_stat(self, guild_id, user_id, column, count=1):
+        stats = self._stats.setdefault(guild_id, {})
+        row = stats.get(user_id)
+        if row is None:
+            row = stats[user_id] = {
+                "guild_id": guild_id, "user_id": user_id,
+                "present_count": 0, "absent_count": 0, "excused_count": 0,
+            }
+        row[column] += count
+        self._stats_changed(guild_id)
+        return row
+
+    def _stats_changed(self, guild_id):
+        self._stats_versions[guild_id] = self._stats_versions.get(guild_id, 0) + 1
+
+    # Guild configuration
+    def get_guild_config(self, guild_id):
+        with self._lock:
+            config = self._configs.get(int(guild_id))
+            return dict(config) if config else None
+
+    def update_guild_config(self, guild_id, **kwargs):
+        unknown = [key for key in kwargs if key not in self._config_defaults]
+        if unknown:
+            raise ValueError(f"Unknown guild config column(s): {', '.join(unknown)}")
+        guild_id = int(guild_id)
+        with self._lock:
+            config = self._configs.get(guild_id)
+            if config is None:
+                config = self._configs[guild_id] = dict(self._config_defaults, guild_id=guild_id)
+            config.update(kwargs)
+        self._changed()
+
+    # Attendance records
+    def get_attendance_records(self, guild_id):
+        with self._lock:
+            return {
+                str(user_id): database.record_from_row(row)
+                for user_id, row in self._records.get(int(guild_id), {}).items()
+            }
+
+    def get_record(self, guild_id, user_id):
+        with self._lock:
+            row = self._records.get(int(guild_id), {}).get(int(user_id))
+            return database.record_from_row(row) if row else None
+
+    def upsert_record(self, guild_id, user_id, status, timestamp, channel_id=None, reason=None):
+        with self._lock:
+            self._put_record(int(guild_id), user_id, status, timestamp, channel_id, reason)
+        self._changed()
+
+    def delete_record(self, guild_id, user_id):
+        with self._lock:
+            deleted = self._records.get(int(guild_id), {}).pop(int(user_id), None) is not None
+        if deleted:
+            self._changed()
+        return deleted
+
+    def bulk_upsert_records(self, guild_id, records_dict):
+        if not records_dict:
+            return
+        guild_id = int(guild_id)
+        with self._lock:
+            for uid, info in records_dict.items():
+                self._put_record(guild_id, uid, info.get('status', 'present'), info.get('timestamp'),
+                                 info.get('channel_id'), info.get('reason'))
+        self._changed()
+
+    def replace_all_records(self, guild_id, records_dict):
+        guild_id = int(guild_id)
+        with self._lock:
+            self._records.pop(guild_id, None)
+            for uid, info in records_dict.items():
+                self._put_record(guild_id, uid, info.get('status', 'present'), info.get('timestamp'),
+                                 info.get('channel_id'), info.get('reason'))
+        self._changed()
+
+    def clear_attendance_records(self, guild_id):
+        with self._lock:
+            self._records.pop(int(guild_id), None)
+        self._changed()
+
+    # Attendance stats
+    def clear_attendance_stats(self, guild_id):
+        with self._lock:
+            self._stats.pop(int(guild_id), None)
+            for key in [key for key in self._archived_counts if key[0] == int(guild_id)]:
+                del self._archived_counts[key]
+            self._stats_changed(int(guild_id))
+            self._append_event(int(guild_id), database.RESET_EVENT_USER_ID, database.RESET_EVENT_STATUS,
+                               None, source="reset")
+        database.notify_stats_changed(int(guild_id), None)
+        self._changed()
+
+    def increment_status_count(self, guild_id, user_id, status, count=1):
+        column = STATUS_COLUMNS.get(status)
+        if column is None:
+            return
+        guild_id, user_id = int(guild_id), int(user_id)
+        with self._lock:
+            row = self._bump_stat(guild_id, user_id, column, count)
+            present_count, version = row["present_count"], self._stats_versions[guild_id]
+        database.notify_stats_changed(guild_id, [(user_id, present_count)], version)
+        self._changed()
+
+    def close_session(self, guild_id, date, absent_user_ids, timestamp=None,
+                      reason="Auto-marked at end of attendance window", clear=True):
+        guild_id = int(guild_id)
+        timestamp = timestamp or datetime.now().isoformat()
+        with self._lock:
+            config = self._configs.get(guild_id)
+            if config is not None and config.get("last_processed_date") == date:
+                return None
+            records = self._records.get(guild_id, {})
+            absent_ids = sorted({int(uid) for uid in absent_user_ids} - set(records))
+            stats = self._stats.setdefault(guild_id, {})
+            for uid in absent_ids:
+                self._put_record(guild_id, uid, "absent", timestamp, None, reason)
+                self._append_event(guild_id, uid, "absent", timestamp, reason, "auto_close")
+                self._bump_stat(guild_id, uid, "absent_count")
+            stats_rows = [(uid, stats[uid]["present_count"]) for uid in absent_ids]
+            version = self._stats_versions.get(guild_id, 0)
+            session = {
+                str(uid): database.record_from_row(row)
+                for uid, row in self._records.get(guild_id, {}).items()
+            }
+            self._update_rollups(guild_id, date, {int(uid): record["status"] for uid, record in session.items()})
+            if clear:
+                self._records.pop(guild_id, None)
+            if config is None:
+                config = self._configs[guild_id] = dict(self._config_defaults, guild_id=guild_id)
+            config["last_processed_date"] = date
+        if stats_rows:
+            database.notify_stats_changed(guild_id, stats_rows, version)
+        self._changed()
+        return session
+
+    def _update_rollups(self, guild_id, day, statuses):
+        periods = database.period_keys(day)
+        year, index = attendance_calendar.day_index(day)
+        for user_id, status in statuses.items():
+            column = STATUS_COLUMNS.get(status)
+            if column is None:
+                continue
+            key = (guild_id, user_id, year)
+            self._calendars[key] = attendance_calendar.set_day(self._calendars.get(key), index, status)
+            for period in periods:
+                rollup = self._rollups.setdefault((guild_id, period, user_id), {
+                    "guild_id": guild_id, "period": period, "user_id": user_id,
+                    "present_count": 0, "absent_count": 0, "excused_count": 0,
+                })
+                rollup[column] += 1
+            streak = self._streaks.get((guild_id, user_id))
+            current, best, last_day = database.next_streak(
+                (streak["current_streak"], streak["best_streak"], streak["last_day"]) if streak else None,
+                status, day
+            )
+            self._streaks[(guild_id, user_id)] = {
+                "guild_id": guild_id, "user_id": user_id,
+                "current_streak": current, "best_streak": best, "last_day": last_day,
+            }
+
+    # Rollups and streaks
+    def get_calendar(self, guild_id, user_id, year):
+        with self._lock:
+            return self._calendars.get((int(guild_id), int(user_id), int(year)))
+
+    def get_guild_calendars(self, guild_id, year):
+        guild_id, year = int(guild_id), int(year)
+        with self._lock:
+            return {
+                user_id: days
+                for (gid, user_id, y), days in self._calendars.items()
+                if gid == guild_id and y == year
+            }
+
+    def get_member_stats(self, guild_id, user_id, period):
+        guild_id, user_id = int(guild_id), int(user_id)
+        with self._lock:
+            rollup = self._rollups.get((guild_id, period, user_id))
+            streak = self._streaks.get((guild_id, user_id))
+            return database.member_stats(period, dict(rollup) if rollup else None, dict(streak) if streak else None)
+
+    def get_period_leaderboard(self, guild_id, period, limit=10, offset=0):
+        guild_id = int(guild_id)
+        with self._lock:
+            rows = sorted(
+                (row for (gid, p, _), row in self._rollups.items() if gid == guild_id and p == period),
+                key=lambda row: (-row["present_count"], row["user_id"])
+            )
+        return len(rows), [
+            {
+                "user_id": row["user_id"],
+                "present_count": row["present_count"],
+                "absent_count": row["absent_count"],
+                "excused_count": row["excused_count"],
+            }
+            for row in rows[offset:offset + limit]
+        ]
+
+    # Attendance ledger
+    def record_attendance(self, guild_id, user_id, status, timestamp, channel_id=None, reason=None, source=None):
+        guild_id, user_id = int(guild_id), int(user_id)
+        column = STATUS_COLUMNS.get(status)
+        with self._lock:
+            self._put_record(guild_id, user_id, status, timestamp, channel_id, reason)
+            self._append_event(guild_id, user_id, status, timestamp, reason, source)
+            if column is not None:
+                row = self._bump_stat(guild_id, user_id, column)
+                present_count, version = row["present_count"], self._stats_versions[guild_id]
+        if column is not None:
+            database.notify_stats_changed(guild_id, [(user_id, present_count)], version)
+        self._changed()
+
+    def log_attendance_event(self, guild_id, user_id, status, timestamp=None, reason=None, source=None):
+        with self._lock:
+            self._append_event(int(guild_id), user_id, status, timestamp, reason, source)
+        self._changed()
+
+    def get_attendance_history(self, guild_id, user_id, since=None, until=None, limit=50):
+        since = database.event_ts(since) if since is not None else 0
+        until = database.event_ts(until) if until is not None else 2 ** 62
+        user_id = int(user_id)
+        with self._lock:
+            rows = [
+                row for row in self._events.get(int(guild_id), [])
+                if row["user_id"] == user_id and since <= row["ts"] < until
+            ]
+        rows.sort(key=lambda row: (row["ts"], row["id"]), reverse=True)
+        events = [
+            {"status": row["status"], "reason": row["reason"], "ts": row["ts"], "source": row["source"]}
+            for row in rows[:limit]
+        ]
+        if len(events) < limit:
+            archived = attendance_archive.read_history(database.ARCHIVE_DIR, int(guild_id), user_id, since, until)
+            archived.sort(key=lambda event: event["ts"], reverse=True)
+            events.extend(archived[:limit - len(events)])
+        return events
+
+    def search_excuses(self, guild_id, terms, since=None, until=None, limit=10, offset=0):
+        # No FTS index here: every word of terms must start (with *) or equal a word of the reason.
+        words = [(word.rstrip("*").lower(), word.endswith("*")) for word in re.findall(r"[\w']+\*?", terms or "")]
+        words = [(word, prefix) for word, prefix in words if word]
+        if not words:
+            return 0, []
+        since = database.event_ts(since) if since is not None else 0
+        until = database.event_ts(until) if until is not None else 2 ** 62
+        archived = [
+            dict(excuse, status="excused")
+            for excuse in attendance_archive.read_excuses(database.ARCHIVE_DIR, int(guild_id), since, until)
+        ]
+        matches = []
+        with self._lock:
+            for row in self._events.get(int(guild_id), []) + archived:
+                if row["status"] != "excused" or not row["reason"] or not since <= row["ts"] < until:
+                    continue
+                tokens = re.findall(r"[\w']+", row["reason"].lower())
+                hits = [
+                    sum(token.startswith(word) if prefix else token == word for token in tokens)
+                    for word, prefix in words
+                ]
+                if all(hits):
+                    matches.append((sum(hits), row))
+        matches.sort(key=lambda match: (-match[0], -match[1]["ts"]))
+        return len(matches), [
+            {"user_id": row["user_id"], "reason": row["reason"], "ts": row["ts"], "source": row["source"],
+             "snippet": row["reason"]}
+            for _, row in matches[offset:offset + limit]
+        ]
+
+    def get_analytics_rows(self, guild_id):
+        guild_id = int(guild_id)
+        with self._lock:
+            stats = [
+                (user_id, row["present_count"], row["absent_count"], row["excused_count"])
+                for user_id, row in self._stats.get(guild_id, {}).items()
+            ]
+            events = self._events.get(guild_id, [])
+            start = 0
+            for index, row in enumerate(events):
+                if row["user_id"] == database.RESET_EVENT_USER_ID and row["status"] == database.RESET_EVENT_STATUS:
+                    start = index + 1
+            events = [
+                (row["user_id"], row["status"], row["ts"])
+                for row in events[start:] if row["status"] in database.COUNTED_STATUSES
+            ]
+        return {"stats": stats, "events": events}
+
+    def rebuild_attendance_stats(self, guild_id=None):
+        total = 0
+        with self._lock:
+            guild_ids = list(self._events) if guild_id is None else [int(guild_id)]
+            if guild_id is None:
+                self._stats.clear()
+            for gid in guild_ids:
+                self._stats.pop(gid, None)
+                events = self._events.get(gid, [])
+                # Count only what happened after the latest stats reset.
+                start = 0
+                for index, row in enumerate(events):
+                    if row["user_id"] == database.RESET_EVENT_USER_ID and row["status"] == database.RESET_EVENT_STATUS:
+                        start = index + 1
+                for row in events[start:]:
+                    column = STATUS_COLUMNS.get(row["status"])
+                    if column is not None:
+                        self._bump_stat(gid, row["user_id"], column)
+                for (archived_gid, user_id), counts in self._archived_counts.items():
+                    if archived_gid == gid:
+                        for column in STATUS_COLUMNS.values():
+                            if counts[column]:
+                                self._bump_stat(gid, user_id, column, counts[column])
+                self._stats_changed(gid)
+                total += len(self._stats.get(gid, {}))
+        database.notify_stats_changed(guild_id, None)
+        self._changed()
+        return total
+
+    def get_leaderboard_state(self, guild_id):
+        guild_id = int(guild_id)
+        with self._lock:
+            return {
+                "members": len(self._stats.get(guild_id, {})),
+                "version": self._stats_versions.get(guild_id, 0),
+            }
+
+    def get_attendance_leaderboard_count(self, guild_id):
+        with self._lock:
+            return len(self._stats.get(int(guild_id), {}))
+
+    def get_attendance_leaderboard(self, guild_id, limit=10, offset=0, after=None):
+        with self._lock:
+            rows = sorted(
+                self._stats.get(int(guild_id), {}).values(),
+                key=lambda row: (-row["present_count"], row["user_id"])
+            )
+            if after is not None:
+                present_count, user_id = after
+                rows = [row for row in rows if (-row["present_count"], row["user_id"]) > (-present_count, user_id)]
+                offset = 0
+            rows = rows[offset:offset + limit]
+            return [
+                {
+                    "user_id": row["user_id"],
+                    "present_count": row["present_count"],
+                    "absent_count": row["absent_count"],
+                    "excused_count": row["excused_count"],
+                }
+                for row in rows
+            ]
+
+    def get_present_counts(self, guild_id=None):
+        with self._lock:
+            guilds = self._stats.items() if guild_id is None else [(int(guild_id), self._stats.get(int(guild_id), {}))]
+            return [
+                (gid, user_id, row["present_count"])
+                for gid, stats in guilds
+                for user_id, row in stats.items()
+            ]
+
+    # Custom commands
+    def get_custom_commands(self, guild_id):
+        with self._lock:
+            return dict(sorted(self._commands.get(int(guild_id), {}).items()))
+
+    def get_custom_command(self, guild_id, command_name):
+        with self._lock:
+            return self._commands.get(int(guild_id), {}).get(command_name)
+
+    def upsert_custom_command(self, guild_id, command_name, response_text):
+        with self._lock:
+            self._commands.setdefault(int(guild_id), {})[command_name] = response_text
+        self._changed()
+
+    def delete_custom_command(self, guild_id, command_name):
+        with self._lock:
+            deleted = self._commands.get(int(guild_id), {}).pop(command_name, None) is not None
+        if deleted:
+            self._changed()
+        return deleted
+
+    # Export / restore
+    def export_all_data(self):
+        with self._lock:
+            tables = {
+                table_name: [
+                    database.encode_blobs(table_name, dict(zip(database.schema_columns(table_name), row)))
+                    for row in self._table_rows(table_name)
+                ]
+                for table_name in database.SNAPSHOT_TABLES
+            }
+        return {
+            "exported_at": datetime.utcnow().isoformat() + "Z",
+            "db_file": ":memory:",
+            "tables": tables
+        }
+
+    def import_data(self, payload, snapshot=True):
+        with self._lock:
+            for table_name in database.SNAPSHOT_TABLES:
+                for row in payload.get("tables", {}).get(table_name, []):
+                    self._insert_row(table_name, dict(row))
+        database.notify_stats_changed(None, None)
+        if snapshot:
+            self._changed()
+
+    # Maintenance
+    def run_maintenance(self, guild_ids, retention_days=None):
+        started = time.time()
+        retention_days = database.RETENTION_DAYS if retention_days is None else retention_days
+        steps = []
+        if retention_days > 0:
+            cutoff = database.retention_cutoffs(datetime.now() - timedelta(days=retention_days))
+            for guild_id in sorted(int(g) for g in guild_ids):
+                steps.extend(self._apply_retention(guild_id, cutoff))
+        if database.ARCHIVE_ENABLED:
+            for guild_id in sorted(int(g) for g in guild_ids):
+                try:
+                    steps.extend(self.archive_closed_months(guild_id))
+                except OSError as e:
+                    logger.warning("Archiving guild %s failed: %s", guild_id, e)
+                    steps.append({"step": "error", "guild_id": guild_id, "error": str(e)})
+        return {"steps": steps, "duration_seconds": round(time.time() - started, 3)}
+
+    def _apply_retention(self, guild_id, cutoff):
+        """Mirrors database.apply_retention for one guild; cutoff is database.retention_cutoffs()."""
+        steps = []
+
+        def expire(table_name, rows, is_old):
+            step_started = time.perf_counter()
+            expired = [key for key, row in rows.items() if is_old(key, row)]
+            for key in expired:
+                del rows[key]
+            steps.append({
+                "step": "retention", "guild_id": guild_id, "table": table_name,
+                "rows": len(expired), "batches": 1,
+                "max_writer_ms": round((time.perf_counter() - step_started) * 1000, 2),
+            })
+
+        with self._lock:
+            if not database.ARCHIVE_ENABLED:
+                step_started = time.perf_counter()
+                events = self._events.get(guild_id, [])
+                old = [row for row in events if row["ts"] < cutoff["ts"]]
+                if old:
+                    self._retire_events(guild_id, old, [row for row in events if row["ts"] >= cutoff["ts"]])
+                    self._events[guild_id] = [row for row in events if row["ts"] >= cutoff["ts"]]
+                steps.append({
+                    "step": "retention", "guild_id": guild_id, "table": "attendance_events",
+                    "rows": len(old), "batches": 1,
+                    "max_writer_ms": round((time.perf_counter() - step_started) * 1000, 2),
+                })
+            expire("attendance_records", self._records.get(guild_id, {}),
+                   lambda uid, row: row.get("timestamp") and row["timestamp"] < cutoff["timestamp"])
+            expire("attendance_rollups", self._rollups, lambda key, row: key[0] == guild_id
+                   and key[1] < (cutoff["week"] if "-W" in key[1] else cutoff["month"]))
+            expire("attendance_calendar", self._calendars,
+                   lambda key, row: key[0] == guild_id and key[2] < cutoff["year"])
+        if any(step["rows"] for step in steps):
+            self._changed()
+        return steps
+
+    def _retire_events(self, guild_id, rows, remaining):
+        """Drops ledger rows leaving the live set, keeping their counts for rebuilds unless a
+        reset among the remaining events makes them irrelevant."""
+        reset_ids = [row["id"] for row in remaining if row["user_id"] == database.RESET_EVENT_USER_ID
+                     and row["status"] == database.RESET_EVENT_STATUS]
+        for row in sorted(rows, key=lambda row: row["id"]):
+            if row["user_id"] == database.RESET_EVENT_USER_ID and row["status"] == database.RESET_EVENT_STATUS:
+                for key in [key for key in self._archived_counts if key[0] == guild_id]:
+                    del self._archived_counts[key]
+            elif row["status"] in STATUS_COLUMNS and not any(reset_id > row["id"] for reset_id in reset_ids):
+                counts = self._archived_counts.setdefault((guild_id, row["user_id"]), {
+                    "guild_id": guild_id, "user_id": row["user_id"],
+                    "present_count": 0, "absent_count": 0, "excused_count": 0,
+                })
+                counts[STATUS_COLUMNS[row["status"]]] += 1
+            self._event_ids.pop(row["id"], None)
+
+    def archive_closed_months(self, guild_id, keep_months=None, now=None):
+        guild_id = int(guild_id)
+        cutoff = database.archive_cutoff(keep_months, now)
+        steps = []
+        with self._lock:
+            events = self._events.get(guild_id, [])
+            by_month = {}
+            for row in events:
+                if row["ts"] < cutoff:
+                    by_month.setdefault(attendance_archive.month_key(row["ts"]), []).append(row)
+            if not by_month:
+                return steps
+            for month, rows in sorted(by_month.items()):
+                step_started = time.perf_counter()
+                path, archived = database.write_archive_month(
+                    guild_id, month, [(row["user_id"], row["status"], row["reason"], row["ts"], row["source"], row["id"])
+                                      for row in rows]
+                )
+                self._retire_events(guild_id, rows, [row for row in events if row["ts"] >= cutoff])
+                steps.append({
+                    "step": "archive", "guild_id": guild_id, "month": month, "file": str(path),
+                    "rows": len(rows), "archived_rows": archived, "batches": 1,
+                    "max_writer_ms": round((time.perf_counter() - step_started) * 1000, 2),
+                })
+            self._events[guild_id] = [row for row in events if row["ts"] >= cutoff]
+        self._changed()
+        return steps
+
+
+def add_stats_listener(listener):
+    """Registers listener(guild_id, rows, version) for committed stats changes on any backend.
+
+    See database.stats_listeners for the arguments; listeners run on the writing thread.
+    """
+    database.stats_listeners.append(listener)
+
+
+def create_backend(name=None):
+    """Builds the storage engine named by DB_BACKEND (or name)."""
+    name = (name or DB_BACKEND).strip().lower()
+    if name not in BACKENDS:
+        logger.warning("Unknown DB_BACKEND %r; using 'sqlite'.", name)
+    elif name == "memory":
+        return MemoryBackend()
+    return SQLiteBackend()
+
+
+backend = create_backend()